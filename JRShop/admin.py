@@ -1,5 +1,22 @@
+from decimal import Decimal
+
 from django.contrib import admin
-from .models import Category, Product, Rating, Cart, CartItem, Order, OrderItem
+from django.db import models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.html import format_html
+from . import images
+from .models import Category, Product, Rating, Cart, CartItem, Order, OrderItem, PaymentValidation, Job
+from .pagination import EstimatedCountPaginator
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelists that never COUNT(*) a big table just to show the row count"""
+    paginator = EstimatedCountPaginator
+    # Skips the second, unfiltered count shown next to filtered results
+    show_full_result_count = False
+
 
 # Category Admin
 @admin.register(Category)
@@ -10,8 +27,10 @@ class CategoryAdmin(admin.ModelAdmin):
 
 # Product Admin
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'get_price_display', 'stock', 'available', 'created_at')
+class ProductAdmin(LargeTableAdmin):
+    list_display = ('get_thumbnail', 'name', 'category', 'get_price_display', 'stock', 'available', 'created_at')
+    list_select_related = ('category',)
+    list_display_links = ('get_thumbnail', 'name')
     list_filter = ('category', 'available', 'created_at')
     search_fields = ('name', 'description')
     prepopulated_fields = {'slug': ('name',)}
@@ -35,6 +54,13 @@ class ProductAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_thumbnail(self, obj):
+        if not obj.image:
+            return ''
+        return format_html('<img src="{}" alt="" width="40" height="40" style="object-fit: cover">',
+                           images.fallback_url(obj, 'thumb'))
+    get_thumbnail.short_description = 'Image'
+
     def get_price_display(self, obj):
         if obj.has_discount():
             return f"৳{obj.discount_price} (was ৳{obj.price})"
@@ -51,16 +77,22 @@ class ProductAdmin(admin.ModelAdmin):
 
 # Rating Admin
 @admin.register(Rating)
-class RatingAdmin(admin.ModelAdmin):
+class RatingAdmin(LargeTableAdmin):
     list_display = ('user', 'product', 'rating', 'created_at')
-    list_filter = ('rating', 'created_at', 'product')
+    list_select_related = ('user', 'product')
+    raw_id_fields = ('user',)
+    autocomplete_fields = ('product',)
+    # No filter on product: its sidebar would list every product on each page
+    list_filter = ('rating', 'created_at')
     search_fields = ('user__username', 'product__name')
     readonly_fields = ('created_at',)
 
 # Cart Admin
 @admin.register(Cart)
-class CartAdmin(admin.ModelAdmin):
+class CartAdmin(LargeTableAdmin):
     list_display = ('user', 'created_at', 'updated_at')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
     list_filter = ('created_at', 'updated_at')
     search_fields = ('user__username',)
     readonly_fields = ('created_at', 'updated_at')
@@ -70,15 +102,20 @@ class CartItemInline(admin.TabularInline):
     model = CartItem
     extra = 1
     fields = ('product', 'quantity')
+    autocomplete_fields = ('product',)
 
 # Update Cart Admin to include CartItems
 CartAdmin.inlines = [CartItemInline]
 
 # CartItem Admin
 @admin.register(CartItem)
-class CartItemAdmin(admin.ModelAdmin):
+class CartItemAdmin(LargeTableAdmin):
     list_display = ('cart', 'product', 'quantity', 'get_cost')
-    list_filter = ('cart__user',)
+    list_select_related = ('cart__user', 'product')
+    raw_id_fields = ('cart',)
+    autocomplete_fields = ('product',)
+    # Found by user or product through the search box; a filter on either
+    # would list every user or product on each page
     search_fields = ('product__name', 'cart__user__username')
     
     def get_cost(self, obj):
@@ -87,8 +124,10 @@ class CartItemAdmin(admin.ModelAdmin):
 
 # Order Admin
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(LargeTableAdmin):
     list_display = ('id', 'user', 'status', 'created_at', 'get_total')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
     list_filter = ('status', 'created_at')
     search_fields = ('user__username', 'email', 'transaction_id')
     readonly_fields = ('created_at', 'updated_at')
@@ -111,6 +150,15 @@ class OrderAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_queryset(self, request):
+        # A correlated subquery is only evaluated for the rows on the page,
+        # where a join and GROUP BY would aggregate the whole table first
+        lines = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        total = lines.annotate(total=Sum(F('quantity') * F('price'))).values('total')
+        return super().get_queryset(request).annotate(total_cost=Coalesce(
+            Subquery(total), Value(Decimal('0')), output_field=models.DecimalField(max_digits=12, decimal_places=2),
+        ))
+
     def get_total(self, obj):
         return f"৳{obj.get_total_cost()}"
     get_total.short_description = 'Total Amount'
@@ -120,17 +168,44 @@ class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 1
     fields = ('product', 'quantity', 'price')
+    autocomplete_fields = ('product',)
 
 # Update Order Admin to include OrderItems
 OrderAdmin.inlines = [OrderItemInline]
 
 # OrderItem Admin
 @admin.register(OrderItem)
-class OrderItemAdmin(admin.ModelAdmin):
+class OrderItemAdmin(LargeTableAdmin):
     list_display = ('order', 'product', 'quantity', 'price', 'get_cost')
+    list_select_related = ('order', 'product')
+    raw_id_fields = ('order',)
+    autocomplete_fields = ('product',)
     list_filter = ('order__created_at',)
     search_fields = ('product__name', 'order__id')
     
     def get_cost(self, obj):
         return f"৳{obj.get_cost()}"
     get_cost.short_description = 'Total Cost'
+
+# PaymentValidation Admin
+@admin.register(PaymentValidation)
+class PaymentValidationAdmin(LargeTableAdmin):
+    list_display = ('val_id', 'order', 'tran_id', 'status', 'amount', 'created_at')
+    list_select_related = ('order',)
+    raw_id_fields = ('order',)
+    list_filter = ('status', 'created_at')
+    search_fields = ('val_id', 'tran_id')
+    readonly_fields = ('created_at',)
+
+# Job Admin
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'run_at', 'created_at')
+    list_filter = ('status', 'name')
+    search_fields = ('key',)
+    readonly_fields = ('created_at', 'last_error')
+    actions = ['retry_now']
+
+    @admin.action(description='Retry selected jobs now')
+    def retry_now(self, request, queryset):
+        queryset.update(status='queued', attempts=0, run_at=timezone.now())
@@ -0,0 +1,13 @@
+"""
+Cached database sessions that skip unchanged writes (see sessions.py).
+
+Only for a cache shared by every worker; settings.SESSION_ENGINE selects
+this engine when CACHE_BACKEND is Redis or Memcached.
+"""
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+
+from .sessions import SkipUnchangedMixin
+
+
+class SessionStore(SkipUnchangedMixin, CachedDBStore):
+    pass
@@ -0,0 +1,132 @@
+"""
+Catalog caching: versioned fragment keys and whole-page caching for
+anonymous visitors.
+
+Nothing is deleted on invalidation. Cache keys embed version tokens
+instead:
+
+    catalog        any product, category or rating change (cached pages)
+    categories     category changes (the category sidebar)
+    product:<id>   changes to one product or its ratings (its card)
+
+A save bumps the tokens it affects once its transaction commits, and
+entries keyed on the old tokens are never read again and simply expire.
+This works the same on the local-memory, file and Redis backends, since
+it needs only get_many and set_many.
+
+With read replicas, an entry filled just after a change may have been
+read from a replica that has not caught up yet. For REPLICA_STICKY_SECONDS
+after a change its token is therefore handed out marked as settling, and
+whatever is cached under the marked token is not read once that window
+has passed.
+
+Stock is decremented by UPDATE at checkout, without signals, so stock
+counts on cached pages can lag by up to CATALOG_PAGE_CACHE_TIMEOUT;
+checkout always checks the real stock.
+"""
+import hashlib
+import time
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+
+from .cart import ANONYMOUS_CART_COOKIE
+from .routers import replicas, sticky_seconds
+
+VERSION_PREFIX = 'catalog-version:'
+
+
+def _settling(token):
+    # Tokens are the time of the change in nanoseconds
+    return time.time_ns() - token < sticky_seconds() * 1_000_000_000
+
+
+def get_versions(*names):
+    """Current version token for each name, creating missing ones; marked while replicas may lag it"""
+    keys = {f'{VERSION_PREFIX}{name}': name for name in names}
+    found = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, None)
+        found.update(missing)
+    if replicas():
+        found = {key: f'{token}-settling' if _settling(token) else token for key, token in found.items()}
+    return {name: found[key] for key, name in keys.items()}
+
+
+def get_version(name):
+    return get_versions(name)[name]
+
+
+def bump_versions(*names):
+    """Invalidate everything keyed on these versions once the current transaction commits"""
+    def bump():
+        token = time.time_ns()
+        cache.set_many({f'{VERSION_PREFIX}{name}': token for name in names}, None)
+    transaction.on_commit(bump)
+
+
+def fragment_timeout():
+    return getattr(settings, 'CATALOG_FRAGMENT_CACHE_TIMEOUT', 3600)
+
+
+def annotate_card_versions(products):
+    """Attach each product's version as cache_version, for its card fragment key"""
+    products = list(products)
+    versions = get_versions(*[f'product:{product.id}' for product in products])
+    for product in products:
+        product.cache_version = versions[f'product:{product.id}']
+    return products
+
+
+def _has_pending_messages(request):
+    if request.COOKIES.get('messages'):
+        return True
+    if settings.SESSION_COOKIE_NAME in request.COOKIES:
+        return '_messages' in request.session
+    return False
+
+
+def page_cache_key(request, params):
+    """Key on the path and the view's own query parameters, sorted, without blanks"""
+    query = urlencode(sorted(
+        (name, value) for name in params for value in request.GET.getlist(name) if value
+    ))
+    raw = f"{get_version('catalog')}|{request.path}|{query}"
+    return f'catalog-page:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def cache_anonymous_page(params=(), timeout=None):
+    """
+    Serve anonymous GET requests for a catalog view from the cache.
+
+    Only the listed query parameters are part of the key, so tracking
+    parameters don't fragment it. Responses that are user-specific are
+    never stored: those that set cookies or used the CSRF token, and
+    requests with messages waiting to be shown or items in their cart.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if (request.method not in ('GET', 'HEAD') or request.user.is_authenticated
+                    or _has_pending_messages(request) or request.COOKIES.get(ANONYMOUS_CART_COOKIE)):
+                return view(request, *args, **kwargs)
+
+            key = page_cache_key(request, params)
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+            response = view(request, *args, **kwargs)
+            if (response.status_code == 200 and not response.streaming and not response.cookies
+                    and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')):
+                page_timeout = timeout or getattr(settings, 'CATALOG_PAGE_CACHE_TIMEOUT', 120)
+                cache.set(key, (response.content, response['Content-Type']), page_timeout)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,316 @@
+"""
+Cart writes, and the per-user cart summary (line count and product ids)
+for navbar badges.
+
+Every user has at most one cart (Cart.user is one-to-one) and a cart has
+one line per product, so adding to the cart is an upsert of each, safe
+against concurrent clicks.
+
+The summary is loaded with one query, cached per user and dropped by the
+views that change the cart, so rendering a badge costs no queries on a
+cache hit.
+
+Visitors who are not logged in get an AnonymousCart instead, kept in a
+signed cookie: browsing and carting anonymously reads products but never
+writes to the database. The cookie's lines are merged into the user's
+cart when they log in.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product
+
+
+class CartConflict(Exception):
+    """Changes that do not fit the cart as it is now; nothing was applied"""
+
+    def __init__(self, errors, cart, items):
+        super().__init__(errors)
+        self.errors = errors
+        self.cart = cart
+        self.items = items
+
+
+class CartFull(Exception):
+    """An anonymous cart already holds ANONYMOUS_CART_MAX_LINES lines"""
+
+
+def _cart_id(user):
+    """Id of the user's cart, creating it if need be, in one statement"""
+    table = connection.ops.quote_name(Cart._meta.db_table)
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""INSERT INTO {table} (user_id, created_at, updated_at, version) VALUES (%s, %s, %s, 0)
+                ON CONFLICT (user_id) DO UPDATE SET user_id = excluded.user_id
+                RETURNING id""",
+            [user.pk, now, now],
+        )
+        return cursor.fetchone()[0]
+
+
+def _lines_changed(cart_id, rows):
+    """
+    Raise the cart's version if `rows` lines were written; every cart write
+    goes through here, so a PATCH client's version check sees all of them.
+    Returns rows.
+    """
+    if rows:
+        Cart.objects.filter(pk=cart_id).update(version=F('version') + 1, updated_at=timezone.now())
+    return rows
+
+
+def add_item(user, product_id, quantity=1):
+    """
+    Add units of an available product to the user's cart.
+
+    The line is inserted, or its quantity raised, by a single INSERT ...
+    ON CONFLICT DO UPDATE that caps it at the product's stock, so
+    concurrent adds neither lose an increment nor oversell. Returns the
+    line's new quantity, or None if nothing could be added (out of stock,
+    unavailable, or the line already holds all the stock).
+    """
+    cart_id = _cart_id(user)
+    qn = connection.ops.quote_name
+    item_table, product_table = qn(CartItem._meta.db_table), qn(Product._meta.db_table)
+    least = 'MIN' if connection.vendor == 'sqlite' else 'LEAST'
+    stock = f'(SELECT stock FROM {product_table} WHERE id = excluded.product_id)'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""INSERT INTO {item_table} (cart_id, product_id, quantity)
+                SELECT %s, id, {least}(%s, stock) FROM {product_table} WHERE id = %s AND available AND stock > 0
+                ON CONFLICT (cart_id, product_id) DO UPDATE
+                SET quantity = {least}({item_table}.quantity + excluded.quantity, {stock})
+                WHERE {item_table}.quantity < {stock}
+                RETURNING quantity""",
+            [cart_id, quantity, product_id],
+        )
+        row = cursor.fetchone()
+        _lines_changed(cart_id, 1 if row else 0)
+    return row[0] if row else None
+
+
+def apply_changes(user, changes):
+    """
+    Set the quantity of several cart lines at once; 0 removes a line.
+
+    `changes` maps CartItem ids to quantities. The cart's lines and their
+    products' stock are read in one query, then every change is validated
+    and applied (one bulk UPDATE, one DELETE) in a single transaction that
+    also raises the cart version if any line changed. Raising a line of a
+    product that is no longer available is a conflict too. Either all
+    changes apply or, with CartConflict, none. Returns the cart and its remaining lines.
+    """
+    with transaction.atomic():
+        cart = Cart.objects.select_for_update().filter(user=user).first()
+        items = list(cart.items.select_related('product').order_by('id')) if cart else []
+        by_id = {item.pk: item for item in items}
+
+        errors = {}
+        for item_id, quantity in changes.items():
+            item = by_id.get(item_id)
+            if item is None:
+                errors[item_id] = "Item not found"
+            elif quantity > item.quantity and not item.product.available:
+                errors[item_id] = "No longer available"
+            elif quantity > item.product.stock:
+                errors[item_id] = f"Only {item.product.stock} in stock"
+        if errors:
+            raise CartConflict(errors, cart, items)
+        if not changes:
+            return cart, items
+
+        removed = [item_id for item_id, quantity in changes.items() if quantity == 0]
+        updated = []
+        for item_id, quantity in changes.items():
+            item = by_id[item_id]
+            if quantity and quantity != item.quantity:
+                item.quantity = quantity
+                updated.append(item)
+        if removed:
+            CartItem.objects.filter(pk__in=removed).delete()
+        if updated:
+            CartItem.objects.bulk_update(updated, ['quantity'])
+        if _lines_changed(cart.pk, len(removed) + len(updated)):
+            # The row is locked, so the new version is known without reading it back
+            cart.version += 1
+
+    if removed:
+        invalidate_cart_summary(user)
+    return cart, [item for item in items if item.pk not in removed]
+
+
+def merge_items(user, lines):
+    """
+    Add {product_id: quantity} lines to the user's cart in one statement.
+
+    Like add_item, each line is capped at its product's stock and lines
+    for unavailable or sold-out products are skipped.
+    """
+    cart_id = _cart_id(user)
+    qn = connection.ops.quote_name
+    item_table, product_table = qn(CartItem._meta.db_table), qn(Product._meta.db_table)
+    least = 'MIN' if connection.vendor == 'sqlite' else 'LEAST'
+    stock = f'(SELECT stock FROM {product_table} WHERE id = excluded.product_id)'
+    values = ', '.join(['(%s, %s)'] * len(lines))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""INSERT INTO {item_table} (cart_id, product_id, quantity)
+                SELECT %s, p.id, {least}(v.column2, p.stock)
+                FROM {product_table} p JOIN (VALUES {values}) AS v ON p.id = v.column1
+                WHERE p.available AND p.stock > 0
+                ON CONFLICT (cart_id, product_id) DO UPDATE
+                SET quantity = {least}({item_table}.quantity + excluded.quantity, {stock})""",
+            [cart_id, *[value for line in lines.items() for value in line]],
+        )
+        _lines_changed(cart_id, cursor.rowcount)
+
+
+ANONYMOUS_CART_COOKIE = 'cart'
+_COOKIE_SALT = 'JRShop.cart'
+
+
+def _cookie_age():
+    return getattr(settings, 'ANONYMOUS_CART_COOKIE_AGE', 30 * 24 * 3600)
+
+
+def read_anonymous_cart(request):
+    """{product_id: quantity} from the cart cookie; empty if it is missing, expired or tampered with"""
+    try:
+        value = request.get_signed_cookie(ANONYMOUS_CART_COOKIE, default='', salt=_COOKIE_SALT, max_age=_cookie_age())
+    except signing.BadSignature:
+        return {}
+    lines = {}
+    for entry in filter(None, value.split(',')):
+        product_id, _, quantity = entry.partition(':')
+        try:
+            lines[int(product_id)] = int(quantity)
+        except ValueError:
+            continue
+    return {product_id: quantity for product_id, quantity in lines.items() if quantity > 0}
+
+
+class AnonymousCart:
+    """
+    The cart of a visitor who is not logged in, kept in a signed cookie as
+    "product_id:quantity,..." so it costs no session or cart rows.
+
+    Its lines are unsaved CartItems whose id is their product id, priced
+    by one Product query; the template and the cart API treat them like
+    the lines of a saved Cart.
+    """
+    version = 0
+
+    def __init__(self, lines=None):
+        self.lines = dict(lines or {})
+        self._items = None
+
+    @classmethod
+    def from_request(cls, request):
+        return cls(read_anonymous_cart(request))
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def get_items(self):
+        if self._items is None:
+            products = Product.objects.select_related('category').filter(pk__in=self.lines, available=True)
+            products = {product.pk: product for product in products}
+            self._items = [
+                CartItem(id=product_id, product=products[product_id], quantity=quantity)
+                for product_id, quantity in self.lines.items() if product_id in products
+            ]
+        return self._items
+
+    def get_total_price(self):
+        return sum((item.get_cost() for item in self.get_items()), Decimal('0'))
+
+    def add(self, product, quantity=1):
+        """Add units of an available product, capped at its stock; the new quantity or None"""
+        current = self.lines.get(product.pk, 0)
+        if current >= product.stock:
+            return None
+        if not current and len(self.lines) >= getattr(settings, 'ANONYMOUS_CART_MAX_LINES', 50):
+            raise CartFull
+        self.lines[product.pk] = min(current + quantity, product.stock)
+        self._items = None
+        return self.lines[product.pk]
+
+    def apply_changes(self, changes):
+        """Set several quantities at once, as apply_changes does for a saved cart"""
+        by_id = {item.pk: item for item in self.get_items()}
+        errors = {}
+        for product_id, quantity in changes.items():
+            item = by_id.get(product_id)
+            if item is None:
+                errors[product_id] = "Item not found"
+            elif quantity > item.product.stock:
+                errors[product_id] = f"Only {item.product.stock} in stock"
+        if errors:
+            raise CartConflict(errors, self, self.get_items())
+        for product_id, quantity in changes.items():
+            if quantity:
+                by_id[product_id].quantity = self.lines[product_id] = quantity
+            else:
+                del self.lines[product_id]
+        self._items = [item for item in self._items if item.pk in self.lines]
+        return self, self._items
+
+    def save(self, response):
+        """Store the lines in the response's cart cookie, or drop the cookie once empty"""
+        if not self.lines:
+            response.delete_cookie(ANONYMOUS_CART_COOKIE, samesite='Lax')
+            return
+        value = ','.join(f'{product_id}:{quantity}' for product_id, quantity in self.lines.items())
+        response.set_signed_cookie(
+            ANONYMOUS_CART_COOKIE, value, salt=_COOKIE_SALT, max_age=_cookie_age(),
+            secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+        )
+
+
+class CartSummary:
+    """Lightweight view of a user's cart: how many lines and which products"""
+
+    def __init__(self, product_ids=()):
+        self.product_ids = frozenset(product_ids)
+
+    @property
+    def count(self):
+        return len(self.product_ids)
+
+    def __contains__(self, product_id):
+        return product_id in self.product_ids
+
+    def __bool__(self):
+        return bool(self.product_ids)
+
+
+EMPTY_CART = CartSummary()
+
+
+def _cache_key(user_id):
+    return f'cart-summary:{user_id}'
+
+
+def get_cart_summary(user, request=None):
+    """Return the cached summary for a user, loading it on a miss; anonymous visitors' comes from their cookie"""
+    if not user.is_authenticated:
+        return CartSummary(read_anonymous_cart(request)) if request is not None else EMPTY_CART
+    key = _cache_key(user.pk)
+    product_ids = cache.get(key)
+    if product_ids is None:
+        product_ids = list(CartItem.objects.filter(cart__user=user).values_list('product_id', flat=True))
+        cache.set(key, product_ids, getattr(settings, 'CART_SUMMARY_TIMEOUT', 300))
+    return CartSummary(product_ids)
+
+
+def invalidate_cart_summary(user):
+    """Forget a user's cached summary after their cart changed"""
+    if user.is_authenticated:
+        cache.delete(_cache_key(user.pk))
@@ -0,0 +1,14 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cart import get_cart_summary
+
+
+def cart_summary(request):
+    """Navbar cart badge; nothing is loaded unless a template uses it"""
+    summary = getattr(request, 'cart', None)
+    if summary is None:
+        summary = SimpleLazyObject(lambda: get_cart_summary(request.user, request))
+    return {
+        'cart_summary': summary,
+        'cart_items_count': SimpleLazyObject(lambda: summary.count),
+    }
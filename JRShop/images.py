@@ -0,0 +1,143 @@
+"""
+Product image variants.
+
+Every product image is rendered at a few fixed widths, in WebP and JPEG,
+next to the original (products/.../thumbs/). Product.image_variants
+records the files, keyed on the original's name, so a replaced image is
+noticed and re-rendered:
+
+    {'source': 'products/2025/01/02/shoe.jpg',
+     'card': {'webp': [[300, 'products/.../thumbs/shoe-card-300.webp'], ...],
+              'jpeg': [[300, ...], ...]},
+     ...}
+
+Variants are rendered when a product is saved with a new image, and for
+existing media by manage.py generate_thumbnails. Until then templates fall
+back to the original.
+"""
+import io
+import logging
+import os
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from . import caching
+
+logger = logging.getLogger(__name__)
+
+# Widths rendered for each use; the larger one serves high-density screens
+VARIANTS = {
+    'card': [300, 600],  # product list cards and related product tiles
+    'detail': [600, 1200],  # the product page
+    'thumb': [80, 160],  # cart lines and the admin
+}
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 75, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 80, 'optimize': True, 'progressive': True}),
+}
+
+
+def variant_name(source, variant, width, extension):
+    directory, filename = os.path.split(source)
+    stem = os.path.splitext(filename)[0]
+    return f'{directory}/thumbs/{stem}-{variant}-{width}.{extension}'
+
+
+def variant_files(variants):
+    return {path for name, formats in variants.items() if name != 'source'
+            for sizes in formats.values() for _, path in sizes}
+
+
+def _flatten(image):
+    """RGB, with any transparency composited onto white"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render_variants(source, previous=None, storage=default_storage):
+    """
+    Render every variant of the image stored as `source` and return the
+    image_variants mapping. Files of a previous rendering that are no longer
+    used are deleted. Touches only storage, so it can run in a worker process.
+    """
+    with storage.open(source, 'rb') as original:
+        image = Image.open(original)
+        # Decode big JPEGs at reduced scale straight away
+        image.draft('RGB', (max(map(max, VARIANTS.values())),) * 2)
+        image = _flatten(ImageOps.exif_transpose(image))
+
+    variants = {'source': source}
+    for name, widths in VARIANTS.items():
+        variants[name] = {extension: [] for extension in FORMATS}
+        rendered = set()
+        for width in widths:
+            resized = image.copy()
+            resized.thumbnail((width, width), Image.Resampling.LANCZOS)
+            # Never upscale: a small original yields one variant
+            if resized.width in rendered:
+                continue
+            rendered.add(resized.width)
+            for extension, (format, options) in FORMATS.items():
+                buffer = io.BytesIO()
+                resized.save(buffer, format, **options)
+                path = variant_name(source, name, resized.width, extension)
+                if storage.exists(path):
+                    storage.delete(path)
+                path = storage.save(path, ContentFile(buffer.getvalue()))
+                variants[name][extension].append([resized.width, path])
+
+    for path in variant_files(previous or {}) - variant_files(variants):
+        storage.delete(path)
+    return variants
+
+
+def is_current(product):
+    return bool(product.image) and product.image_variants.get('source') == product.image.name
+
+
+def update_product_images(product_id, source, previous=None):
+    """Render a product's variants and record them, unless its image has changed meanwhile"""
+    from .models import Product
+
+    try:
+        variants = render_variants(source, previous)
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning(f"Could not render variants of Product {product_id} image {source}: {e}")
+        return False
+    # An UPDATE skips the save signals, so invalidate its cached card here
+    updated = Product.objects.filter(pk=product_id, image=source).update(image_variants=variants)
+    caching.bump_versions('catalog', f'product:{product_id}')
+    return bool(updated)
+
+
+def schedule_product_images(product):
+    """Render variants for a product's new image once it is committed"""
+    if not product.image or is_current(product):
+        return
+    source, previous = product.image.name, dict(product.image_variants)
+    transaction.on_commit(lambda: update_product_images(product.pk, source, previous))
+
+
+def srcset(product, variant, extension):
+    """srcset value for one variant and format, or '' until it is rendered"""
+    if not is_current(product):
+        return ''
+    sizes = product.image_variants.get(variant, {}).get(extension, [])
+    return ', '.join(f'{default_storage.url(path)} {width}w' for width, path in sizes)
+
+
+def fallback_url(product, variant):
+    """The smallest JPEG of a variant, else the original"""
+    if is_current(product):
+        sizes = product.image_variants.get(variant, {}).get('jpeg')
+        if sizes:
+            return default_storage.url(sizes[0][1])
+    return product.image.url
@@ -0,0 +1,168 @@
+"""
+Per-request instrumentation: SQL query count and time, repeated queries
+(N+1 fingerprints), template rendering time and SSL Commerz gateway time.
+
+InstrumentationMiddleware (middleware.py) starts a RequestMetrics for a
+sampled share of requests (INSTRUMENTATION_SAMPLE_RATE) and keeps it in a
+context variable, so the database execute wrapper, the template backend
+and the gateway clients add to it wherever they run, including the
+threads and event loop of async views. Outside a sampled request each
+hook costs one context variable lookup.
+
+Totals go out in a Server-Timing header, and requests slower than
+SLOW_REQUEST_THRESHOLD_MS are logged as one JSON line to the
+JRShop.slow_requests logger (logs/slow_requests.log). Queries run while
+a streaming response is consumed fall after the measurement.
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends import django as django_backend
+from django.utils import timezone
+
+slow_logger = logging.getLogger('JRShop.slow_requests')
+
+_current = ContextVar('request_metrics', default=None)
+
+# "IN (%s, %s, ...)" of any length is one fingerprint
+IN_LIST = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+
+
+def fingerprint(sql):
+    return IN_LIST.sub('(...)', sql)
+
+
+class RequestMetrics:
+    """What one request spent its time on"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.fingerprints = Counter()
+        self.timings = defaultdict(float)
+
+    def add_query(self, sql, duration):
+        self.queries += 1
+        self.db_time += duration
+        self.fingerprints[sql] += 1
+
+    def repeated_queries(self, threshold=None):
+        """(fingerprint, count) of the queries run at least threshold times, most repeated first"""
+        threshold = threshold or getattr(settings, 'N_PLUS_ONE_THRESHOLD', 5)
+        counts = Counter()
+        for sql, count in self.fingerprints.items():
+            counts[fingerprint(sql)] += count
+        return [(sql, count) for sql, count in counts.most_common() if count >= threshold]
+
+    def server_timing(self, total):
+        """The Server-Timing header value; durations in milliseconds"""
+        repeated = len(self.repeated_queries())
+        entries = [f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries, {repeated} repeated"']
+        entries += [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.timings.items()]
+        entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+def current():
+    """The metrics of the request being measured, or None"""
+    return _current.get()
+
+
+def start():
+    """Measure the current request; returns a token for stop()"""
+    return _current.set(RequestMetrics())
+
+
+def stop(token):
+    _current.reset(token)
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the current request's `name` timing"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[name] += time.perf_counter() - started
+
+
+def _record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - started)
+
+
+def _install_query_recorder(connection, **kwargs):
+    # Ahead of any wrapper pushed by connection.execute_wrapper(), which pops its own on exit
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+def install():
+    """Record the queries of every database connection, this thread's open ones and all opened later"""
+    connection_created.connect(_install_query_recorder, dispatch_uid='JRShop.instrumentation')
+    for connection in connections.all(initialized_only=True):
+        _install_query_recorder(connection)
+
+
+def log_slow_request(request, response, total, metrics):
+    match = getattr(request, 'resolver_match', None)
+    record = {
+        'time': timezone.now().isoformat(timespec='milliseconds'),
+        'method': request.method,
+        'path': request.path,
+        'view': match.view_name if match else None,
+        'status': response.status_code,
+        'user': request.user.pk if getattr(request, 'user', None) and request.user.is_authenticated else None,
+        'total_ms': round(total * 1000, 1),
+    }
+    if metrics is not None:
+        record.update({
+            'queries': metrics.queries,
+            'db_ms': round(metrics.db_time * 1000, 1),
+            **{f'{name}_ms': round(seconds * 1000, 1) for name, seconds in metrics.timings.items()},
+            'repeated_queries': [{'sql': sql[:300], 'count': count} for sql, count in metrics.repeated_queries()[:5]],
+        })
+    slow_logger.warning(json.dumps(record))
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing each top-level render as 'template'"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class TimedTemplate:
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        # Includes and queries run by lazy querysets count towards this too
+        with timed('template'):
+            return self.template.render(context, request)
@@ -0,0 +1,176 @@
+"""
+A small database-backed job queue.
+
+Jobs are rows in the Job table, so enqueueing inside a transaction is
+atomic with the work that caused it and no broker is needed. Workers
+(manage.py run_jobs) claim ready jobs by pushing their run_at forward by
+the visibility timeout; a job whose worker dies becomes ready again once
+that passes. Finished jobs are deleted, failed attempts are retried with
+exponential backoff until max_attempts, after which the job is kept as
+'failed' for inspection in the admin and its key is released, so the same
+work can be queued again (e.g. by the gateway resending an IPN).
+
+Handlers are registered with @task. A batch task receives the payloads
+of every job of its kind claimed together, e.g. to send many emails over
+one SMTP connection. It may return {index: exception} for the payloads
+that failed; only their jobs are retried and the rest are finished.
+"""
+import logging
+import random
+import traceback
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+_tasks = {}
+
+
+class Task:
+
+    def __init__(self, func, name, batch=False):
+        self.func = func
+        self.name = name
+        self.batch = batch
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def enqueue(self, payload=None, **options):
+        return enqueue(self.name, payload, **options)
+
+
+def task(name=None, batch=False):
+    """Register a job handler; batch handlers get a list of payloads"""
+    def register(func):
+        handler = Task(func, name or func.__name__, batch)
+        _tasks[handler.name] = handler
+        return handler
+    return register
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _new_job(name, payload, key, delay, max_attempts):
+    return Job(
+        name=name,
+        payload=payload or {},
+        key=key,
+        run_at=timezone.now() + timedelta(seconds=delay),
+        max_attempts=max_attempts or _setting('JOB_MAX_ATTEMPTS', 8),
+    )
+
+
+def enqueue(name, payload=None, key=None, delay=0, max_attempts=None):
+    """Queue a job; with a key, nothing is queued while a job with that key exists"""
+    job = _new_job(name, payload, key, delay, max_attempts)
+    Job.objects.bulk_create([job], ignore_conflicts=key is not None)
+    return job
+
+
+async def aenqueue(name, payload=None, key=None, delay=0, max_attempts=None):
+    job = _new_job(name, payload, key, delay, max_attempts)
+    await Job.objects.abulk_create([job], ignore_conflicts=key is not None)
+    return job
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, in seconds"""
+    base = _setting('JOB_RETRY_BASE_DELAY', 10)
+    delay = min(_setting('JOB_RETRY_MAX_DELAY', 3600), base * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def claim(worker, limit=10, visibility_timeout=None):
+    """
+    Claim up to `limit` ready jobs for a worker.
+
+    The UPDATE repeats the readiness condition, so two workers racing for
+    the same rows (SQLite has no SKIP LOCKED) cannot both win them.
+    """
+    now = timezone.now()
+    timeout = visibility_timeout or _setting('JOB_VISIBILITY_TIMEOUT', 300)
+    token = f'{worker}:{uuid.uuid4().hex[:8]}'
+    ready = Job.objects.filter(status__in=('queued', 'running'), run_at__lte=now)
+    with transaction.atomic():
+        ids = list(
+            ready.order_by('run_at').select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        ready.filter(pk__in=ids).update(
+            status='running', locked_by=token, run_at=now + timedelta(seconds=timeout), attempts=F('attempts') + 1,
+        )
+    return list(Job.objects.filter(locked_by=token).order_by('pk'))
+
+
+def _complete(jobs):
+    # Matching on locked_by ignores jobs another worker reclaimed meanwhile
+    Job.objects.filter(pk__in=[job.pk for job in jobs], locked_by=jobs[0].locked_by).delete()
+
+
+def _fail(job, error):
+    last_error = ''.join(traceback.format_exception(error))[-4000:]
+    if job.attempts >= job.max_attempts:
+        changes = {'status': 'failed', 'key': None}
+        logger.error(f"Job {job} failed permanently after {job.attempts} attempt(s): {error}")
+    else:
+        delay = retry_delay(job.attempts)
+        changes = {'status': 'queued', 'run_at': timezone.now() + timedelta(seconds=delay)}
+        logger.warning(f"Job {job} attempt {job.attempts} failed, retrying in {delay:.0f}s: {error}")
+    Job.objects.filter(pk=job.pk, locked_by=job.locked_by).update(last_error=last_error, **changes)
+
+
+def run(jobs):
+    """Run claimed jobs, grouping batch tasks; returns how many succeeded"""
+    groups = defaultdict(list)
+    for job in jobs:
+        groups[job.name].append(job)
+
+    done = 0
+    for name, group in groups.items():
+        handler = _tasks.get(name)
+        if handler is None:
+            for job in group:
+                job.attempts = job.max_attempts
+                _fail(job, LookupError(f"No task registered as '{name}'"))
+            continue
+        if handler.batch:
+            try:
+                failed = handler([job.payload for job in group]) or {}
+            except Exception as e:
+                failed = dict.fromkeys(range(len(group)), e)
+            for index, error in failed.items():
+                _fail(group[index], error)
+            succeeded = [job for index, job in enumerate(group) if index not in failed]
+            if succeeded:
+                _complete(succeeded)
+                done += len(succeeded)
+            continue
+        for job in group:
+            try:
+                handler(**job.payload)
+            except Exception as e:
+                _fail(job, e)
+            else:
+                _complete([job])
+                done += 1
+    return done
+
+
+def run_pending(worker='inline', limit=100):
+    """Run jobs until none are ready (tests, run_jobs --once)"""
+    done = 0
+    while jobs := claim(worker, limit):
+        done += run(jobs)
+    return done
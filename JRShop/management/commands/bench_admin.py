@@ -0,0 +1,138 @@
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from types import MethodType
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from JRShop.management.commands.bench_indexes import chunks
+from JRShop.models import Category, Order, OrderItem, Product
+
+PRODUCTS = 1000
+USERS = 10_000
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch test database with a large order history and time the admin changelists of orders "
+        "and order lines, as configured and with Django's defaults (exact counts, no select_related, "
+        "per-row totals)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1_000_000)
+        parser.add_argument('--lines', type=int, default=2, help="Lines per order")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed requests per page and setup")
+
+    def handle(self, *args, **options):
+        self.options = options
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.seed()
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            client = Client()
+            client.force_login(User.objects.create_superuser('bench-admin', 'admin@example.com', '!'))
+            pages = [
+                ('orders', reverse('admin:JRShop_order_changelist')),
+                ('orders, filtered', reverse('admin:JRShop_order_changelist') + '?status__exact=pending'),
+                ('order lines', reverse('admin:JRShop_orderitem_changelist')),
+            ]
+            self.stdout.write(f"\n{'':28}{'queries':>10}{'p50 ms':>10}{'p99 ms':>10}")
+            for label, url in pages:
+                self.report(label, client, url)
+            with self.django_defaults():
+                for label, url in pages:
+                    self.report(f'{label} (defaults)', client, url)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def insert(self, model, fields, rows):
+        qn = connection.ops.quote_name
+        columns = ', '.join(qn(model._meta.get_field(name).column) for name in fields)
+        placeholders = ', '.join(['%s'] * len(fields))
+        sql = f'INSERT INTO {qn(model._meta.db_table)} ({columns}) VALUES ({placeholders})'
+        with transaction.atomic(), connection.cursor() as cursor:
+            for chunk in chunks(rows, 10_000):
+                cursor.executemany(sql, chunk)
+
+    def seed(self):
+        rnd = random.Random(42)
+        orders, lines = self.options['orders'], self.options['lines']
+        start = timezone.now() - timedelta(days=365)
+
+        def stamp(seconds):
+            return connection.ops.adapt_datetimefield_value(start + timedelta(seconds=seconds))
+
+        self.stdout.write(f"Seeding {orders:,} orders with {lines} line(s) each")
+        started = time.perf_counter()
+
+        category = Category.objects.create(name='Seeded', slug='seeded', description='Seeded')
+        self.insert(Product, ['name', 'slug', 'category', 'description', 'price', 'stock', 'available',
+                              'created_at', 'updated_at', 'image', 'image_variants', 'rating_count', 'rating_sum', 'rating_avg'], (
+            (f'Product {i}', f'product-{i}', category.pk, 'Seeded product', Decimal(rnd.randint(100, 100_000)) / 100,
+             100, True, stamp(i), stamp(i), 'products/seed.png', '{}', 0, 0, Decimal('0'))
+            for i in range(PRODUCTS)
+        ))
+        self.insert(User, ['username', 'password', 'is_superuser', 'first_name', 'last_name', 'email',
+                           'is_staff', 'is_active', 'date_joined'], (
+            (f'user{i}', '!', False, '', '', f'user{i}@example.com', False, True, stamp(i)) for i in range(USERS)
+        ))
+        product_ids = list(Product.objects.values_list('pk', flat=True))
+        user_ids = list(User.objects.values_list('pk', flat=True))
+
+        seconds = 365 * 24 * 3600
+        self.insert(Order, ['user', 'first_name', 'last_name', 'email', 'phone', 'address', 'postal_code', 'city',
+                            'transaction_id', 'paid', 'stock_reserved', 'created_at', 'updated_at', 'status'], (
+            (rnd.choice(user_ids), 'Seed', 'Buyer', 'buyer@example.com', '01700000000', 'Road 1', '1200',
+             'Dhaka', f'{i}-seed', paid, True, stamp(at), stamp(at), 'processing' if paid else 'pending')
+            for i in range(orders)
+            for at in [i * seconds // orders]
+            for paid in [rnd.random() < 0.9]
+        ))
+        first_order = Order.objects.order_by('pk').values_list('pk', flat=True).first()
+        self.insert(OrderItem, ['order', 'product', 'quantity', 'price'], (
+            (first_order + i, rnd.choice(product_ids), rnd.randint(1, 3), Decimal(rnd.randint(100, 100_000)) / 100)
+            for i in range(orders) for _ in range(lines)
+        ))
+        self.stdout.write(f"Seeded in {time.perf_counter() - started:.1f} s")
+
+    @contextmanager
+    def django_defaults(self):
+        """Temporarily undo the changelist optimizations of the registered admins"""
+        admins = [admin.site._registry[model] for model in (Order, OrderItem)]
+        for model_admin in admins:
+            model_admin.paginator = Paginator
+            model_admin.show_full_result_count = True
+            model_admin.list_select_related = False
+            model_admin.get_queryset = MethodType(admin.ModelAdmin.get_queryset, model_admin)
+        try:
+            yield
+        finally:
+            for model_admin in admins:
+                for name in ('paginator', 'show_full_result_count', 'list_select_related', 'get_queryset'):
+                    del model_admin.__dict__[name]
+
+    def report(self, label, client, url):
+        timings = []
+        for _ in range(self.options['repeat']):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = client.get(url)
+                timings.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.status_code
+        percentiles = statistics.quantiles(timings, n=100, method='inclusive')
+        self.stdout.write(f"{label:28}{len(queries):>10}{percentiles[49]:>10.1f}{percentiles[98]:>10.1f}")
@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from JRShop.models import Category, Product
+
+CHECKOUT_FORM = {
+    'first_name': 'Bench', 'last_name': 'Buyer', 'email': 'bench@example.com', 'phone': '01700000000',
+    'address': 'Road 1', 'city': 'Dhaka', 'postal_code': '1200',
+}
+
+# SQLite's own defaults, to compare against the tuned init_command
+SQLITE_UNTUNED = 'PRAGMA journal_mode=DELETE; PRAGMA synchronous=FULL;'
+
+
+def shop(args):
+    """One worker process: add to cart and check out as its own user until the deadline"""
+    user_id, product_ids, deadline, seed = args
+    logging.disable(logging.INFO)
+    rnd = random.Random(seed)
+    client = Client()
+    client.force_login(User.objects.get(pk=user_id))
+    stats = {'add': [], 'checkout': [], 'errors': 0, 'locked': 0}
+
+    def timed(kind, *request):
+        started = time.perf_counter()
+        try:
+            client.post(*request)
+        except DatabaseError as e:
+            stats['errors'] += 1
+            stats['locked'] += 'locked' in str(e)
+            return
+        stats[kind].append(time.perf_counter() - started)
+
+    while time.monotonic() < deadline:
+        for product_id in rnd.sample(product_ids, 2):
+            timed('add', reverse('add_to_cart', args=[product_id]))
+        timed('checkout', reverse('checkout'), CHECKOUT_FORM)
+    connections.close_all()
+    return stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure concurrent add-to-cart and checkout throughput against a scratch copy of the configured "
+        "database; run once per profile (DB_ENGINE=...) to compare them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent shopper processes")
+        parser.add_argument('--duration', type=float, default=20, help="Seconds to run")
+        parser.add_argument('--products', type=int, default=20,
+                            help="Products shoppers pick from; fewer means more contention on stock rows")
+        parser.add_argument('--untuned', action='store_true',
+                            help="SQLite only: use the rollback journal and full syncs instead of WAL")
+
+    def handle(self, *args, **options):
+        if options['untuned']:
+            if connection.vendor != 'sqlite':
+                raise CommandError("--untuned only applies to SQLite")
+            connection.settings_dict['OPTIONS']['init_command'] = SQLITE_UNTUNED
+
+        # Lets the test client through ALLOWED_HOSTS and keeps emails in memory
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write(f"Profile: {self.describe()}")
+            category = Category.objects.create(name='Bench', slug='bench')
+            products = Product.objects.bulk_create(
+                Product(name=f'Bench {i}', slug=f'bench-{i}', category=category, price=100, stock=10 ** 9,
+                        image='products/bench.png')
+                for i in range(options['products'])
+            )
+            users = User.objects.bulk_create(User(username=f'shopper{i}') for i in range(options['workers']))
+            product_ids = [product.pk for product in products]
+
+            # Workers are forked and must not share the parent's connections
+            connections.close_all()
+            if hasattr(connection, 'close_pool'):
+                connection.close_pool()
+            deadline = time.monotonic() + options['duration']
+            work = [(user.pk, product_ids, deadline, seed) for seed, user in enumerate(users)]
+            with multiprocessing.get_context('fork').Pool(options['workers']) as pool:
+                results = pool.map(shop, work)
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.report(results, options['duration'])
+
+    def describe(self):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                pragmas = {name: cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                           for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size')}
+            return 'sqlite ' + ' '.join(f'{name}={value}' for name, value in pragmas.items())
+        settings = connection.settings_dict
+        pool = settings['OPTIONS'].get('pool')
+        return f"{connection.vendor} CONN_MAX_AGE={settings['CONN_MAX_AGE']} pool={pool or 'off'}"
+
+    def report(self, results, duration):
+        for kind in ('add', 'checkout'):
+            timings = [t * 1000 for result in results for t in result[kind]]
+            if len(timings) < 2:
+                self.stdout.write(f"{kind:>9}: {len(timings)} completed")
+                continue
+            percentiles = statistics.quantiles(timings, n=100, method='inclusive')
+            self.stdout.write(
+                f"{kind:>9}: {len(timings) / duration:8.1f} req/s   "
+                f"p50 {percentiles[49]:7.1f} ms   p99 {percentiles[98]:7.1f} ms"
+            )
+        errors = sum(result['errors'] for result in results)
+        locked = sum(result['locked'] for result in results)
+        self.stdout.write(f"   errors: {errors} ({locked} 'database is locked')")
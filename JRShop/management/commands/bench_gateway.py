@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from JRShop.management.commands.bench_database import CHECKOUT_FORM
+from JRShop.models import Order
+from JRShop.sslcommerz import avalidate_sslcommerz_payment, validate_sslcommerz_payment
+
+
+RESPONSE_BODY = json.dumps({'status': 'VALID', 'amount': '100.00'}).encode()
+RESPONSE = (
+    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+    b'Content-Length: ' + str(len(RESPONSE_BODY)).encode() + b'\r\n\r\n' + RESPONSE_BODY
+)
+
+
+def serve_stub_gateway(latency, ready):
+    """
+    Keep-alive HTTP server answering every request with VALID after
+    `latency` seconds. Runs in its own process on asyncio, so the stub
+    itself never limits concurrency or competes with the caller for the GIL.
+    """
+    async def handle(reader, writer):
+        try:
+            while await reader.readuntil(b'\r\n\r\n'):
+                await asyncio.sleep(latency)
+                writer.write(RESPONSE)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=4096)
+        ready.put(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare payment validation throughput of sync (WSGI thread pool) and async (ASGI event loop) "
+        "callers against a local stub gateway with injected latency: the gateway client on its own, then "
+        "the sslcommerz_success view through the whole middleware chain"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help="Validations per run")
+        parser.add_argument('--latency', type=float, default=0.2, help="Gateway latency in seconds")
+        parser.add_argument('--threads', type=int, default=16,
+                            help="Sync workers, e.g. gunicorn workers x threads")
+        parser.add_argument('--concurrency', type=int, default=256,
+                            help="Validations in flight on the event loop")
+
+    def run_sync(self, total, threads):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(validate_sslcommerz_payment, (f'val-{i}' for i in range(total))))
+
+    def run_async(self, total, concurrency):
+        async def main():
+            limit = asyncio.Semaphore(concurrency)
+
+            async def validate(val_id):
+                async with limit:
+                    return await avalidate_sslcommerz_payment(val_id)
+
+            await asyncio.gather(*(validate(f'val-{i}') for i in range(total)))
+
+        asyncio.run(main())
+
+    def success_callbacks(self, order, total):
+        url = reverse('sslcommerz_success', args=[order.pk])
+        # Every callback carries a new val_id, so each is validated with the gateway. The stub's
+        # amount does not match the order, so none marks it paid and ends the run early.
+        return ((url, {'tran_id': order.transaction_id, 'val_id': f'view-{i}'}) for i in range(total))
+
+    def run_wsgi_view(self, order, total, threads):
+        def callback(request):
+            # Client() goes through WSGIHandler, so the async view runs via async_to_sync in each thread
+            return Client().post(*request)
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(callback, self.success_callbacks(order, total)))
+
+    def run_asgi_view(self, order, total, concurrency):
+        async def main():
+            client = AsyncClient()
+            limit = asyncio.Semaphore(concurrency)
+
+            async def callback(request):
+                async with limit:
+                    return await client.post(*request)
+
+            await asyncio.gather(*(callback(request) for request in self.success_callbacks(order, total)))
+
+        asyncio.run(main())
+
+    def handle(self, *args, **options):
+        total = options['requests']
+        ready = multiprocessing.Queue()
+        gateway = multiprocessing.Process(target=serve_stub_gateway, args=(options['latency'], ready), daemon=True)
+        gateway.start()
+        url = f'http://127.0.0.1:{ready.get(timeout=10)}/validator'
+
+        self.stdout.write(
+            f"{total} validations, {options['latency'] * 1000:.0f} ms gateway latency\n"
+        )
+        logging.disable(logging.ERROR)
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user = User.objects.create_user('bench-payer', 'bench-payer@example.com', 'bench-pass-123')
+            order = Order.objects.create(user=user, transaction_id='bench-tx', **CHECKOUT_FORM)
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=url, SSLCOMMERZ_POOL_SIZE=options['threads'],
+                                   SSLCOMMERZ_ASYNC_MAX_CONNECTIONS=options['concurrency']):
+                threads, concurrency = options['threads'], options['concurrency']
+                runs = [
+                    (f"client sync, {threads} threads", lambda: self.run_sync(total, threads)),
+                    (f"client async, {concurrency} in flight", lambda: self.run_async(total, concurrency)),
+                    (f"view WSGI, {threads} threads", lambda: self.run_wsgi_view(order, total, threads)),
+                    (f"view ASGI, {concurrency} in flight", lambda: self.run_asgi_view(order, total, concurrency)),
+                ]
+                for label, run in runs:
+                    started = time.perf_counter()
+                    run()
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(f"{label:<32} {elapsed:8.2f} s {total / elapsed:10.1f} req/s")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            logging.disable(logging.NOTSET)
+            gateway.terminate()
+            gateway.join()
@@ -0,0 +1,191 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from JRShop.models import Cart, CartItem, Category, Order, Product
+
+# Measured without, then with, the duplicate cleanup and hot-path indexes (0011, 0012) and what follows them
+BEFORE_HOT_PATH_INDEXES = ('JRShop', '0010_job_queue')
+
+CATEGORIES = 100
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a scratch test database with a large catalog and order history, then report EXPLAIN "
+        "plans and p50/p99 timings of the hot-path queries without and with the hot-path indexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1_000_000)
+        parser.add_argument('--orders', type=int, default=5_000_000)
+        parser.add_argument('--users', type=int, default=100_000)
+        parser.add_argument('--repeat', type=int, default=50, help="Timed runs per query and phase")
+        parser.add_argument('--database', default='default',
+                            help="Alias whose test database is created, seeded and destroyed")
+
+    def handle(self, *args, **options):
+        self.alias = options['database']
+        self.connection = connections[self.alias]
+        self.random = random.Random(42)
+        self.options = options
+
+        old_name = self.connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write(f"Scratch database: {self.connection.settings_dict['NAME']}")
+            self.migrate([BEFORE_HOT_PATH_INDEXES])
+            self.seed()
+            self.report('before')
+            self.stdout.write(f"\nMigrating forward took {self.migrate(None):.1f} s")
+            self.report('after')
+        finally:
+            self.connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    # Schema
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(self.connection)
+        started = time.perf_counter()
+        executor.migrate(targets or executor.loader.graph.leaf_nodes())
+        with self.connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        return time.perf_counter() - started
+
+    # Data
+
+    def insert(self, model, fields, rows):
+        qn = self.connection.ops.quote_name
+        columns = ', '.join(qn(model._meta.get_field(name).column) for name in fields)
+        placeholders = ', '.join(['%s'] * len(fields))
+        sql = f'INSERT INTO {qn(model._meta.db_table)} ({columns}) VALUES ({placeholders})'
+        started = time.perf_counter()
+        with transaction.atomic(using=self.alias), self.connection.cursor() as cursor:
+            for chunk in chunks(rows, 10_000):
+                cursor.executemany(sql, chunk)
+        self.stdout.write(f"  {model.__name__:<10} {time.perf_counter() - started:8.1f} s")
+
+    def seed(self):
+        rnd = self.random
+        ops = self.connection.ops
+        start = timezone.now() - timedelta(days=365)
+
+        def stamp(seconds):
+            return ops.adapt_datetimefield_value(start + timedelta(seconds=seconds))
+
+        products, orders, users = self.options['products'], self.options['orders'], self.options['users']
+        self.stdout.write(f"Seeding {products:,} products, {orders:,} orders, {users:,} users")
+
+        self.insert(Category, ['name', 'slug', 'description'], (
+            (f'Category {i}', f'category-{i}', 'Seeded') for i in range(CATEGORIES)
+        ))
+        self.insert(User, ['username', 'password', 'is_superuser', 'first_name', 'last_name', 'email',
+                           'is_staff', 'is_active', 'date_joined'], (
+            (f'user{i}', '!', False, '', '', f'user{i}@example.com', False, True, stamp(i)) for i in range(users)
+        ))
+        self.category_ids = list(Category.objects.using(self.alias).values_list('pk', flat=True))
+        self.user_ids = list(User.objects.using(self.alias).values_list('pk', flat=True))
+
+        self.insert(Product, ['name', 'slug', 'category', 'description', 'price', 'stock', 'available',
+                              'created_at', 'updated_at', 'image', 'rating_count', 'rating_sum', 'rating_avg'], (
+            (f'Product {i}', f'product-{i}', rnd.choice(self.category_ids), 'Seeded product',
+             Decimal(rnd.randint(100, 1_000_000)) / 100, rnd.randint(0, 500), rnd.random() < 0.9,
+             stamp(i * 30), stamp(i * 30), 'products/seed.png', 0, 0, Decimal('0'))
+            for i in range(products)
+        ))
+        self.product_ids = list(Product.objects.using(self.alias).values_list('pk', flat=True))
+
+        seconds = 365 * 24 * 3600
+        self.insert(Order, ['user', 'first_name', 'last_name', 'email', 'phone', 'address', 'postal_code', 'city',
+                            'transaction_id', 'paid', 'stock_reserved', 'reservation_expires_at', 'created_at',
+                            'updated_at', 'status'], (
+            (rnd.choice(self.user_ids), 'Seed', 'Buyer', 'buyer@example.com', '01700000000', 'Road 1', '1200',
+             'Dhaka', f'{i}-seed', paid, True, stamp(at + 1800), stamp(at), stamp(at),
+             'processing' if paid else 'pending')
+            for i in range(orders)
+            for at in [i * seconds // orders]
+            for paid in [rnd.random() < 0.9]
+        ))
+
+        carts = self.user_ids[::10]
+        self.insert(Cart, ['user', 'created_at', 'updated_at'], ((pk, stamp(0), stamp(0)) for pk in carts))
+        self.cart_ids = list(Cart.objects.using(self.alias).values_list('pk', flat=True))
+        self.insert(CartItem, ['cart', 'product', 'quantity'], (
+            (cart, product, 1) for cart in self.cart_ids for product in rnd.sample(self.product_ids, 3)
+        ))
+        self.order_count = orders
+
+    # Queries
+
+    def queries(self):
+        rnd, db = self.random, self.alias
+        # image_variants is only added by migration 0013, after the 'before' schema
+        products = Product.objects.using(db).defer('image_variants')
+        orders = Order.objects.using(db)
+        now = timezone.now()
+
+        def category_page():
+            return products.filter(available=True, category_id=rnd.choice(self.category_ids)).order_by(
+                '-created_at', '-id')[:13]
+
+        def price_filter():
+            low = rnd.randint(100, 9000)
+            return products.filter(
+                available=True, category_id=rnd.choice(self.category_ids), price__gte=low, price__lte=low + 500,
+            ).order_by('-created_at', '-id')[:13]
+
+        def price_range():
+            return products.filter(available=True, category_id=rnd.choice(self.category_ids)).values(
+                'category_id').annotate(low=Min('price'), high=Max('price'))
+
+        def ipn_lookup():
+            return orders.filter(transaction_id=f'{rnd.randrange(self.order_count)}-seed')
+
+        def profile_orders():
+            return orders.filter(user_id=rnd.choice(self.user_ids)).order_by('-created_at')[:20]
+
+        def expired_reservations():
+            return orders.filter(paid=False, stock_reserved=True, reservation_expires_at__lt=now).order_by(
+                'reservation_expires_at')[:100]
+
+        def cart_line():
+            return CartItem.objects.using(db).filter(
+                cart_id=rnd.choice(self.cart_ids), product_id=rnd.choice(self.product_ids))
+
+        return [
+            ('category page', category_page),
+            ('price filter', price_filter),
+            ('price range', price_range),
+            ('IPN order lookup', ipn_lookup),
+            ('profile orders', profile_orders),
+            ('expired reservations', expired_reservations),
+            ('cart line lookup', cart_line),
+        ]
+
+    def report(self, phase):
+        self.stdout.write(f"\n=== {phase} hot-path indexes ===")
+        for label, make in self.queries():
+            self.stdout.write(f"\n-- {label}\n{make().explain()}")
+            timings = []
+            for _ in range(self.options['repeat']):
+                queryset = make()
+                started = time.perf_counter()
+                list(queryset)
+                timings.append((time.perf_counter() - started) * 1000)
+            percentiles = statistics.quantiles(timings, n=100, method='inclusive')
+            self.stdout.write(f"p50 {percentiles[49]:9.3f} ms   p99 {percentiles[98]:9.3f} ms")
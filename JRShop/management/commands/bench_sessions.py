@@ -0,0 +1,112 @@
+import logging
+from contextlib import contextmanager
+from itertools import cycle
+
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from JRShop.management.commands.bench_database import CHECKOUT_FORM
+from JRShop.models import Category, Order, Product
+
+ENGINES = [
+    ('database (before)', 'django.contrib.sessions.backends.db'),
+    ('JRShop.sessions', 'JRShop.sessions'),
+    ('JRShop.cached_sessions', 'JRShop.cached_sessions'),
+]
+PASSWORD = 'bench-pass-123'
+
+
+class Command(BaseCommand):
+    help = (
+        "Count django_session reads and writes per 1,000 page views of logged-in shoppers, with Django's "
+        "database session engine and with JRShop.sessions and JRShop.cached_sessions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--views', type=int, default=1000, help="Page views per session engine")
+        parser.add_argument('--shoppers', type=int, default=20, help="Shoppers taking turns, each logged in once")
+
+    def handle(self, *args, **options):
+        logging.disable(logging.WARNING)
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            shoppers = self.seed(options['shoppers'])
+            results = [(label, *self.run(engine, shoppers, options['views'])) for label, engine in ENGINES]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            logging.disable(logging.NOTSET)
+
+        self.stdout.write(f"{options['views']} page views by {options['shoppers']} logged-in shoppers\n")
+        self.stdout.write(f"{'per 1k page views':26}{'reads':>10}{'writes':>10}")
+        for label, views, reads, writes in results:
+            self.stdout.write(f"{label:26}{reads * 1000 / views:>10.0f}{writes * 1000 / views:>10.0f}")
+
+    def seed(self, count):
+        category = Category.objects.create(name='Bench', slug='bench', description='Bench')
+        self.products = [
+            Product.objects.create(name=f'Bench {i}', slug=f'bench-{i}', category=category, description='Bench',
+                                   price=100, stock=10 ** 6, image='products/bench.png')
+            for i in range(10)
+        ]
+        shoppers = []
+        for i in range(count):
+            user = User.objects.create_user(f'shopper{i}', f'shopper{i}@example.com', PASSWORD)
+            # An unpaid order to retry paying for, as a shopper whose payment failed would
+            order = Order.objects.create(user=user, **CHECKOUT_FORM)
+            shoppers.append((user, order))
+        return shoppers
+
+    def pages(self, order, round):
+        product = self.products[round % len(self.products)]
+        return [
+            ('get', reverse('home')),
+            ('get', reverse('product_list')),
+            ('get', reverse('product_detail', args=[product.slug])),
+            ('post', reverse('add_to_cart', args=[product.pk])),
+            ('get', reverse('view_cart')),
+            ('get', reverse('checkout')),
+            ('get', reverse('profile')),
+            # Every retry stores the same order_id in the session again
+            ('get', reverse('payment_retry', args=[order.pk])),
+        ]
+
+    @contextmanager
+    def count_session_queries(self, counts):
+        table = Session._meta.db_table
+
+        def count(execute, sql, params, many, context):
+            if table in sql:
+                counts['reads' if sql.lstrip().upper().startswith('SELECT') else 'writes'] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            yield
+
+    def run(self, engine, shoppers, total):
+        """Page views made, and session table reads and writes, browsing with one session engine"""
+        counts = {'reads': 0, 'writes': 0}
+        views = 0
+        cache.clear()
+        Session.objects.all().delete()
+        with override_settings(SESSION_ENGINE=engine), self.count_session_queries(counts):
+            visitors = []
+            for user, order in shoppers:
+                client = Client()
+                client.post(reverse('login'), {'email': user.email, 'password': PASSWORD})
+                visitors.append((client, order))
+                views += 1
+            for round, (client, order) in enumerate(cycle(visitors)):
+                for method, url in self.pages(order, round):
+                    if views >= total:
+                        return views, counts['reads'], counts['writes']
+                    getattr(client, method)(url)
+                    views += 1
+        return views, counts['reads'], counts['writes']
@@ -0,0 +1,63 @@
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from JRShop.staticfiles import IMMUTABLE, index_static_files
+
+ASSET = re.compile(r'<(?:link[^>]+href|script[^>]+src)="([^"]+)"')
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the bytes and repeat-visit requests of the CSS/JS pages load, served plainly (runserver, "
+        "django.contrib.staticfiles) versus collected, compressed and immutable (run collectstatic first)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='*', default=['/', '/login/', '/register/', '/products/'],
+                            help="Pages to visit, in order, as one visitor")
+
+    def handle(self, *args, **options):
+        if not index_static_files():
+            raise CommandError(f"Nothing collected in {settings.STATIC_ROOT}; run manage.py collectstatic first")
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            client = Client(headers={'Accept-Encoding': 'gzip, deflate, br'})
+            assets = []
+            # Hashed names are only used with DEBUG off, as in production
+            with override_settings(DEBUG=False):
+                for url in options['urls']:
+                    page = client.get(url).content.decode()
+                    assets += [asset for asset in ASSET.findall(page)
+                               if asset.startswith(settings.STATIC_URL) and asset not in assets]
+                before = [self.plain(asset) for asset in assets]
+                after = [self.collected(client, asset) for asset in assets]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"{len(assets)} assets on {', '.join(options['urls'])}\n")
+        self.stdout.write(f"{'':24}{'before':>12}{'after':>12}")
+        self.stdout.write(f"{'first visit bytes':24}{sum(b for b, _ in before):>12,}{sum(b for b, _ in after):>12,}")
+        self.stdout.write(f"{'repeat-visit requests':24}{sum(r for _, r in before):>12}{sum(r for _, r in after):>12}")
+
+    def plain(self, asset):
+        """Bytes and repeat requests of the original file with no compression or Cache-Control"""
+        hashed = asset[len(settings.STATIC_URL):]
+        name = next((name for name, stored in staticfiles_storage.hashed_files.items() if stored == hashed), hashed)
+        # Browsers revalidate files without freshness information on every visit
+        return os.path.getsize(finders.find(name)), 1
+
+    def collected(self, client, asset):
+        response = client.get(asset)
+        size = sum(len(chunk) for chunk in response.streaming_content)
+        return size, 0 if response['Cache-Control'] == IMMUTABLE else 1
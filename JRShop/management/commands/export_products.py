@@ -0,0 +1,85 @@
+import csv
+import json
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from JRShop.models import Product
+
+# Columns of an export, and of an import file; category is the category slug
+FIELDS = ['slug', 'name', 'category', 'description', 'price', 'discount_price', 'stock', 'available', 'image']
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+def file_format(path, format=None):
+    """The explicit format, else the one the file extension names"""
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise CommandError(f"Cannot tell the format of {path!r}; pass --format csv or --format jsonl")
+    return FORMATS[extension]
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+class Command(BaseCommand):
+    help = "Stream every product to a CSV or JSON Lines file (or stdout), in constant memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="File to write, or - for stdout")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help="Output format; by default taken from the file extension")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Products fetched per database round trip")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        format = file_format(output, options['format'] or ('csv' if output == '-' else None))
+
+        columns = [name if name != 'category' else 'category__slug' for name in FIELDS]
+        rows = Product.objects.order_by('pk').values_list(*columns).iterator(chunk_size=options['chunk_size'])
+
+        started = time.monotonic()
+        stream = sys.stdout if output == '-' else open(output, 'w', newline='', encoding='utf-8')
+        try:
+            if format == 'csv':
+                exported = self.write_csv(stream, rows)
+            else:
+                exported = self.write_jsonl(stream, rows)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        elapsed = time.monotonic() - started
+        self.stderr.write(self.style.SUCCESS(
+            f"Exported {exported} products in {elapsed:.1f}s ({exported / max(elapsed, 1e-9):,.0f} rows/s)"
+        ))
+
+    def write_csv(self, stream, rows):
+        writer = csv.writer(stream)
+        writer.writerow(FIELDS)
+        exported = 0
+        for row in rows:
+            writer.writerow([csv_value(value) for value in row])
+            exported += 1
+        return exported
+
+    def write_jsonl(self, stream, rows):
+        exported = 0
+        for row in rows:
+            record = dict(zip(FIELDS, row))
+            for name in ('price', 'discount_price'):
+                if record[name] is not None:
+                    record[name] = str(record[name])
+            stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+            exported += 1
+        return exported
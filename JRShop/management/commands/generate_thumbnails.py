@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from JRShop import caching, images
+from JRShop.models import Product
+
+
+def render(job):
+    """Worker process: render one image's variants"""
+    product_id, source, previous = job
+    try:
+        return product_id, source, images.render_variants(source, previous), None
+    except (OSError, Image.DecompressionBombError) as e:
+        return product_id, source, None, str(e)
+
+
+class Command(BaseCommand):
+    help = "Render the WebP/JPEG thumbnails of product images that lack them, across a pool of processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes")
+        parser.add_argument('--batch-size', type=int, default=200, help="Products rendered between saves")
+        parser.add_argument('--force', action='store_true', help="Re-render images that are up to date")
+
+    def handle(self, *args, **options):
+        products = (
+            Product.objects.exclude(image='').only('pk', 'image', 'image_variants').order_by('pk')
+            .iterator(chunk_size=options['batch_size'])
+        )
+        stale = (
+            (product.pk, product.image.name, product.image_variants)
+            for product in products if options['force'] or not images.is_current(product)
+        )
+
+        rendered = failed = 0
+        # Fresh interpreters, so no worker inherits a database connection
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(options['workers'], mp_context=context, initializer=django.setup) as pool:
+            while batch := list(islice(stale, options['batch_size'])):
+                updates = []
+                for product_id, source, variants, error in pool.map(render, batch, chunksize=4):
+                    if error:
+                        failed += 1
+                        self.stderr.write(f"Product {product_id} ({source}): {error}")
+                    else:
+                        updates.append(Product(pk=product_id, image_variants=variants))
+                # bulk_update skips the save signals
+                Product.objects.bulk_update(updates, ['image_variants'])
+                caching.bump_versions('catalog', *[f'product:{product.pk}' for product in updates])
+                rendered += len(updates)
+                self.stdout.write(f"Rendered {rendered} image(s)")
+
+        self.stdout.write(self.style.SUCCESS(f"Rendered {rendered} image(s), {failed} failed"))
@@ -0,0 +1,219 @@
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import urlsplit
+
+import requests
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from JRShop import caching, search
+from JRShop.management.commands.export_products import FIELDS, file_format
+from JRShop.models import Category, Product
+
+# Columns rewritten when a slug already exists; ratings, image variants
+# and created_at are left alone
+UPDATE_FIELDS = ['name', 'category', 'description', 'price', 'discount_price', 'stock', 'available', 'image',
+                 'updated_at']
+
+TRUE = {'1', 'true', 't', 'yes', 'y'}
+FALSE = {'0', 'false', 'f', 'no', 'n'}
+
+IMAGE_TIMEOUT = (5, 30)
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+# Row errors printed before only counting them
+MAX_REPORTED_ERRORS = 20
+
+
+class RowError(ValueError):
+    """A row that cannot be imported"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Create or update products from a CSV or JSON Lines file (or stdin), upserting by slug in batches. "
+        f"Columns: {', '.join(FIELDS)}; category is a category slug and image is a path in media storage "
+        "or an http(s) URL, downloaded concurrently"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="File to read, or - for stdin")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help="Input format; by default taken from the file extension")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Products written per transaction")
+        parser.add_argument('--image-workers', type=int, default=8, help="Concurrent image downloads")
+        parser.add_argument('--create-categories', action='store_true',
+                            help="Create categories whose slug is unknown instead of rejecting their rows")
+        parser.add_argument('--refetch-images', action='store_true',
+                            help="Download image URLs even for products that already have an image")
+
+    def handle(self, *args, **options):
+        path = options['input']
+        format = file_format(path, options['format'] or ('csv' if path == '-' else None))
+        self.options = options
+        self.categories = {category.slug: category for category in Category.objects.all()}
+        self.imported = self.failed = self.fetched = 0
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=options['image_workers'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        started = time.monotonic()
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            records = self.read_csv(stream) if format == 'csv' else self.read_jsonl(stream)
+            with ThreadPoolExecutor(options['image_workers']) as pool:
+                while batch := list(islice(records, options['batch_size'])):
+                    self.import_batch(batch, pool)
+                    if options['verbosity'] > 1:
+                        self.stdout.write(f"{self.imported} products imported, {self.throughput(started)}")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            self.session.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {self.imported} products ({self.failed} rows rejected) in "
+            f"{time.monotonic() - started:.1f}s, {self.throughput(started)}"
+        ))
+        if self.fetched:
+            self.stdout.write(f"Downloaded {self.fetched} images; run manage.py generate_thumbnails to render them")
+
+    def throughput(self, started):
+        return f"{(self.imported + self.failed) / max(time.monotonic() - started, 1e-9):,.0f} rows/s"
+
+    # Reading
+
+    def read_csv(self, stream):
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield f'line {reader.line_num}', record
+
+    def read_jsonl(self, stream):
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield f'line {number}', RowError(f"invalid JSON: {e}")
+                continue
+            yield f'line {number}', record
+
+    # Writing
+
+    def reject(self, where, error):
+        self.failed += 1
+        if self.failed <= MAX_REPORTED_ERRORS:
+            self.stderr.write(f"{where}: {error}")
+        elif self.failed == MAX_REPORTED_ERRORS + 1:
+            self.stderr.write("Further rejected rows are only counted")
+
+    def import_batch(self, batch, pool):
+        rows = {}
+        for where, record in batch:
+            try:
+                if isinstance(record, RowError):
+                    raise record
+                product, image = self.build(record)
+            except RowError as e:
+                self.reject(where, e)
+                continue
+            # One statement cannot upsert the same slug twice; the last row wins
+            rows[product.slug] = (product, image)
+
+        existing = dict(Product.objects.filter(slug__in=rows).values_list('slug', 'image'))
+        urls = {
+            image for slug, (_, image) in rows.items()
+            if urlsplit(image).scheme in ('http', 'https') and (self.options['refetch_images'] or not existing.get(slug))
+        }
+        downloaded = dict(zip(urls, pool.map(self.fetch_image, urls)))
+        self.fetched += sum(1 for name in downloaded.values() if name)
+
+        products = []
+        for slug, (product, image) in rows.items():
+            if urlsplit(image).scheme in ('http', 'https'):
+                image = downloaded.get(image)
+            # Without a usable image a product keeps the one it has
+            product.image = image or existing.get(slug, '')
+            products.append(product)
+
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                products, update_conflicts=True, unique_fields=['slug'], update_fields=UPDATE_FIELDS,
+            )
+            # bulk_create skips the save signals
+            search.index_products(products)
+            caching.bump_versions('catalog', *[f'product:{product.pk}' for product in products])
+        self.imported += len(products)
+
+    def build(self, record):
+        """An unsaved Product from one row, and its image path or URL"""
+        values = {name: record.get(name) for name in FIELDS}
+        for name, value in values.items():
+            if isinstance(value, str):
+                values[name] = value.strip()
+
+        category = self.category(values.pop('category'))
+        image = values.pop('image') or ''
+        values['description'] = values['description'] or ''
+        values['stock'] = values['stock'] or 0
+        values['discount_price'] = values['discount_price'] or None
+        values['available'] = self.boolean(values['available'])
+
+        product = Product(category=category, **values)
+        try:
+            product.clean_fields(exclude=['category', 'image'])
+        except ValidationError as e:
+            raise RowError('; '.join(f"{name}: {' '.join(errors)}" for name, errors in e.message_dict.items()))
+        return product, image
+
+    def category(self, slug):
+        if not slug:
+            raise RowError("category: This field cannot be blank.")
+        if slug not in self.categories:
+            if not self.options['create_categories']:
+                raise RowError(f"category: no category with slug {slug!r}")
+            self.categories[slug] = Category.objects.create(
+                slug=slug, name=slug.replace('-', ' ').title(), description='',
+            )
+        return self.categories[slug]
+
+    def boolean(self, value):
+        if value is None or value == '':
+            return True
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in TRUE:
+            return True
+        if str(value).lower() in FALSE:
+            return False
+        raise RowError(f"available: {value!r} is not true or false")
+
+    def fetch_image(self, url):
+        """Download an image into media storage; its name, or None on failure"""
+        try:
+            response = self.session.get(url, timeout=IMAGE_TIMEOUT, stream=True)
+            response.raise_for_status()
+            if not response.headers.get('Content-Type', '').startswith('image/'):
+                raise ValueError(f"not an image ({response.headers.get('Content-Type')})")
+            content = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > MAX_IMAGE_BYTES:
+                    raise ValueError(f"larger than {MAX_IMAGE_BYTES} bytes")
+        except (requests.RequestException, ValueError) as e:
+            self.stderr.write(f"Image {url}: {e}")
+            return None
+        filename = os.path.basename(urlsplit(url).path) or 'image'
+        name = Product._meta.get_field('image').generate_filename(None, filename)
+        return default_storage.save(name, ContentFile(bytes(content)))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from JRShop.sessions import purge_expired_sessions
+
+
+class Command(BaseCommand):
+    help = "Delete expired sessions in small batches, oldest first (run from cron instead of clearsessions)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Sessions deleted per statement")
+        parser.add_argument('--limit', type=int, default=None, help="Maximum number of sessions deleted in this run")
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help="Seconds to sleep between batches, leaving room for other writers")
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_sessions(options['batch_size'], options['limit'], options['pause'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired session(s)"))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import Count, F, Sum
+
+from JRShop.models import CustomerStats, Order
+
+
+class Command(BaseCommand):
+    help = "Recompute the CustomerStats rows (paid order count and total spent) from the orders table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Number of customers updated per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        paid = Order.objects.filter(paid=True).order_by()
+
+        last_id = 0
+        updated = 0
+        while True:
+            ids = list(
+                paid.filter(user_id__gt=last_id).order_by('user_id').values_list('user_id', flat=True)
+                .distinct()[:batch_size]
+            )
+            if not ids:
+                break
+            totals = paid.filter(user_id__in=ids).values('user_id').annotate(
+                paid_orders=Count('id', distinct=True),
+                total_spent=Sum(F('order_items__quantity') * F('order_items__price'),
+                                output_field=models.DecimalField(max_digits=14, decimal_places=2)),
+            )
+            with transaction.atomic():
+                CustomerStats.objects.bulk_create(
+                    [CustomerStats(user_id=row['user_id'], paid_orders=row['paid_orders'],
+                                   total_spent=row['total_spent'] or 0) for row in totals],
+                    update_conflicts=True, unique_fields=['user'], update_fields=['paid_orders', 'total_spent'],
+                )
+            last_id = ids[-1]
+            updated += len(ids)
+
+        # Customers whose paid orders have all been deleted
+        removed, _ = CustomerStats.objects.exclude(user__orders__paid=True).delete()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt order stats for {updated} customers, removed {removed}"))
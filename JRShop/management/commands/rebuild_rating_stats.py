@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from JRShop.models import Product, Rating
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized rating_count/rating_sum/rating_avg columns on Product"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Number of products updated per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ratings = Rating.objects.filter(product=OuterRef('pk')).order_by().values('product')
+        rating_count = Coalesce(Subquery(ratings.annotate(n=Count('id')).values('n')), Value(0))
+        rating_sum = Coalesce(Subquery(ratings.annotate(s=Sum('rating')).values('s')), Value(0))
+
+        last_id = 0
+        updated = 0
+        while True:
+            ids = list(
+                Product.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                batch = Product.objects.filter(pk__in=ids)
+                batch.update(rating_count=rating_count, rating_sum=rating_sum)
+                # The average is derived from the totals written just above
+                batch.update(rating_avg=Product.rating_avg_expression())
+            last_id = ids[-1]
+            updated += len(ids)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rating aggregates for {updated} products"))
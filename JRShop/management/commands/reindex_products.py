@@ -0,0 +1,49 @@
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from JRShop import search
+from JRShop.models import Product
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text product search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Number of products indexed per transaction")
+        parser.add_argument('--database', default='default',
+                            help="Database alias whose index is rebuilt")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        using = options['database']
+        backend = search.get_backend(using)
+        if type(backend) is search.SearchBackend:
+            self.stdout.write(self.style.WARNING("No full-text index on this database, nothing to do"))
+            return
+
+        started = time.monotonic()
+        products = (
+            Product.objects.using(using)
+            .select_related('category')
+            .only('id', 'name', 'description', 'category__name')
+            .order_by('pk')
+            .iterator(chunk_size=batch_size)
+        )
+        backend.clear()
+        indexed = 0
+        while True:
+            batch = list(islice(products, batch_size))
+            if not batch:
+                break
+            with transaction.atomic(using=using):
+                backend.index(batch)
+            indexed += len(batch)
+
+        if hasattr(backend, 'optimize'):
+            backend.optimize()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} products in {elapsed:.1f}s"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from JRShop.orders import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Return the stock held by unpaid orders whose reservation has expired (run from cron)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help="Maximum number of orders released in this run")
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations(limit=options['limit'])
+        self.stdout.write(self.style.SUCCESS(f"Released {released} expired reservation(s)"))
@@ -0,0 +1,47 @@
+import os
+import signal
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from JRShop import jobs
+
+
+class Command(BaseCommand):
+    help = "Run background jobs (payment IPNs, confirmation emails); start one or more per server"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20,
+                            help="Jobs claimed at a time; batch tasks such as emails are run together")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty")
+        parser.add_argument('--visibility-timeout', type=int, default=None,
+                            help="Seconds before an unfinished job may be claimed by another worker")
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once no job is ready instead of waiting for more")
+
+    def handle(self, *args, **options):
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = False
+
+        def stop(signum, frame):
+            # Finish the current batch, then exit
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        done = 0
+        while not self.stopping:
+            close_old_connections()
+            claimed = jobs.claim(worker, options['batch_size'], options['visibility_timeout'])
+            if claimed:
+                done += jobs.run(claimed)
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['poll_interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Worker {worker} finished {done} job(s)"))
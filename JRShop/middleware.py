@@ -0,0 +1,177 @@
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+from django.utils.functional import SimpleLazyObject
+
+from . import instrumentation
+from .cart import ANONYMOUS_CART_COOKIE, get_cart_summary
+from .routers import PIN_COOKIE, pin_primary, replicas, sticky_seconds
+from .staticfiles import index_static_files
+
+
+class HybridMiddleware:
+    """
+    Runs sync or async, like the rest of the chain, so under ASGI the async
+    views are not handed to a thread. Subclasses implement __call__ and,
+    returning it from there when self.is_async, __acall__.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+class StaticFilesMiddleware(HybridMiddleware):
+    """Serve collected static files ahead of everything else (see staticfiles.py)"""
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.files = index_static_files()
+        if not self.files:
+            # Nothing collected: runserver or the finders serve /static/
+            raise MiddlewareNotUsed
+
+    def static_file(self, request):
+        if request.method in ('GET', 'HEAD'):
+            return self.files.get(request.path_info)
+        return None
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        static_file = self.static_file(request)
+        if static_file is not None:
+            return static_file.respond(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        static_file = self.static_file(request)
+        if static_file is not None:
+            return static_file.respond(request)
+        return await self.get_response(request)
+
+
+class InstrumentationMiddleware(HybridMiddleware):
+    """
+    Measure a sampled share of requests (see instrumentation.py): send a
+    Server-Timing header and log requests slower than the threshold.
+    Unsampled requests are only timed, so a slow one is still logged.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.sample_rate = getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 1.0)
+        self.server_timing = getattr(settings, 'INSTRUMENTATION_SERVER_TIMING', True)
+        self.threshold = getattr(settings, 'SLOW_REQUEST_THRESHOLD_MS', 500) / 1000
+        instrumentation.install()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = instrumentation.start() if random.random() < self.sample_rate else None
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            total, metrics = self.stop(token, started)
+        self.add_server_timing(response, total, metrics)
+        if total >= self.threshold:
+            instrumentation.log_slow_request(request, response, total, metrics)
+        return response
+
+    async def __acall__(self, request):
+        token = instrumentation.start() if random.random() < self.sample_rate else None
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            total, metrics = self.stop(token, started)
+        self.add_server_timing(response, total, metrics)
+        if total >= self.threshold:
+            # The log reads request.user, which may not have been loaded yet
+            await sync_to_async(instrumentation.log_slow_request)(request, response, total, metrics)
+        return response
+
+    def stop(self, token, started):
+        total = time.perf_counter() - started
+        metrics = instrumentation.current() if token is not None else None
+        if token is not None:
+            instrumentation.stop(token)
+        return total, metrics
+
+    def add_server_timing(self, response, total, metrics):
+        if metrics is not None and self.server_timing:
+            response['Server-Timing'] = metrics.server_timing(total)
+
+
+class CartMiddleware(HybridMiddleware):
+    """
+    Attach a lazily loaded cart summary to the request as request.cart, and
+    drop the anonymous cart cookie once its visitor has logged in (login
+    merges it into their cart, see signals.py)
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request.cart = SimpleLazyObject(lambda: get_cart_summary(request.user, request))
+        response = self.get_response(request)
+        if ANONYMOUS_CART_COOKIE in request.COOKIES and request.user.is_authenticated:
+            response.delete_cookie(ANONYMOUS_CART_COOKIE, samesite='Lax')
+        return response
+
+    async def __acall__(self, request):
+        request.cart = SimpleLazyObject(lambda: get_cart_summary(request.user, request))
+        response = await self.get_response(request)
+        # request.user would load the user synchronously; auser() is its async twin
+        if ANONYMOUS_CART_COOKIE in request.COOKIES and (await request.auser()).is_authenticated:
+            response.delete_cookie(ANONYMOUS_CART_COOKIE, samesite='Lax')
+        return response
+
+
+def _view_uses_primary(request):
+    try:
+        return getattr(resolve(request.path_info).func, 'use_primary', False)
+    except Resolver404:
+        return False
+
+
+class ReplicaRoutingMiddleware(HybridMiddleware):
+    """Pin requests to the primary where replica lag would show"""
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not replicas():
+            return self.get_response(request)
+        with pin_primary(self.pinned(request)):
+            response = self.get_response(request)
+        return self.stick(request, response)
+
+    async def __acall__(self, request):
+        if not replicas():
+            return await self.get_response(request)
+        # The pin is a context variable, so it reaches sync views run in a thread too
+        with pin_primary(self.pinned(request)):
+            response = await self.get_response(request)
+        return self.stick(request, response)
+
+    @staticmethod
+    def writing(request):
+        return request.method not in ('GET', 'HEAD', 'OPTIONS')
+
+    def pinned(self, request):
+        return self.writing(request) or PIN_COOKIE in request.COOKIES or _view_uses_primary(request)
+
+    def stick(self, request, response):
+        if self.writing(request) and response.status_code < 400:
+            response.set_cookie(PIN_COOKIE, '1', max_age=sticky_seconds(), httponly=True, samesite='Lax')
+        return response
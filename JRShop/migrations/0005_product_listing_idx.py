@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('JRShop', '0004_order_paid_alter_order_note_alter_order_status_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['available', '-created_at', '-id'], name='product_listing_idx'),
+        ),
+    ]
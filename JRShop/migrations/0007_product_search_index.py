@@ -0,0 +1,53 @@
+from django.db import migrations
+
+SEARCH_TABLE = 'jrshop_product_search'
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+            "name, category, description, tokenize = 'unicode61 remove_diacritics 2', "
+            "prefix = '2 3 4')"
+        )
+        populate = (
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, category, description) "
+            'SELECT p.id, p.name, c.name, p.description '
+            'FROM "JRShop_product" p JOIN "JRShop_category" c ON c.id = p.category_id'
+        )
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f'CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ('
+            'product_id bigint PRIMARY KEY, document tsvector NOT NULL)'
+        )
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_gin '
+            f'ON {SEARCH_TABLE} USING gin (document)'
+        )
+        populate = (
+            f'INSERT INTO {SEARCH_TABLE} (product_id, document) '
+            "SELECT p.id, setweight(to_tsvector('simple', p.name), 'A') || "
+            "setweight(to_tsvector('simple', c.name), 'B') || "
+            "setweight(to_tsvector('simple', p.description), 'C') "
+            'FROM "JRShop_product" p JOIN "JRShop_category" c ON c.id = p.category_id'
+        )
+    else:
+        return
+    schema_editor.execute(populate)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('JRShop', '0006_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
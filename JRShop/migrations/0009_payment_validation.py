@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('JRShop', '0008_order_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentValidation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('val_id', models.CharField(max_length=100, unique=True)),
+                ('tran_id', models.CharField(blank=True, max_length=150)),
+                ('status', models.CharField(max_length=20)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=12, null=True)),
+                ('response', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='validations', to='JRShop.order')),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:38
+
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def remove_duplicates(apps, schema_editor):
+    """Merge duplicate cart lines and blank transaction ids before the unique constraints"""
+    CartItem = apps.get_model('JRShop', 'CartItem')
+    Order = apps.get_model('JRShop', 'Order')
+    duplicates = (
+        CartItem.objects.values('cart_id', 'product_id')
+        .annotate(lines=Count('id'), keep=Min('id'), quantity=Sum('quantity'))
+        .filter(lines__gt=1)
+    )
+    for line in duplicates:
+        CartItem.objects.filter(pk=line['keep']).update(quantity=line['quantity'])
+        CartItem.objects.filter(cart_id=line['cart_id'], product_id=line['product_id']).exclude(pk=line['keep']).delete()
+    Order.objects.filter(transaction_id='').update(transaction_id=None)
+
+
+# Data only: PostgreSQL cannot add 0012's constraints in the transaction
+# that changed these rows ("pending trigger events")
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('JRShop', '0010_job_queue'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:57
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+
+
+def backfill_customer_stats(apps, schema_editor):
+    Order = apps.get_model('JRShop', 'Order')
+    CustomerStats = apps.get_model('JRShop', 'CustomerStats')
+    totals = (
+        Order.objects.filter(paid=True).order_by().values('user')
+        .annotate(
+            paid_orders=Count('id', distinct=True),
+            total_spent=Sum(F('order_items__quantity') * F('order_items__price'),
+                            output_field=models.DecimalField(max_digits=14, decimal_places=2)),
+        )
+    )
+    CustomerStats.objects.bulk_create(
+        [CustomerStats(user_id=row['user'], paid_orders=row['paid_orders'], total_spent=row['total_spent'] or 0)
+         for row in totals.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('JRShop', '0013_product_image_variants'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='order_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('paid_orders', models.PositiveIntegerField(default=0)),
+                ('total_spent', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+            ],
+            options={
+                'verbose_name_plural': 'customer stats',
+            },
+        ),
+        migrations.RunPython(backfill_customer_stats, migrations.RunPython.noop),
+    ]
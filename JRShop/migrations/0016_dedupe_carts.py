@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:19
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_carts(apps, schema_editor):
+    """Fold every user's extra carts into their oldest one before the unique constraint"""
+    Cart = apps.get_model('JRShop', 'Cart')
+    CartItem = apps.get_model('JRShop', 'CartItem')
+    duplicates = Cart.objects.values('user_id').annotate(carts=Count('id'), keep=Min('id')).filter(carts__gt=1)
+    for user in duplicates:
+        extra = Cart.objects.filter(user_id=user['user_id']).exclude(pk=user['keep'])
+        kept = {item.product_id: item for item in CartItem.objects.filter(cart_id=user['keep'])}
+        for item in CartItem.objects.filter(cart__in=extra).order_by('id'):
+            if item.product_id in kept:
+                kept[item.product_id].quantity += item.quantity
+                kept[item.product_id].save(update_fields=['quantity'])
+                item.delete()
+            else:
+                item.cart_id = user['keep']
+                item.save(update_fields=['cart'])
+                kept[item.product_id] = item
+        extra.delete()
+
+
+# Data only: PostgreSQL cannot alter the cart table in the transaction
+# that deleted these rows ("pending trigger events"), so 0017 does that
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('JRShop', '0015_order_status_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_carts, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,9 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, Prefetch, Q, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Round
+from decimal import Decimal
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 
 # Create your models here.
@@ -27,6 +31,24 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     image = models.ImageField(upload_to='products/%Y/%m/%d')
+    # Resized WebP/JPEG renderings of image, see images.py
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveBigIntegerField(default=0, editable=False)
+    rating_avg = models.DecimalField(max_digits=3, decimal_places=2, default=0, db_index=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the catalog walks this index newest first
+            models.Index(fields=['available', '-created_at', '-id'], name='product_listing_idx'),
+            # Category pages: the same walk restricted to one category
+            models.Index(
+                fields=['category', '-created_at', '-id'], condition=Q(available=True),
+                name='product_category_listing_idx',
+            ),
+            # Price filters and the min/max price of a listing
+            models.Index(fields=['available', 'category', 'price'], name='product_price_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -49,10 +71,30 @@ class Product(models.Model):
         return self.price
     
     def average_ratings(self):
-        ratings = self.ratings.all()
-        if ratings.count() > 0:
-            return sum([rating.rating for rating in ratings])/ratings.count()
+        """Average rating, read from the denormalized rating_* columns"""
+        if self.rating_count > 0:
+            return self.rating_sum / self.rating_count
+    
+    @staticmethod
+    def rating_avg_expression(count_delta=0, sum_delta=0):
+        """SQL expression for the average after shifting count and sum by the given deltas"""
+        new_count = F('rating_count') + count_delta
+        new_sum = F('rating_sum') + sum_delta
+        return Case(
+            When(Q(rating_count__gt=-count_delta), then=Round(Cast(new_sum, models.FloatField()) / new_count, 2)),
+            default=Value(0),
+            output_field=models.DecimalField(max_digits=3, decimal_places=2),
+        )
     
+    @classmethod
+    def apply_rating_delta(cls, product_id, count_delta, sum_delta):
+        """Shift a product's rating aggregates in a single UPDATE"""
+        cls.objects.filter(pk=product_id).update(
+            rating_count=F('rating_count') + count_delta,
+            rating_sum=F('rating_sum') + sum_delta,
+            rating_avg=cls.rating_avg_expression(count_delta, sum_delta),
+        )
+
 
 class Rating(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='ratings')
@@ -64,15 +106,34 @@ class Rating(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.product.name} - {self.rating}"
     
+    def save(self, *args, **kwargs):
+        # post_save updates the product's rating aggregates; run it in the
+        # same transaction as the insert/update (deletes already are atomic)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+    
+class CartQuerySet(models.QuerySet):
+    def with_items(self):
+        """Prefetch the cart lines and their products in one extra query"""
+        return self.prefetch_related(
+            Prefetch('items', queryset=CartItem.objects.select_related('product__category').order_by('id'))
+        )
+
+
 class Cart(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Raised by every change made through cart.add_item and the cart API
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = CartQuerySet.as_manager()
 
     def __str__(self):
         return f"Cart - {self.user.username}"
     
     def get_total_price(self):
+        # Free of queries when the cart was loaded with with_items()
         return sum(item.get_cost() for item in self.items.all())
     
 class CartItem(models.Model):
@@ -80,12 +141,35 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveBigIntegerField(default=1)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='cartitem_cart_product_unique'),
+        ]
+
     def __str__(self):
         return f"{self.quantity} X {self.product.name}"
     
     def get_cost(self):
         return self.quantity * self.product.get_final_price()
 
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Annotate each order with its total cost, computed by the database"""
+        return self.annotate(
+            total_cost=Coalesce(
+                Sum(F('order_items__quantity') * F('order_items__price')),
+                Value(Decimal('0')),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            )
+        )
+
+    def with_items(self):
+        """Prefetch the order lines and their products in one extra query"""
+        return self.prefetch_related(
+            Prefetch('order_items', queryset=OrderItem.objects.select_related('product').order_by('id'))
+        )
+
+
 class Order(models.Model):
     STATUS = [
         ('pending', 'Pending'),
@@ -106,15 +190,44 @@ class Order(models.Model):
     note = models.TextField(blank=True, null=True)
     transaction_id = models.CharField(max_length=150, blank=True, null=True)
     paid = models.BooleanField(default=False)
+    stock_reserved = models.BooleanField(default=False, help_text="Stock for this order is held back from other buyers")
+    reservation_expires_at = models.DateTimeField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=15, choices=STATUS, default='pending')
 
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # A user's orders, newest first (profile)
+            models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+            # The admin's status filter, and counting its matches
+            models.Index(fields=['status'], name='order_status_idx'),
+            # Only unpaid orders still holding stock are scanned for expiry
+            models.Index(
+                fields=['reservation_expires_at'], condition=Q(stock_reserved=True, paid=False),
+                name='order_reservation_expiry_idx',
+            ),
+        ]
+        constraints = [
+            # The IPN and the success callback look orders up by transaction
+            models.UniqueConstraint(fields=['transaction_id'], name='order_transaction_id_unique'),
+        ]
+
     def __str__(self):
         return f"Order #{self.id}"
     
     def get_total_cost(self):
-        return sum(item.get_cost() for item in self.order_items.all())
+        """Total of all lines, without a query when annotated or prefetched"""
+        if getattr(self, 'total_cost', None) is not None:
+            return self.total_cost
+        if 'order_items' in getattr(self, '_prefetched_objects_cache', {}):
+            return sum((item.get_cost() for item in self.order_items.all()), Decimal('0'))
+        total = self.order_items.aggregate(
+            total=Sum(F('quantity') * F('price'), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+        )['total']
+        return total or Decimal('0')
     
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='order_items')
@@ -126,4 +239,60 @@ class OrderItem(models.Model):
         return self.quantity * self.price
 
 
+class CustomerStats(models.Model):
+    """Running totals of a customer's paid orders, kept up to date by orders.finalize_payment"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='order_stats')
+    paid_orders = models.PositiveIntegerField(default=0)
+    total_spent = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0'))
 
+    class Meta:
+        verbose_name_plural = 'customer stats'
+
+    def __str__(self):
+        return f"{self.user} ({self.paid_orders} paid orders)"
+
+
+class PaymentValidation(models.Model):
+    """A successful SSL Commerz validation, stored so repeat callbacks skip the gateway"""
+    val_id = models.CharField(max_length=100, unique=True)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='validations')
+    tran_id = models.CharField(max_length=150, blank=True)
+    status = models.CharField(max_length=20)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    response = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.val_id} ({self.status})"
+
+
+class Job(models.Model):
+    """
+    A unit of background work, run by the run_jobs command.
+
+    run_at is when a queued job may start; while a job runs it is the
+    visibility deadline, after which another worker may claim it again.
+    """
+    STATUS = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+    ]
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    key = models.CharField(max_length=200, unique=True, null=True, blank=True, help_text="Jobs with the same key are only queued once")
+    status = models.CharField(max_length=10, choices=STATUS, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=8)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_ready_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
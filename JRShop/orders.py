@@ -0,0 +1,213 @@
+"""
+Order placement and stock reservation.
+
+Checkout reserves stock by decrementing Product.stock with a conditional
+UPDATE inside the transaction that creates the order, so two buyers can
+never be sold the same unit. A reservation that is not paid for within
+STOCK_RESERVATION_MINUTES is released back to stock by
+release_expired_reservations (see the command of the same name).
+
+Paying for an order also adds it to the customer's CustomerStats row,
+which the profile page reads instead of summing their order history.
+"""
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .jobs import enqueue
+from .models import CartItem, CustomerStats, Order, OrderItem, Product
+
+logger = logging.getLogger(__name__)
+
+
+class OutOfStock(Exception):
+    """Raised when a cart line cannot be reserved"""
+
+    def __init__(self, product, available):
+        self.product = product
+        self.available = available
+        super().__init__(f"Only {available} of {product.name} left in stock")
+
+
+class EmptyCart(Exception):
+    """Raised when the cart has no lines left to order, e.g. emptied by another tab"""
+
+    def __init__(self, cart):
+        self.cart = cart
+        super().__init__(f"Cart {cart.pk} is empty")
+
+
+def _per_product(quantities):
+    """CASE expression giving each product's quantity, for one UPDATE covering every line"""
+    return Case(
+        *[When(pk=pk, then=Value(q)) for pk, q in quantities.items()],
+        output_field=models.PositiveBigIntegerField(),
+    )
+
+
+def _order_quantities(order_pk):
+    quantities = {}
+    for item in OrderItem.objects.filter(order_id=order_pk).values('product_id', 'quantity'):
+        quantities[item['product_id']] = quantities.get(item['product_id'], 0) + item['quantity']
+    return quantities
+
+
+def reservation_deadline():
+    minutes = getattr(settings, 'STOCK_RESERVATION_MINUTES', 30)
+    return timezone.now() + timedelta(minutes=minutes)
+
+
+def place_order(cart, order):
+    """
+    Save an unsaved order for the cart's lines, reserving their stock.
+
+    Everything happens in one transaction: the products are locked in id
+    order (where the database supports SELECT ... FOR UPDATE), a single
+    UPDATE decrements each line's stock only if enough is left, the lines
+    are inserted with one bulk_create and the cart is emptied. Raises
+    OutOfStock, with nothing written, if any line cannot be reserved, and
+    EmptyCart if the cart was emptied since the caller read it.
+    """
+    with transaction.atomic():
+        quantities = {}
+        for item in CartItem.objects.filter(cart=cart).values('product_id', 'quantity'):
+            quantities[item['product_id']] = quantities.get(item['product_id'], 0) + item['quantity']
+        if not quantities:
+            raise EmptyCart(cart)
+
+        products = list(
+            Product.objects.select_for_update().filter(pk__in=quantities).order_by('pk')
+        )
+        # One conditional UPDATE reserves every line; any row that would go
+        # below zero is left out, so a short rowcount means something is short
+        quantity = _per_product(quantities)
+        reserved = Product.objects.filter(
+            pk__in=quantities, available=True, stock__gte=quantity
+        ).update(stock=F('stock') - quantity)
+        if reserved != len(quantities):
+            short = next(
+                (p for p in products if not p.available or p.stock < quantities[p.pk]),
+                products[0],
+            )
+            raise OutOfStock(short, short.stock if short.available else 0)
+
+        order.stock_reserved = True
+        order.reservation_expires_at = reservation_deadline()
+        order.save()
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.get_final_price(), quantity=quantities[product.pk])
+            for product in products
+        ])
+        CartItem.objects.filter(cart=cart).delete()
+
+    logger.info(f"Order {order.id} placed with {len(products)} line(s), stock reserved until {order.reservation_expires_at}")
+    return order
+
+
+def release_reservation(order):
+    """
+    Return an unpaid order's reserved stock. Safe to call concurrently:
+    only the caller that flips stock_reserved releases anything.
+    """
+    with transaction.atomic():
+        released = Order.objects.filter(pk=order.pk, paid=False, stock_reserved=True).update(stock_reserved=False)
+        if not released:
+            return False
+        quantities = _order_quantities(order.pk)
+        if quantities:
+            Product.objects.filter(pk__in=quantities).update(stock=F('stock') + _per_product(quantities))
+    logger.info(f"Released stock reservation for Order {order.pk}")
+    return True
+
+
+def release_expired_reservations(now=None, limit=None):
+    """Release every unpaid reservation past its deadline; returns how many were released"""
+    expired = Order.objects.filter(
+        paid=False, stock_reserved=True, reservation_expires_at__lt=now or timezone.now()
+    ).order_by('reservation_expires_at').only('pk')
+    if limit:
+        expired = expired[:limit]
+    return sum(1 for order in expired if release_reservation(order))
+
+
+def finalize_payment(order, transaction_id=None):
+    """
+    Mark an order paid exactly once and settle its stock.
+
+    The browser redirect and the IPN can arrive together; the conditional
+    UPDATE ... WHERE paid = false lets only one of them win. If the order
+    still holds its checkout reservation the stock is already taken;
+    otherwise (the reservation expired and was released) every line is
+    decremented in a single UPDATE, clamped at zero. The customer's stats
+    and the confirmation email are updated and queued in the same
+    transaction. Returns True for the caller
+    that finalized the order, False if it was already paid.
+    """
+    changes = {'paid': True, 'status': 'processing'}
+    if transaction_id:
+        changes['transaction_id'] = transaction_id
+
+    with transaction.atomic():
+        if not Order.objects.filter(pk=order.pk, paid=False).update(**changes):
+            return False
+
+        # Claim the stock unless the checkout reservation is still held
+        if Order.objects.filter(pk=order.pk, stock_reserved=False).update(stock_reserved=True):
+            quantities = _order_quantities(order.pk)
+            if quantities:
+                Product.objects.filter(pk__in=quantities).update(
+                    stock=Greatest(F('stock') - _per_product(quantities), Value(0))
+                )
+                logger.info(f"Order {order.pk}: reservation had lapsed, decremented stock for {len(quantities)} product(s)")
+
+        record_payment(order)
+        enqueue('send_order_confirmation', {'order_id': order.pk}, key=f'order-confirmation:{order.pk}')
+
+    for field, value in changes.items():
+        setattr(order, field, value)
+    order.stock_reserved = True
+    logger.info(f"Order {order.pk} marked as paid")
+    return True
+
+
+def record_payment(order):
+    """Add a newly paid order to its customer's running totals"""
+    total = OrderItem.objects.filter(order_id=order.pk).aggregate(
+        total=Coalesce(Sum(F('quantity') * F('price')), Value(Decimal('0')),
+                       output_field=models.DecimalField(max_digits=12, decimal_places=2))
+    )['total']
+    changes = {'paid_orders': F('paid_orders') + 1, 'total_spent': F('total_spent') + total}
+    if CustomerStats.objects.filter(user_id=order.user_id).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            CustomerStats.objects.create(user_id=order.user_id, paid_orders=1, total_spent=total)
+    except IntegrityError:
+        # Another of their orders was paid at the same moment and created the row
+        CustomerStats.objects.filter(user_id=order.user_id).update(**changes)
+
+
+def order_summary(user, using=None):
+    """
+    A customer's order counts, overall and by status, and their total
+    spent, in one query: the counts are aggregated over their orders and
+    the total comes from their CustomerStats row.
+    """
+    counts = {
+        f'{status}_orders': Count('orders', filter=Q(orders__status=status)) for status, _ in Order.STATUS
+    }
+    return User.objects.using(using).filter(pk=user.pk).values(
+        total_orders=Count('orders'),
+        **counts,
+        total_spent=Coalesce(
+            F('order_stats__total_spent'), Value(Decimal('0')),
+            output_field=models.DecimalField(max_digits=14, decimal_places=2),
+        ),
+    ).get()
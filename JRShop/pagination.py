@@ -0,0 +1,189 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+def _dump(value):
+    # isoformat() keeps microseconds, which the keyset comparison needs
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class CursorPage:
+    """A single page of results returned by CursorPaginator"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class CursorPaginator:
+    """
+    Keyset pagination, newest first on (created_at, id) by default.
+
+    Every page is a range scan that starts at the cursor position, so the
+    cost of page 10,000 is the same as the cost of page 1. No COUNT query
+    is ever issued. The ordering must end in a unique field.
+    """
+
+    def __init__(self, queryset, per_page=12, ordering=('-created_at', '-id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = tuple(ordering)
+
+    def _fields(self):
+        return [(name.lstrip('-'), name.startswith('-')) for name in self.ordering]
+
+    def _to_python(self, name, value):
+        annotation = self.queryset.query.annotations.get(name)
+        if annotation is not None:
+            field = annotation.output_field
+        else:
+            field = self.queryset.model._meta.get_field(name)
+        return field.to_python(value)
+
+    def encode_cursor(self, obj):
+        """Encode the ordering position of an object as an opaque cursor"""
+        values = [_dump(getattr(obj, name)) for name, _ in self._fields()]
+        raw = json.dumps(values, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """Decode a cursor back into a list of ordering values"""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            fields = self._fields()
+            if not isinstance(values, list) or len(values) != len(fields):
+                raise ValueError
+            return [self._to_python(name, value) for (name, _), value in zip(fields, values)]
+        except (ValueError, TypeError, binascii.Error, FieldDoesNotExist, ValidationError):
+            raise InvalidCursor(f"Invalid cursor: {cursor!r}")
+
+    def _seek(self, cursor, forward):
+        """Filter for the rows strictly after (or before) the cursor position"""
+        values = self.decode_cursor(cursor)
+        condition = Q()
+        equal = {}
+        for (name, descending), value in zip(self._fields(), values):
+            lookup = 'lt' if descending == forward else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return self.queryset.filter(condition)
+
+    def window(self, after=None):
+        """
+        Queryset of up to per_page + 1 rows following the `after` cursor.
+
+        The extra row only tells the caller whether a next page exists.
+        """
+        queryset = self._seek(after, forward=True) if after else self.queryset
+        return queryset.order_by(*self.ordering)[:self.per_page + 1]
+
+    def page(self, after=None, before=None):
+        """Return the page after (or before) the given cursor"""
+        if before:
+            reverse = [name[1:] if name.startswith('-') else f'-{name}' for name in self.ordering]
+            rows = list(self._seek(before, forward=False).order_by(*reverse)[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            return CursorPage(
+                rows,
+                next_cursor=self.encode_cursor(rows[-1]) if rows else None,
+                previous_cursor=self.encode_cursor(rows[0]) if rows and has_previous else None,
+            )
+
+        rows = list(self.window(after))
+        has_next = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        return CursorPage(
+            rows,
+            next_cursor=self.encode_cursor(rows[-1]) if rows and has_next else None,
+            previous_cursor=self.encode_cursor(rows[0]) if rows and after else None,
+        )
+
+
+def estimated_count(queryset):
+    """
+    The database's row estimate for a queryset, or None when it has none.
+
+    Unfiltered tables use the row count kept for the query planner; a
+    filtered queryset gets the planner's estimate of its result on
+    PostgreSQL only. Either may be off by a few percent, or more for
+    filters on skewed columns.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    try:
+        if connection.vendor == 'postgresql':
+            if queryset.query.where:
+                plan = json.loads(queryset.order_by().explain(format='json'))
+                return plan[0]['Plan']['Plan Rows']
+            sql = 'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass'
+            params = [connection.ops.quote_name(table)]
+        elif connection.vendor == 'sqlite' and not queryset.query.where:
+            # Rows counted by ANALYZE (or PRAGMA optimize); the first number
+            # of each index's stat is the row count, partial indexes cover less
+            sql = 'SELECT MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 WHERE tbl = %s'
+            params = [table]
+        else:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+    except DatabaseError:
+        # No sqlite_stat1 table before the first ANALYZE
+        return None
+    # reltuples is -1 for a table that was never analyzed
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for admin changelists of large tables.
+
+    When the database estimates more than ADMIN_ESTIMATED_COUNT_THRESHOLD
+    rows, the estimate is shown instead of running a COUNT(*) that reads
+    them all on every page view. Smaller results are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate > settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+            return estimate
+        return super().count
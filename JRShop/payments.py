@@ -0,0 +1,211 @@
+"""
+Deduplicated SSL Commerz payment validation.
+
+The browser redirect (sslcommerz_success) and the IPN validate the same
+val_id, and the gateway retries IPNs. validate_payment answers from, in
+order:
+
+1. the cache, which holds a successful result for
+   PAYMENT_VALIDATION_CACHE_TIMEOUT, and any other answer only for
+   PAYMENT_VALIDATION_FAILURE_CACHE_TIMEOUT, long enough for the callers
+   waiting on it but not to block a retry;
+2. the PaymentValidation row stored for an earlier successful validation;
+3. a validation of the same val_id already in flight in this process;
+4. the gateway, holding a cache lock so that other processes sharing the
+   cache wait for this result instead of calling too.
+
+Gateway errors are never cached, so the next caller simply tries again.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import PaymentValidation
+from .sslcommerz import avalidate_sslcommerz_payment, validate_sslcommerz_payment
+
+logger = logging.getLogger(__name__)
+
+VALID_STATUSES = ('VALID', 'VALIDATED')
+LOCK_POLL_SECONDS = 0.05
+
+
+def is_valid(validation):
+    return (validation.get('status') or '').upper() in VALID_STATUSES
+
+
+def _cache_key(val_id):
+    return f'payment-validation:{val_id}'
+
+
+def _lock_key(val_id):
+    return f'payment-validation-lock:{val_id}'
+
+
+def _cache_timeout(validation=None):
+    if validation is not None and not is_valid(validation):
+        return getattr(settings, 'PAYMENT_VALIDATION_FAILURE_CACHE_TIMEOUT', 5)
+    return getattr(settings, 'PAYMENT_VALIDATION_CACHE_TIMEOUT', 300)
+
+
+def _lock_timeout():
+    # Long enough for one validation including its retries; a crashed holder's lock expires
+    connect = getattr(settings, 'SSLCOMMERZ_CONNECT_TIMEOUT', 5)
+    read = getattr(settings, 'SSLCOMMERZ_READ_TIMEOUT', 20)
+    return int(connect + read * (1 + getattr(settings, 'SSLCOMMERZ_RETRIES', 3)))
+
+
+def _record_fields(validation, order):
+    try:
+        amount = Decimal(str(validation.get('amount')))
+    except (InvalidOperation, TypeError):
+        amount = None
+    return {
+        'order': order,
+        'tran_id': validation.get('tran_id') or '',
+        'status': (validation.get('status') or '').upper(),
+        'amount': amount,
+        'response': validation,
+    }
+
+
+# Sync callers (WSGI workers, the job queue)
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _stored(val_id):
+    validation = cache.get(_cache_key(val_id))
+    if validation is None:
+        record = PaymentValidation.objects.filter(val_id=val_id).only('response').first()
+        if record is not None:
+            validation = record.response
+            cache.set(_cache_key(val_id), validation, _cache_timeout())
+    return validation
+
+
+def _remember(val_id, validation, order):
+    cache.set(_cache_key(val_id), validation, _cache_timeout(validation))
+    if is_valid(validation):
+        PaymentValidation.objects.get_or_create(val_id=val_id, defaults=_record_fields(validation, order))
+
+
+def _fetch(val_id, order):
+    lock = _lock_key(val_id)
+    deadline = time.monotonic() + _lock_timeout()
+    acquired = cache.add(lock, 1, _lock_timeout())
+    while not acquired:
+        # Another process is validating this val_id; use its result once it lands
+        time.sleep(LOCK_POLL_SECONDS)
+        validation = cache.get(_cache_key(val_id))
+        if validation is not None:
+            return validation
+        if time.monotonic() > deadline:
+            # Validate without the lock, leaving the holder's alone
+            break
+        acquired = cache.add(lock, 1, _lock_timeout())
+    try:
+        validation = validate_sslcommerz_payment(val_id)
+        _remember(val_id, validation, order)
+        return validation
+    finally:
+        if acquired:
+            cache.delete(lock)
+
+
+def validate_payment(val_id, order=None):
+    """
+    Validate a payment, calling the gateway at most once per val_id.
+
+    Concurrent callers in the same process share one request, and callers
+    that fail share its exception.
+    """
+    validation = _stored(val_id)
+    if validation is not None:
+        logger.info(f"Reusing stored validation for val_id {val_id}")
+        return validation
+
+    with _inflight_lock:
+        future = _inflight.get(val_id)
+        leader = future is None
+        if leader:
+            future = _inflight[val_id] = Future()
+    if not leader:
+        return future.result()
+
+    try:
+        validation = _fetch(val_id, order)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(validation)
+        return validation
+    finally:
+        with _inflight_lock:
+            del _inflight[val_id]
+
+
+# Async callers (ASGI views)
+
+_async_inflight = weakref.WeakKeyDictionary()
+
+
+async def _astored(val_id):
+    validation = await cache.aget(_cache_key(val_id))
+    if validation is None:
+        record = await PaymentValidation.objects.filter(val_id=val_id).only('response').afirst()
+        if record is not None:
+            validation = record.response
+            await cache.aset(_cache_key(val_id), validation, _cache_timeout())
+    return validation
+
+
+async def _aremember(val_id, validation, order):
+    await cache.aset(_cache_key(val_id), validation, _cache_timeout(validation))
+    if is_valid(validation):
+        await PaymentValidation.objects.aget_or_create(val_id=val_id, defaults=_record_fields(validation, order))
+
+
+async def _afetch(val_id, order):
+    lock = _lock_key(val_id)
+    deadline = time.monotonic() + _lock_timeout()
+    acquired = await cache.aadd(lock, 1, _lock_timeout())
+    while not acquired:
+        await asyncio.sleep(LOCK_POLL_SECONDS)
+        validation = await cache.aget(_cache_key(val_id))
+        if validation is not None:
+            return validation
+        if time.monotonic() > deadline:
+            break
+        acquired = await cache.aadd(lock, 1, _lock_timeout())
+    try:
+        validation = await avalidate_sslcommerz_payment(val_id)
+        await _aremember(val_id, validation, order)
+        return validation
+    finally:
+        if acquired:
+            await cache.adelete(lock)
+
+
+async def avalidate_payment(val_id, order=None):
+    """Async version of validate_payment; tasks on one event loop share a request"""
+    validation = await _astored(val_id)
+    if validation is not None:
+        logger.info(f"Reusing stored validation for val_id {val_id}")
+        return validation
+
+    inflight = _async_inflight.setdefault(asyncio.get_running_loop(), {})
+    task = inflight.get(val_id)
+    if task is None:
+        task = inflight[val_id] = asyncio.ensure_future(_afetch(val_id, order))
+        task.add_done_callback(lambda _: inflight.pop(val_id, None))
+    # A cancelled caller must not cancel the request other callers are waiting on
+    return await asyncio.shield(task)
@@ -0,0 +1,89 @@
+"""
+Read replicas for the catalog.
+
+Reads of the catalog models go to a random alias in DATABASE_REPLICAS
+(set from DB_REPLICAS, see settings); everything else, and every write,
+stays on the primary ('default'). Reads fall back to the primary:
+
+- inside a transaction, so a transaction sees its own writes;
+- for views marked @use_primary (checkout and payments);
+- for REPLICA_STICKY_SECONDS after the visitor's last write (a cookie set
+  by ReplicaRoutingMiddleware), so people see their own changes.
+
+Other visitors keep reading from replicas after a catalog change; cached
+pages and fragments filled from a lagging replica are keyed apart until
+the replicas have caught up (see caching.py).
+
+Related objects are read from the database their parent came from.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICATED_MODELS = {'JRShop.Product', 'JRShop.Category', 'JRShop.Rating'}
+
+PIN_COOKIE = 'use_primary'
+
+_pinned = ContextVar('use_primary', default=False)
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+
+@contextmanager
+def pin_primary(pinned=True):
+    """Read everything from the primary within this block"""
+    token = _pinned.set(pinned or _pinned.get())
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def read_database():
+    """Alias to read catalog data (or anything else that may lag) from"""
+    aliases = replicas()
+    if not aliases or _pinned.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    return random.choice(aliases)
+
+
+def use_primary(view):
+    """Mark a view as reading only from the primary"""
+    view.use_primary = True
+    return view
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        if model._meta.label in REPLICATED_MODELS:
+            return read_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary
+        if db in replicas():
+            return False
+        return None
+
@@ -0,0 +1,215 @@
+"""
+Full-text product search.
+
+Products are indexed into a side table keyed by product id: an FTS5
+virtual table on SQLite and a weighted tsvector table with a GIN index on
+PostgreSQL. Searches restrict the product queryset to the ids matching in
+that table, rank them (bm25 / ts_rank_cd) and match the last term as a
+prefix for autocomplete.
+Other databases fall back to icontains filtering.
+"""
+import logging
+import re
+
+from django.db import connections
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = 'jrshop_product_search'
+MAX_TERMS = 8
+
+# Column weights: name, category, description
+SQLITE_BM25_WEIGHTS = (10.0, 5.0, 1.0)
+
+
+def tokenize(query):
+    """Split a search box query into at most MAX_TERMS lowercase terms"""
+    return re.findall(r'\w+', (query or '').lower())[:MAX_TERMS]
+
+
+def _documents(products):
+    for product in products:
+        yield product.id, product.name, product.category.name, product.description
+
+
+class SearchBackend:
+    """Fallback backend: substring matching without an index or ranking"""
+
+    ordering = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def filter(self, queryset, query):
+        """Restrict the queryset to products matching the query"""
+        for term in tokenize(query):
+            queryset = queryset.filter(
+                Q(name__icontains=term) |
+                Q(description__icontains=term) |
+                Q(category__name__icontains=term)
+            )
+        return queryset
+
+    def index(self, products):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def clear(self):
+        pass
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 virtual table ranked with bm25 (lower is better)"""
+
+    ordering = ('search_rank', 'id')
+
+    def _match_expression(self, terms):
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def filter(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset
+        product_table = self.connection.ops.quote_name(queryset.model._meta.db_table)
+        weights = ', '.join(str(weight) for weight in SQLITE_BM25_WEIGHTS)
+        match = self._match_expression(terms)
+        # The rank is looked up by rowid for each matching product only
+        return queryset.filter(
+            id__in=RawSQL(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s', (match,)),
+        ).annotate(
+            search_rank=RawSQL(
+                f'SELECT bm25({SEARCH_TABLE}, {weights}) FROM {SEARCH_TABLE} '
+                f'WHERE {SEARCH_TABLE} MATCH %s AND rowid = {product_table}.id',
+                (match,),
+                output_field=FloatField(),
+            ),
+        )
+
+    def index(self, products):
+        rows = list(_documents(products))
+        if not rows:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_TABLE} (rowid, name, category, description) VALUES (%s, %s, %s, %s)',
+                rows,
+            )
+
+    def remove(self, product_ids):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+
+    def optimize(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')")
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """Weighted tsvector table with a GIN index, ranked with ts_rank_cd"""
+
+    # The rank is negated so that, as with bm25, lower sorts first
+    ordering = ('search_rank', 'id')
+
+    def _tsquery(self, terms):
+        return ' & '.join(f'{term}:*' for term in terms)
+
+    def filter(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset
+        product_table = self.connection.ops.quote_name(queryset.model._meta.db_table)
+        tsquery = self._tsquery(terms)
+        return queryset.filter(
+            id__in=RawSQL(
+                f"SELECT product_id FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('simple', %s)", (tsquery,),
+            ),
+        ).annotate(
+            search_rank=RawSQL(
+                f"SELECT -ts_rank_cd(document, to_tsquery('simple', %s)) FROM {SEARCH_TABLE} "
+                f"WHERE product_id = {product_table}.id",
+                (tsquery,),
+                output_field=FloatField(),
+            ),
+        )
+
+    def index(self, products):
+        rows = list(_documents(products))
+        if not rows:
+            return
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"""INSERT INTO {SEARCH_TABLE} (product_id, document) VALUES (
+                    %s,
+                    setweight(to_tsvector('simple', %s), 'A') ||
+                    setweight(to_tsvector('simple', %s), 'B') ||
+                    setweight(to_tsvector('simple', %s), 'C')
+                ) ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document""",
+                rows,
+            )
+
+    def remove(self, product_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {SEARCH_TABLE}')
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+_backends = {}
+
+
+def get_backend(using='default'):
+    """
+    Search backend for a database alias, falling back when the index table is missing.
+
+    Only a backend whose table was found is kept; the fallback is decided
+    again on every call, so the index is used as soon as its migration runs.
+    """
+    if using in _backends:
+        return _backends[using]
+    connection = connections[using]
+    backend_class = BACKENDS.get(connection.vendor, SearchBackend)
+    if backend_class is SearchBackend:
+        _backends[using] = SearchBackend(connection)
+    elif SEARCH_TABLE in connection.introspection.table_names():
+        _backends[using] = backend_class(connection)
+    else:
+        logger.warning(f"Search table {SEARCH_TABLE} missing on '{using}', falling back to icontains search")
+        return SearchBackend(connection)
+    return _backends[using]
+
+
+def search_products(queryset, query):
+    """
+    Filter a product queryset by a search query.
+
+    Returns the filtered queryset and the ordering to paginate it by
+    (None to keep the caller's default ordering).
+    """
+    backend = get_backend(queryset.db)
+    if not tokenize(query):
+        return queryset, None
+    return backend.filter(queryset, query), backend.ordering
+
+
+def index_products(products, using='default'):
+    get_backend(using).index(products)
+
+
+def remove_products(product_ids, using='default'):
+    get_backend(using).remove(product_ids)
@@ -0,0 +1,86 @@
+"""
+Session engines that skip unchanged writes.
+
+Django saves a session whenever it was marked modified, even when a view
+stored the value it already held (e.g. payment_retry setting the same
+order_id again). These stores remember a digest of the data as loaded
+and skip the save when nothing actually changed. Creating a session and
+cycling its key on login are always written.
+
+JRShop.sessions keeps sessions in django_session only. JRShop.cached_sessions
+also serves them from SESSION_CACHE_ALIAS, which is only safe with a cache
+every worker shares (Redis, Memcached): with the per-process local-memory
+cache a logout or change made in one worker would go unseen by the others.
+settings.SESSION_ENGINE picks between them.
+
+Expired rows are deleted in small batches by purge_expired_sessions
+(manage.py purge_sessions, or clearsessions which calls clear_expired),
+so no single statement scans or locks the whole table.
+"""
+import hashlib
+import time
+
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.contrib.sessions.models import Session
+from django.utils import timezone
+
+
+def purge_expired_sessions(batch_size=1000, limit=None, pause=0, now=None):
+    """Delete expired sessions oldest first, batch_size rows per statement; returns how many were deleted"""
+    now = now or timezone.now()
+    deleted = 0
+    while limit is None or deleted < limit:
+        size = batch_size if limit is None else min(batch_size, limit - deleted)
+        # expire_date is indexed, so each batch is found without a full scan
+        keys = list(
+            Session.objects.filter(expire_date__lt=now).order_by('expire_date').values_list('pk', flat=True)[:size]
+        )
+        if not keys:
+            break
+        deleted += Session.objects.filter(pk__in=keys).delete()[0]
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+class SkipUnchangedMixin:
+    """Skip saving a session whose data is what was loaded"""
+
+    _loaded_digest = None
+
+    def _digest(self, data):
+        return hashlib.md5(self.serializer().dumps(data)).digest()
+
+    def _unchanged(self, must_create):
+        return (not must_create and self.session_key is not None and self._loaded_digest is not None
+                and self._digest(self._session) == self._loaded_digest)
+
+    def load(self):
+        data = super().load()
+        self._loaded_digest = self._digest(data) if self.session_key is not None else None
+        return data
+
+    async def aload(self):
+        data = await super().aload()
+        self._loaded_digest = self._digest(data) if self.session_key is not None else None
+        return data
+
+    def save(self, must_create=False):
+        if self._unchanged(must_create):
+            return
+        super().save(must_create)
+        self._loaded_digest = self._digest(self._session)
+
+    async def asave(self, must_create=False):
+        if self._unchanged(must_create):
+            return
+        await super().asave(must_create)
+        self._loaded_digest = self._digest(self._session)
+
+    @classmethod
+    def clear_expired(cls):
+        purge_expired_sessions()
+
+
+class SessionStore(SkipUnchangedMixin, DBStore):
+    pass
@@ -0,0 +1,101 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import caching, images, search
+from .cart import invalidate_cart_summary, merge_items, read_anonymous_cart
+from .models import Category, Product, Rating
+
+SEARCH_FIELDS = {'name', 'description', 'category', 'category_id'}
+
+
+@receiver(pre_save, sender=Rating)
+def remember_previous_rating(sender, instance, raw=False, **kwargs):
+    """Keep the stored rating so an edit can be applied as a delta"""
+    instance._previous_rating = None
+    if instance.pk and not raw:
+        instance._previous_rating = (
+            Rating.objects.filter(pk=instance.pk).values('product_id', 'rating').first()
+        )
+
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous_rating', None)
+    if created or previous is None:
+        Product.apply_rating_delta(instance.product_id, 1, instance.rating)
+    elif previous['product_id'] != instance.product_id:
+        Product.apply_rating_delta(previous['product_id'], -1, -previous['rating'])
+        Product.apply_rating_delta(instance.product_id, 1, instance.rating)
+    elif previous['rating'] != instance.rating:
+        Product.apply_rating_delta(instance.product_id, 0, instance.rating - previous['rating'])
+
+
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, **kwargs):
+    Product.apply_rating_delta(instance.product_id, -1, -instance.rating)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, raw=False, update_fields=None, using='default', **kwargs):
+    """Keep the full-text index in sync; stock-only saves are skipped"""
+    if raw or (update_fields and not SEARCH_FIELDS & set(update_fields)):
+        return
+    search.index_products([instance], using=using)
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, using='default', **kwargs):
+    search.remove_products([instance.pk], using=using)
+
+
+@receiver(post_save, sender=Product)
+def render_product_images(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Render thumbnails of a new or replaced image once it is committed"""
+    if raw or (update_fields and 'image' not in update_fields):
+        return
+    images.schedule_product_images(instance)
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, raw=False, using='default', **kwargs):
+    """The category name is indexed with every product in it"""
+    if raw or created:
+        return
+    search.index_products(
+        instance.products.using(using).select_related('category').iterator(chunk_size=500),
+        using=using,
+    )
+
+
+# Cached catalog pages and fragments are keyed on versions; a bump makes
+# the next request rebuild them
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_caches(sender, instance, **kwargs):
+    caching.bump_versions('catalog', f'product:{instance.pk}')
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_caches(sender, instance, **kwargs):
+    caching.bump_versions('catalog', 'categories')
+
+
+@receiver([post_save, post_delete], sender=Rating)
+def invalidate_rating_caches(sender, instance, **kwargs):
+    names = {'catalog', f'product:{instance.product_id}'}
+    previous = getattr(instance, '_previous_rating', None)
+    if previous:
+        names.add(f"product:{previous['product_id']}")
+    caching.bump_versions(*names)
+
+
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    """Move what the visitor carted before logging in (user_login, register or allauth) into their cart"""
+    lines = read_anonymous_cart(request) if request is not None else {}
+    if lines:
+        merge_items(user, lines)
+        invalidate_cart_summary(user)
@@ -1,14 +1,308 @@
+import asyncio
+import itertools
 import requests
 import json
 import logging
+import random
 import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.urls import reverse
 from django.template.loader import render_to_string
 from django.core.mail import EmailMultiAlternatives
+from django.utils.html import strip_tags
+
+from . import instrumentation
+
+try:
+    import httpx
+except ImportError:  # async callers fall back to the sync client in a thread
+    httpx = None
 
 logger = logging.getLogger(__name__)
 
+# Gateway responses worth retrying for idempotent (GET) calls
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class GatewayUnavailable(requests.RequestException):
+    """Raised without a network call while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the gateway is down.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls are rejected for `reset_timeout` seconds. Then a single trial
+    call is let through; its success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_flight:
+                raise GatewayUnavailable("Payment gateway circuit is open")
+            # Half-open: let exactly one trial call through
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.error(f"Payment gateway circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+
+class GatewayClient:
+    """
+    Process-wide HTTP client for SSL Commerz.
+
+    Keeps a pooled keep-alive session, uses separate connect and read
+    timeouts, retries idempotent (GET) calls with jittered exponential
+    backoff and guards every call with a circuit breaker.
+    """
+
+    def __init__(self, breaker, connect_timeout=5, read_timeout=20, retries=3, backoff=0.3, pool_size=20):
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            backoff_jitter=backoff,
+            status_forcelist=RETRY_STATUSES,
+            # Payment initiation (POST) must never be replayed once sent
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @classmethod
+    def from_settings(cls, breaker):
+        return cls(
+            breaker,
+            connect_timeout=getattr(settings, 'SSLCOMMERZ_CONNECT_TIMEOUT', 5),
+            read_timeout=getattr(settings, 'SSLCOMMERZ_READ_TIMEOUT', 20),
+            retries=getattr(settings, 'SSLCOMMERZ_RETRIES', 3),
+            backoff=getattr(settings, 'SSLCOMMERZ_RETRY_BACKOFF', 0.3),
+            pool_size=getattr(settings, 'SSLCOMMERZ_POOL_SIZE', 20),
+        )
+
+    def request(self, method, url, **kwargs):
+        self.breaker.before_call()
+        healthy = False
+        try:
+            with instrumentation.timed('gateway'):
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            # A 4xx still proves the gateway is up; only 5xx counts against it
+            healthy = response.status_code < 500
+        finally:
+            # Any exception counts as a failure, and a half-open trial is
+            # always released
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        response.raise_for_status()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncGatewayClient:
+    """
+    asyncio counterpart of GatewayClient, built on httpx.
+
+    One instance per event loop; it shares the process-wide circuit
+    breaker with the sync client. Without httpx installed, calls are run
+    on the sync client in a worker thread instead.
+
+    Connections are spread over several small httpx pools, each gated by
+    a semaphore: httpcore rescans every queued request against every
+    connection whenever one frees up, which becomes CPU-bound with
+    hundreds of validations in flight on a single pool.
+    """
+
+    SHARD_SIZE = 16
+
+    def __init__(self, breaker, connect_timeout=5, read_timeout=20, retries=3, backoff=0.3,
+                 max_connections=500):
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff = backoff
+        self.shards = []
+        if httpx is not None:
+            timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+            size = min(self.SHARD_SIZE, max_connections)
+            limits = httpx.Limits(max_connections=size, max_keepalive_connections=size)
+            # Loading the CA bundle is slow; build one SSL context for all shards
+            ssl_context = httpx.create_ssl_context()
+            self.shards = [
+                (httpx.AsyncClient(verify=ssl_context, timeout=timeout, limits=limits), asyncio.Semaphore(size))
+                for _ in range(max(1, max_connections // size))
+            ]
+        self._next_shard = itertools.cycle(self.shards)
+
+    @classmethod
+    def from_settings(cls, breaker):
+        return cls(
+            breaker,
+            connect_timeout=getattr(settings, 'SSLCOMMERZ_CONNECT_TIMEOUT', 5),
+            read_timeout=getattr(settings, 'SSLCOMMERZ_READ_TIMEOUT', 20),
+            retries=getattr(settings, 'SSLCOMMERZ_RETRIES', 3),
+            backoff=getattr(settings, 'SSLCOMMERZ_RETRY_BACKOFF', 0.3),
+            max_connections=getattr(settings, 'SSLCOMMERZ_ASYNC_MAX_CONNECTIONS', 500),
+        )
+
+    async def request(self, method, url, **kwargs):
+        if not self.shards:
+            return await sync_to_async(get_gateway_client().request, thread_sensitive=False)(method, url, **kwargs)
+
+        self.breaker.before_call()
+        healthy = False
+        try:
+            response = await self._send(method, url, **kwargs)
+            healthy = response.status_code < 500
+        finally:
+            # As in the sync client: any exception, cancellation included,
+            # counts as a failure and releases a half-open trial
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        if response.is_error:
+            raise requests.HTTPError(f"{response.status_code} Error for url: {response.url}")
+        return response
+
+    async def _send(self, method, url, **kwargs):
+        # Same policy as the sync client: only GET is retried
+        attempts = 1 + (self.retries if method == 'GET' else 0)
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) + random.uniform(0, self.backoff))
+            client, slots = next(self._next_shard)
+            try:
+                async with slots:
+                    with instrumentation.timed('gateway'):
+                        response = await client.request(method, url, **kwargs)
+            except httpx.TimeoutException as e:
+                error = requests.Timeout(str(e))
+                continue
+            except httpx.TransportError as e:
+                error = requests.ConnectionError(str(e))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+                continue
+            return response
+        raise error
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+_breaker = None
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+_client_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """Return the breaker shared by the sync and async clients"""
+    global _breaker
+    if _breaker is None:
+        with _client_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    failure_threshold=getattr(settings, 'SSLCOMMERZ_CIRCUIT_FAILURE_THRESHOLD', 5),
+                    reset_timeout=getattr(settings, 'SSLCOMMERZ_CIRCUIT_RESET_SECONDS', 30),
+                )
+    return _breaker
+
+
+def get_gateway_client():
+    """Return the shared gateway client, creating it on first use"""
+    global _client
+    if _client is None:
+        breaker = get_circuit_breaker()
+        with _client_lock:
+            if _client is None:
+                _client = GatewayClient.from_settings(breaker)
+    return _client
+
+
+def get_async_gateway_client():
+    """Return the async gateway client bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncGatewayClient.from_settings(get_circuit_breaker())
+    return client
+
+
+CLIENT_SETTINGS = {
+    'SSLCOMMERZ_CONNECT_TIMEOUT', 'SSLCOMMERZ_READ_TIMEOUT', 'SSLCOMMERZ_RETRIES',
+    'SSLCOMMERZ_RETRY_BACKOFF', 'SSLCOMMERZ_POOL_SIZE', 'SSLCOMMERZ_ASYNC_MAX_CONNECTIONS',
+    'SSLCOMMERZ_CIRCUIT_FAILURE_THRESHOLD', 'SSLCOMMERZ_CIRCUIT_RESET_SECONDS',
+}
+
+
+@receiver(setting_changed)
+def reset_gateway_client(setting=None, **kwargs):
+    """Rebuild the clients when their settings change (tests)"""
+    global _breaker, _client
+    if setting is None or setting in CLIENT_SETTINGS:
+        with _client_lock:
+            if _client is not None:
+                _client.close()
+            _client = None
+            _breaker = None
+            _async_clients.clear()
+
 def validate_phone_number(phone):
     """Validate Bangladesh phone number format"""
     # Remove any spaces or dashes
@@ -20,27 +314,30 @@ def validate_phone_number(phone):
     logger.warning(f"Invalid phone number format: {phone}")
     return phone  # Return as-is, let SSL Commerz handle validation
 
-def generate_sslcommerz_payment(request, order):
-    """
-    Generate SSL Commerz payment request
-    
-    Args:
-        request: Django request object
-        order: Order instance
-        
-    Returns:
-        dict: SSL Commerz API response
-        
-    Raises:
-        requests.RequestException: If API request fails
-        ValueError: If response is invalid
-    """
+@contextmanager
+def _gateway_errors(context):
+    """Log gateway failures the same way for the sync and async calls"""
+    try:
+        yield
+    except requests.Timeout:
+        logger.error(f"SSL Commerz {context} timeout")
+        raise
+    except requests.RequestException as e:
+        logger.error(f"SSL Commerz {context} failed: {str(e)}")
+        raise
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse SSL Commerz {context} response: {str(e)}")
+        raise ValueError("Invalid response from payment gateway")
+
+
+def build_payment_data(request, order):
+    """Form data for an SSL Commerz payment session (no queries if the order total is annotated)"""
     tran_id = order.transaction_id or str(order.id)
     
     # Validate phone number
     phone = validate_phone_number(order.phone)
     
-    post_data = {
+    return {
         'store_id': settings.SSLCOMMERZ_STORE_ID,
         'store_passwd': settings.SSLCOMMERZ_STORE_PASSWORD,
         'total_amount': float(order.get_total_cost()),
@@ -62,53 +359,90 @@ def generate_sslcommerz_payment(request, order):
         'product_category': 'General',
         'product_profile': 'general',
     }
+
+
+def _payment_response(order, response):
+    response_data = response.json()
     
-    logger.info(f"Initiating SSL Commerz payment for Order #{order.id}, Transaction ID: {tran_id}")
+    # Validate response
+    if not isinstance(response_data, dict):
+        logger.error(f"Invalid response format from SSL Commerz: {response.text}")
+        raise ValueError("Invalid response format from payment gateway")
     
-    try:
-        # Get timeout from settings or use default
-        timeout = getattr(settings, 'SSLCOMMERZ_TIMEOUT', 30)
-        
-        response = requests.post(
-            settings.SSLCOMMERZ_PAYMENT_URL, 
-            data=post_data,
-            timeout=timeout
-        )
-        response.raise_for_status()
-        
-        response_data = response.json()
-        
-        # Validate response
-        if not isinstance(response_data, dict):
-            logger.error(f"Invalid response format from SSL Commerz: {response.text}")
-            raise ValueError("Invalid response format from payment gateway")
-        
-        # Check if request was successful
-        status = response_data.get('status')
-        if status == 'SUCCESS':
-            logger.info(f"SSL Commerz payment initiated successfully for Order #{order.id}")
-        else:
-            logger.warning(f"SSL Commerz payment initiation failed for Order #{order.id}: {response_data.get('failedreason', 'Unknown reason')}")
+    # Check if request was successful
+    status = response_data.get('status')
+    if status == 'SUCCESS':
+        logger.info(f"SSL Commerz payment initiated successfully for Order #{order.id}")
+    else:
+        logger.warning(f"SSL Commerz payment initiation failed for Order #{order.id}: {response_data.get('failedreason', 'Unknown reason')}")
+    
+    return response_data
+
+
+def generate_sslcommerz_payment(request, order):
+    """
+    Generate SSL Commerz payment request
+    
+    Args:
+        request: Django request object
+        order: Order instance
         
-        return response_data
+    Returns:
+        dict: SSL Commerz API response
         
-    except requests.Timeout:
-        logger.error(f"SSL Commerz payment request timeout for Order #{order.id}")
-        raise
-    except requests.RequestException as e:
-        logger.error(f"SSL Commerz payment request failed for Order #{order.id}: {str(e)}")
-        raise
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse SSL Commerz response for Order #{order.id}: {str(e)}")
-        raise ValueError("Invalid response from payment gateway")
+    Raises:
+        requests.RequestException: If API request fails
+        ValueError: If response is invalid
+    """
+    post_data = build_payment_data(request, order)
+    logger.info(f"Initiating SSL Commerz payment for Order #{order.id}, Transaction ID: {post_data['tran_id']}")
     
-def send_order_confirmation_email(order):
+    with _gateway_errors(f"payment request for Order #{order.id}"):
+        response = get_gateway_client().post(settings.SSLCOMMERZ_PAYMENT_URL, data=post_data)
+        return _payment_response(order, response)
+
+
+async def agenerate_sslcommerz_payment(request, order):
+    """Async version of generate_sslcommerz_payment; the order total must be annotated"""
+    post_data = build_payment_data(request, order)
+    logger.info(f"Initiating SSL Commerz payment for Order #{order.id}, Transaction ID: {post_data['tran_id']}")
+    
+    with _gateway_errors(f"payment request for Order #{order.id}"):
+        response = await get_async_gateway_client().post(settings.SSLCOMMERZ_PAYMENT_URL, data=post_data)
+        return _payment_response(order, response)
+    
+def build_order_confirmation_email(order):
+    """Confirmation email for a paid order; prefetch order items to avoid a query per line"""
     subject = f'Order Confirmation - Order #{order.id}'
-    message = render_to_string('shop/email/order_confirmation.html', {'order' : order}) # html code ke --> string e convert kore
+    message = render_to_string('JRShop/email/order_confirmation.html', {'order' : order}) # html code ke --> string e convert kore
     to = order.email
-    send_email = EmailMultiAlternatives(subject, '', to=[to])
-    send_email.attach_alternative(message, 'text/html')
-    send_email.send()
+    email = EmailMultiAlternatives(subject, strip_tags(message), to=[to])
+    email.attach_alternative(message, 'text/html')
+    return email
+
+
+def send_order_confirmation_email(order):
+    build_order_confirmation_email(order).send()
+
+
+def _validation_params(val_id):
+    return {
+        'val_id': val_id,
+        'store_id': settings.SSLCOMMERZ_STORE_ID,
+        'store_passwd': settings.SSLCOMMERZ_STORE_PASSWORD,
+        'v': 1,
+        'format': 'json',
+    }
+
+
+def _validation_response(val_id, response):
+    validation_data = response.json()
+    
+    # Log validation result
+    status = validation_data.get('status', 'UNKNOWN')
+    logger.info(f"SSL Commerz validation result for val_id {val_id}: {status}")
+    
+    return validation_data
 
 
 def validate_sslcommerz_payment(val_id):
@@ -127,40 +461,15 @@ def validate_sslcommerz_payment(val_id):
     """
     logger.info(f"Validating SSL Commerz payment with val_id: {val_id}")
     
-    params = {
-        'val_id': val_id,
-        'store_id': settings.SSLCOMMERZ_STORE_ID,
-        'store_passwd': settings.SSLCOMMERZ_STORE_PASSWORD,
-        'v': 1,
-        'format': 'json',
-    }
-    
-    try:
-        timeout = getattr(settings, 'SSLCOMMERZ_TIMEOUT', 30)
-        
-        response = requests.get(
-            settings.SSLCOMMERZ_VALIDATION_URL, 
-            params=params, 
-            timeout=timeout
-        )
-        response.raise_for_status()
-        
-        validation_data = response.json()
-        
-        # Log validation result
-        status = validation_data.get('status', 'UNKNOWN')
-        logger.info(f"SSL Commerz validation result for val_id {val_id}: {status}")
-        
-        return validation_data
-        
-    except requests.Timeout:
-        logger.error(f"SSL Commerz validation timeout for val_id: {val_id}")
-        raise
-    except requests.RequestException as e:
-        logger.error(f"SSL Commerz validation request failed for val_id {val_id}: {str(e)}")
-        raise
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse SSL Commerz validation response for val_id {val_id}: {str(e)}")
-        raise ValueError("Invalid validation response from payment gateway")
+    with _gateway_errors(f"validation request for val_id {val_id}"):
+        response = get_gateway_client().get(settings.SSLCOMMERZ_VALIDATION_URL, params=_validation_params(val_id))
+        return _validation_response(val_id, response)
+
+
+async def avalidate_sslcommerz_payment(val_id):
+    """Async version of validate_sslcommerz_payment"""
+    logger.info(f"Validating SSL Commerz payment with val_id: {val_id}")
     
-    
\ No newline at end of file
+    with _gateway_errors(f"validation request for val_id {val_id}"):
+        response = await get_async_gateway_client().get(settings.SSLCOMMERZ_VALIDATION_URL, params=_validation_params(val_id))
+        return _validation_response(val_id, response)
@@ -36,3 +36,40 @@ function dismissMessage(msg) {
     msg.classList.add('dismiss');
     setTimeout(() => msg.remove(), 500);
 }
+
+// Get CSRF token from cookie
+function getCookie(name) {
+    let cookieValue = null;
+    if (document.cookie && document.cookie !== '') {
+        const cookies = document.cookie.split(';');
+        for (let i = 0; i < cookies.length; i++) {
+            const cookie = cookies[i].trim();
+            if (cookie.substring(0, name.length + 1) === (name + '=')) {
+                cookieValue = decodeURIComponent(cookie.substring(name.length + 1));
+                break;
+            }
+        }
+    }
+    return cookieValue;
+}
+
+// Add-to-cart forms carry no {% csrf_token %}, so catalog pages stay cacheable.
+// The token is read from the csrftoken cookie when the form is sent; a first
+// visit that has no cookie yet gets one from the cart API.
+document.addEventListener('submit', async function(e) {
+    const form = e.target.closest('form.add-to-cart-form');
+    if (!form) return;
+    e.preventDefault();
+
+    let token = getCookie('csrftoken');
+    if (!token) {
+        await fetch('/api/cart/', { credentials: 'same-origin' });
+        token = getCookie('csrftoken');
+    }
+    const input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = 'csrfmiddlewaretoken';
+    input.value = token || '';
+    form.appendChild(input);
+    form.submit();
+});
@@ -2,22 +2,7 @@
 
 console.log('Cart.js loaded');
 
-// Get CSRF token from cookie
-function getCookie(name) {
-    let cookieValue = null;
-    if (document.cookie && document.cookie !== '') {
-        const cookies = document.cookie.split(';');
-        for (let i = 0; i < cookies.length; i++) {
-            const cookie = cookies[i].trim();
-            if (cookie.substring(0, name.length + 1) === (name + '=')) {
-                cookieValue = decodeURIComponent(cookie.substring(name.length + 1));
-                break;
-            }
-        }
-    }
-    return cookieValue;
-}
-
+// CSRF token from cookie (getCookie is in base.js)
 const csrftoken = getCookie('csrftoken');
 console.log('CSRF Token:', csrftoken ? 'Found' : 'Not found');
 
@@ -355,76 +340,98 @@ function removeCartItem(itemId) {
     }
 }
 
-function updateQuantityAJAX(itemId, quantity) {
-    const formData = new FormData();
-    formData.append('quantity', quantity);
-    
-    fetch(`/update-cart-quantity/${itemId}/`, {
-        method: 'POST',
+// Cart changes are batched: edits made within CART_SYNC_DELAY of each other
+// go to the server as one PATCH /api/cart/ request
+const CART_SYNC_DELAY = 400;
+const pendingChanges = {};
+let syncTimer = null;
+let syncInFlight = false;
+let cartVersion = parseInt(document.getElementById('cart-items-list')?.dataset.cartVersion) || 0;
+
+function queueCartChange(itemId, quantity, immediate = false) {
+    pendingChanges[itemId] = quantity;
+    clearTimeout(syncTimer);
+    syncTimer = setTimeout(syncCart, immediate ? 0 : CART_SYNC_DELAY);
+}
+
+function syncCart() {
+    if (syncInFlight) {
+        // Sent once the current request completes
+        syncTimer = setTimeout(syncCart, CART_SYNC_DELAY);
+        return;
+    }
+    const changes = Object.assign({}, pendingChanges);
+    Object.keys(changes).forEach(itemId => delete pendingChanges[itemId]);
+    if (Object.keys(changes).length === 0) return;
+
+    syncInFlight = true;
+    fetch('/api/cart/', {
+        method: 'PATCH',
         headers: {
             'X-CSRFToken': csrftoken,
+            'Content-Type': 'application/json',
         },
-        body: formData
+        body: JSON.stringify({ items: changes })
     })
     .then(response => {
-        if (!response.ok) {
+        if (!response.ok && response.status !== 409) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
         return response.json();
     })
     .then(data => {
-        console.log('Update response:', data);
-        if (data.success) {
-            const cartItem = document.querySelector(`[data-item-id="${itemId}"]`);
-            if (cartItem) {
-                const price = parseFloat(cartItem.dataset.productPrice);
-                const newTotal = price * quantity;
-                const totalValue = cartItem.querySelector('.item-total-value');
-                if (totalValue) {
-                    totalValue.textContent = newTotal.toFixed(2);
-                }
-            }
-            updateCartTotals();
-        } else {
-            console.error('Update failed:', data.error);
-            alert('Error updating cart: ' + (data.error || 'Unknown error'));
+        if (data.errors) {
+            alert('Error updating cart: ' + Object.values(data.errors).join(', '));
         }
+        applyCartState(data);
     })
     .catch(error => {
         console.error('Error updating cart:', error);
         alert('Error updating cart. Please try again.');
+    })
+    .finally(() => {
+        syncInFlight = false;
     });
 }
 
-function removeItemAJAX(itemId) {
-    const formData = new FormData();
-    
-    fetch(`/remove-from-cart/${itemId}/`, {
-        method: 'POST',
-        headers: {
-            'X-CSRFToken': csrftoken,
-        },
-        body: formData
-    })
-    .then(response => {
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-        }
-        return response.json();
-    })
-    .then(data => {
-        console.log('Remove response:', data);
-        if (data.success) {
+function applyCartState(data) {
+    // A response older than one already applied is ignored
+    if (data.version < cartVersion) return;
+    cartVersion = data.version;
+
+    const lines = {};
+    data.items.forEach(line => { lines[line.id] = line; });
+    document.querySelectorAll('.cart-item').forEach(cartItem => {
+        const itemId = cartItem.dataset.itemId;
+        const line = lines[itemId];
+        if (!line) {
             removeCartItem(itemId);
-        } else {
-            console.error('Remove failed:', data.error);
-            alert('Error removing item: ' + (data.error || 'Unknown error'));
+            return;
+        }
+        // Lines with edits still queued keep what the shopper typed
+        const input = cartItem.querySelector('.quantity-input');
+        if (input && !(itemId in pendingChanges)) {
+            input.value = line.quantity;
+            input.dataset.previousValue = line.quantity;
+        }
+        const totalValue = cartItem.querySelector('.item-total-value');
+        if (totalValue) {
+            totalValue.textContent = parseFloat(line.cost).toFixed(2);
         }
-    })
-    .catch(error => {
-        console.error('Error removing item:', error);
-        alert('Error removing item. Please try again.');
     });
+    updateCartTotals();
+}
+
+function updateLineTotal(itemId, quantity) {
+    const cartItem = document.querySelector(`[data-item-id="${itemId}"]`);
+    if (cartItem) {
+        const price = parseFloat(cartItem.dataset.productPrice);
+        const totalValue = cartItem.querySelector('.item-total-value');
+        if (totalValue) {
+            totalValue.textContent = (price * quantity).toFixed(2);
+        }
+    }
+    updateCartTotals();
 }
 
 // Initialize event listeners
@@ -447,7 +454,7 @@ function initializeCartEventListeners() {
         // If quantity is 0, remove the item
         if (quantity === 0) {
             if (confirm('Remove this item from cart?')) {
-                removeItemAJAX(itemId);
+                queueCartChange(itemId, 0, true);
             } else {
                 // Reset to previous value
                 this.value = this.dataset.previousValue || 1;
@@ -474,8 +481,9 @@ function initializeCartEventListeners() {
         cartItem.style.opacity = '0.7';
         this.style.background = '#f0f4ff';
         
-        // Update via AJAX
-        updateQuantityAJAX(itemId, quantity);
+        // Show the new total straight away; the server confirms it
+        updateLineTotal(itemId, quantity);
+        queueCartChange(itemId, quantity);
         
         setTimeout(() => {
             cartItem.style.opacity = '1';
@@ -494,7 +502,7 @@ function initializeCartEventListeners() {
             const itemId = this.dataset.itemId;
             console.log('Remove button clicked for item:', itemId);
             if (confirm('Remove this item from cart?')) {
-                removeItemAJAX(itemId);
+                queueCartChange(itemId, 0, true);
             }
         });
         
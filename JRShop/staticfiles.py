@@ -0,0 +1,150 @@
+"""
+Fingerprinted, pre-compressed static files served by the app itself.
+
+collectstatic (with CompressedManifestStaticFilesStorage) copies every
+file to STATIC_ROOT under a content-hashed name, e.g. base.3f2a9c1e.css,
+and writes a gzip copy (and a brotli one when the brotli package is
+installed) next to each text file. StaticFilesMiddleware then serves
+STATIC_ROOT from memory-indexed paths: the best encoding the client
+accepts, ETags, and a one-year immutable Cache-Control for hashed names,
+since their content can never change under the same URL.
+
+Run collectstatic on every deploy and restart the app afterwards; the
+index is built when the app starts.
+"""
+import gzip
+import logging
+import mimetypes
+import os
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils.http import http_date
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE = ('.css', '.js', '.map', '.json', '.svg', '.txt', '.xml', '.html', '.ico', '.ttf', '.otf', '.eot')
+
+# Compressed copies are only kept when they save at least this much
+MIN_SAVING = 0.05
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=60'
+
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Hashed file names, plus .gz and .br copies of text files"""
+
+    _reported = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            # Not collected (tests, or DEBUG off before collectstatic): the
+            # plain name still works through the staticfiles finders, but
+            # without a hash browsers may keep a stale copy after a deploy
+            if not settings.DEBUG:
+                self._report_unhashed(name)
+            return name
+
+    def _report_unhashed(self, name):
+        if self.hashed_files:
+            logger.warning(f"Static file {name} is missing from the manifest, serving it unhashed; "
+                           f"re-run collectstatic")
+        elif not self._reported:
+            # Once per process: without a manifest every file would report
+            self._reported = True
+            logger.warning(f"No static files manifest in {self.location}, serving unhashed names; "
+                           f"run collectstatic on deploy")
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in sorted({*paths, *self.hashed_files.values()}):
+            if name.endswith(COMPRESSIBLE):
+                for compressed in self.compress(name):
+                    yield name, compressed, True
+
+    def compress(self, name):
+        with self.open(name) as original:
+            data = original.read()
+        copies = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            copies.append(('.br', brotli.compress(data, quality=11)))
+        for extension, compressed in copies:
+            if len(compressed) > len(data) * (1 - MIN_SAVING):
+                continue
+            if self.exists(name + extension):
+                self.delete(name + extension)
+            yield self._save(name + extension, ContentFile(compressed))
+
+
+class StaticFile:
+    """A collected file and its compressed copies, ready to serve"""
+
+    def __init__(self, path, immutable):
+        stat = os.stat(path)
+        self.path = path
+        content_type, _ = mimetypes.guess_type(path)
+        if (content_type or '').startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type or 'application/octet-stream'
+        self.etag = f'W/"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+        self.last_modified = http_date(stat.st_mtime)
+        self.cache_control = IMMUTABLE if immutable else REVALIDATE
+        self.encodings = [
+            (encoding, path + extension) for encoding, extension in ENCODINGS if os.path.exists(path + extension)
+        ]
+
+    def respond(self, request):
+        if self.etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            accepted = {
+                token.split(';')[0].strip() for token in request.headers.get('Accept-Encoding', '').split(',')
+            }
+            path, encoding = next(
+                ((path, encoding) for encoding, path in self.encodings if encoding in accepted), (self.path, None)
+            )
+            response = FileResponse(open(path, 'rb'), content_type=self.content_type)
+            if encoding:
+                response['Content-Encoding'] = encoding
+            response['Last-Modified'] = self.last_modified
+        response['ETag'] = self.etag
+        response['Cache-Control'] = self.cache_control
+        if self.encodings:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+
+def index_static_files():
+    """Map each URL under STATIC_URL to its collected file, empty if nothing was collected"""
+    root = settings.STATIC_ROOT
+    # Files on a CDN or another host are not ours to serve
+    if not root or not os.path.isdir(root) or not settings.STATIC_URL.startswith('/'):
+        return {}
+    storage = CompressedManifestStaticFilesStorage(location=root)
+    hashed = set(storage.hashed_files.values())
+    compressed = tuple(extension for _, extension in ENCODINGS)
+
+    files = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            if name.endswith(compressed) or name == storage.manifest_name:
+                continue
+            files[settings.STATIC_URL + name] = StaticFile(path, immutable=name in hashed)
+    logger.info(f"Serving {len(files)} static files from {root}")
+    return files
@@ -0,0 +1,57 @@
+"""Background job handlers, run by manage.py run_jobs"""
+import logging
+
+from django.core.mail import get_connection
+
+from .jobs import task
+from .models import Order
+from .orders import finalize_payment
+from .payments import is_valid, validate_payment
+from .sslcommerz import build_order_confirmation_email
+
+logger = logging.getLogger(__name__)
+
+
+@task()
+def process_ipn(tran_id, val_id):
+    """Validate an IPN recorded by sslcommerz_ipn and mark its order paid"""
+    order = Order.objects.filter(transaction_id=tran_id).first()
+    if order is None:
+        logger.warning(f"IPN for non-existent order: tran_id={tran_id}")
+        return
+    if order.paid:
+        logger.info(f"IPN for already paid Order {order.id}")
+        return
+
+    # Gateway errors propagate so the job is retried with backoff
+    validation = validate_payment(val_id, order)
+    if not is_valid(validation):
+        logger.warning(f"IPN invalid status for Order {order.id}: {validation.get('status')}")
+        return
+
+    # The redirect may have beaten us to it
+    if finalize_payment(order):
+        logger.info(f"IPN: Order {order.id} marked as paid")
+
+
+@task(batch=True)
+def send_order_confirmation(payloads):
+    """
+    Send the confirmation emails of a batch of paid orders over one
+    connection; a failed email is retried on its own, without resending
+    the others.
+    """
+    orders = Order.objects.filter(pk__in={payload['order_id'] for payload in payloads}).with_totals().with_items()
+    orders = {order.pk: order for order in orders}
+    failed = {}
+    with get_connection() as connection:
+        for index, payload in enumerate(payloads):
+            order = orders.get(payload['order_id'])
+            if order is None:
+                continue
+            try:
+                connection.send_messages([build_order_confirmation_email(order)])
+            except Exception as e:
+                failed[index] = e
+    logger.info(f"Sent {len(orders) - len(failed)} order confirmation email(s), {len(failed)} failed")
+    return failed
@@ -1,4 +1,8 @@
 from django import template
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+from JRShop import images
 
 register = template.Library()
 
@@ -14,3 +18,26 @@ def is_provider_configured(providers, provider_id):
         if provider.id == provider_id:
             return True
     return False
+
+
+@register.simple_tag
+def product_picture(product, variant, sizes, css_class='', lazy=True):
+    """
+    A product image as a <picture> offering the WebP and JPEG renderings
+    of a variant, or the original until they exist.
+    Usage: {% product_picture product 'card' '300px' 'product-image' %}
+    """
+    attributes = format_html(
+        'alt="{}" class="{}"{}', product.name, css_class,
+        mark_safe(' loading="lazy" decoding="async"') if lazy else '',
+    )
+    webp = images.srcset(product, variant, 'webp')
+    if not webp:
+        return format_html('<img src="{}" {}>', product.image.url, attributes)
+    return format_html(
+        '<picture class="responsive-image">'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" {}>'
+        '</picture>',
+        webp, sizes, images.fallback_url(product, variant), images.srcset(product, variant, 'jpeg'), sizes, attributes,
+    )
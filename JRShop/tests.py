@@ -1,3 +1,1329 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import io
+import json
+import logging
+import os
+import smtplib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.contrib.messages import get_messages
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core import mail
+from django.core.management import call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.template import RequestContext, Template
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from JRShop import instrumentation, jobs, search
+from JRShop.caching import VERSION_PREFIX, get_version
+from JRShop.cart import add_item, get_cart_summary
+from JRShop.images import VARIANTS
+from JRShop.middleware import ReplicaRoutingMiddleware
+from JRShop.models import (
+    Cart, CartItem, Category, CustomerStats, Job, Order, OrderItem, PaymentValidation, Product, Rating,
+)
+import requests
+from PIL import Image
+from asgiref.sync import sync_to_async
+
+from JRShop.sslcommerz import (
+    CircuitBreaker, GatewayClient, GatewayUnavailable, avalidate_sslcommerz_payment, get_gateway_client,
+    validate_sslcommerz_payment,
+)
+from JRShop.payments import _lock_key, avalidate_payment, validate_payment
+from JRShop.pagination import CursorPaginator, EstimatedCountPaginator, InvalidCursor
+from JRShop.orders import (
+    EmptyCart, OutOfStock, finalize_payment, order_summary, place_order, release_expired_reservations,
+    release_reservation,
+)
+from JRShop.routers import PIN_COOKIE, ReplicaRouter, pin_primary
+from JRShop.search import search_products
+from JRShop.staticfiles import CompressedManifestStaticFilesStorage
+from JRShop.sessions import purge_expired_sessions
+
+
+ORDER_DETAILS = {
+    'first_name': 'Jane', 'last_name': 'Doe', 'email': 'buyer@example.com',
+    'phone': '01712345678', 'address': 'Road 1', 'postal_code': '1200', 'city': 'Dhaka',
+}
+
+
+class ShopTestCase(TestCase):
+    """Shared fixtures: a logged-in user and a small catalog"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buyer', 'buyer@example.com', 'secret-pass-123')
+        cls.category = Category.objects.create(name='Gadgets', slug='gadgets', description='Gadgets')
+        cls.products = [
+            Product.objects.create(
+                name=f'Product {i}', slug=f'product-{i}', category=cls.category,
+                description='A product', price=Decimal('100.00') + i, stock=50, image='products/test.png',
+            )
+            for i in range(6)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def fill_cart(self, lines):
+        cart, _ = Cart.objects.get_or_create(user=self.user)
+        for product in self.products[:lines]:
+            CartItem.objects.create(cart=cart, product=product, quantity=2)
+        return cart
+
+    def create_order(self, lines):
+        order = Order.objects.create(user=self.user, **ORDER_DETAILS)
+        for product in self.products[:lines]:
+            OrderItem.objects.create(order=order, product=product, quantity=2, price=product.price)
+        return order
+
+
+class QueryCountTests(ShopTestCase):
+    """Cart, checkout and order pages run a fixed number of queries per request"""
+
+    def assertQueriesIndependentOfLines(self, num, make_url):
+        for lines in (1, 5):
+            with self.subTest(lines=lines):
+                url = make_url(lines)
+                with self.assertNumQueries(num):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                CartItem.objects.all().delete()
+                cache.clear()
+
+    def test_view_cart(self):
+        def make_url(lines):
+            self.fill_cart(lines)
+            return reverse('view_cart')
+        # session, user, cart, cart items + products, cart summary
+        self.assertQueriesIndependentOfLines(5, make_url)
+
+    def test_add_to_cart(self):
+        url = reverse('add_to_cart', args=[self.products[0].pk])
+        for message in ('added to cart', 'Updated'):
+            # session, user, product, cart upsert, line upsert, version
+            with self.assertNumQueries(6):
+                response = self.client.post(url, follow=False)
+            self.assertEqual(response.status_code, 302)
+            self.assertIn(message, str(list(get_messages(response.wsgi_request))[-1]))
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 2)
+
+    def test_checkout_page(self):
+        def make_url(lines):
+            self.fill_cart(lines)
+            return reverse('checkout')
+        self.assertQueriesIndependentOfLines(5, make_url)
+
+    def test_payment_success_page(self):
+        def make_url(lines):
+            return reverse('payment_success', args=[self.create_order(lines).id])
+        # session, user, order with its total, order items + products
+        self.assertQueriesIndependentOfLines(4, make_url)
+
+    def test_profile_page(self):
+        def make_url(lines):
+            for _ in range(lines):
+                self.create_order(lines)
+            return reverse('profile')
+        # session, user, order summary, a page of orders with totals, their
+        # items + products, cart summary
+        self.assertQueriesIndependentOfLines(6, make_url)
+
+    def test_profile_order_history_is_paginated(self):
+        orders = [self.create_order(1) for _ in range(12)]
+        response = self.client.get(reverse('profile'))
+        self.assertEqual([order.pk for order in response.context['orders']], [o.pk for o in orders[::-1][:10]])
+        self.assertEqual(response.context['summary']['total_orders'], 12)
+        response = self.client.get(f"{reverse('profile')}?{response.context['next_query']}")
+        self.assertEqual([order.pk for order in response.context['orders']], [orders[1].pk, orders[0].pk])
+
+    def test_order_total(self):
+        order = self.create_order(3)
+        expected = sum(p.price * 2 for p in self.products[:3])
+        self.assertEqual(Order.objects.with_totals().get(pk=order.pk).get_total_cost(), expected)
+        with self.assertNumQueries(1):
+            self.assertEqual(order.get_total_cost(), expected)
+
+
+class AdminChangelistTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin-pass-123'))
+
+    def test_changelists_run_fixed_queries(self):
+        for model in (Order, OrderItem, CartItem):
+            url = reverse(f'admin:JRShop_{model._meta.model_name}_changelist')
+            with self.subTest(model=model.__name__):
+                counts = []
+                for lines in (1, 5):
+                    self.create_order(lines)
+                    self.fill_cart(lines)
+                    with CaptureQueriesContext(connection) as queries:
+                        self.assertEqual(self.client.get(url).status_code, 200)
+                    counts.append(len(queries))
+                    CartItem.objects.all().delete()
+                self.assertEqual(counts[0], counts[1])
+
+    def test_unfiltered_count_uses_the_estimate(self):
+        self.create_order(5)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        items = OrderItem.objects.order_by('pk')
+        with override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=0):
+            OrderItem.objects.all().delete()
+            # Still the 5 rows counted by ANALYZE
+            self.assertEqual(EstimatedCountPaginator(items, 10).count, 5)
+            self.assertEqual(EstimatedCountPaginator(items.filter(quantity=2), 10).count, 0)
+        self.assertEqual(EstimatedCountPaginator(items, 10).count, 0)
+
+
+class CursorPaginationTests(ShopTestCase):
+    """Cursors walk every row exactly once, both ways, even across ties on the sort key"""
+
+    def setUp(self):
+        super().setUp()
+        # Every product shares one created_at, so only the id breaks ties
+        Product.objects.update(created_at=timezone.now())
+        self.expected = list(Product.objects.order_by('-id').values_list('id', flat=True))
+
+    def test_pages_cover_every_row_once(self):
+        paginator = CursorPaginator(Product.objects.all(), per_page=4)
+        first = paginator.page()
+        self.assertFalse(first.has_previous)
+        second = paginator.page(after=first.next_cursor)
+        self.assertFalse(second.has_next)
+        self.assertEqual([p.id for p in first] + [p.id for p in second], self.expected)
+        back = paginator.page(before=second.previous_cursor)
+        self.assertEqual([p.id for p in back], [p.id for p in first])
+        self.assertFalse(back.has_previous)
+
+    def test_invalid_cursors(self):
+        paginator = CursorPaginator(Product.objects.all())
+        valid = paginator.encode_cursor(self.products[0])
+        tampered = base64.urlsafe_b64encode(b'["yesterday",1]').decode()
+        for cursor in ('garbage!', valid[:-3], tampered, base64.urlsafe_b64encode(b'[1]').decode()):
+            with self.subTest(cursor=cursor), self.assertRaises(InvalidCursor):
+                paginator.page(after=cursor)
+
+    def get_api(self, **params):
+        response = self.client.get(reverse('product_list_api'), params)
+        if response.status_code != 200:
+            return response.status_code, None
+        return 200, json.loads(b''.join(response.streaming_content))
+
+    def test_api_pages(self):
+        _, first = self.get_api(limit=4)
+        self.assertIsNotNone(first['next'])
+        _, second = self.get_api(limit=4, after=first['next'])
+        self.assertIsNone(second['next'])
+        self.assertEqual([p['id'] for p in first['results'] + second['results']], self.expected)
+        self.assertEqual(self.get_api(after='garbage!'), (400, None))
+        self.assertEqual(self.get_api(limit='many'), (400, None))
+
+    def test_non_finite_filters_are_ignored(self):
+        for value in ('NaN', 'Infinity', '-inf', 'sNaN'):
+            with self.subTest(value=value):
+                status, page = self.get_api(min_price=value, rating=value)
+                self.assertEqual((status, len(page['results'])), (200, 6))
+                self.assertEqual(self.client.get(reverse('product_list'), {'max_price': value}).status_code, 200)
+
+
+class RatingStatsTests(ShopTestCase):
+    """Rating saves and deletes keep the product's count, sum and average in step"""
+
+    def stats(self, product):
+        product.refresh_from_db()
+        return product.rating_count, product.rating_sum, product.rating_avg
+
+    def rate(self, product, score, username):
+        user = User.objects.create_user(username, f'{username}@example.com', 'secret-pass-123')
+        return Rating.objects.create(product=product, user=user, rating=score, comment='Fine')
+
+    def test_deltas(self):
+        product, other = self.products[:2]
+        first = self.rate(product, 5, 'first')
+        second = self.rate(product, 4, 'second')
+        third = self.rate(product, 4, 'third')
+        self.assertEqual(self.stats(product), (3, 13, Decimal('4.33')))
+
+        third.rating = 2
+        third.save()
+        self.assertEqual(self.stats(product), (3, 11, Decimal('3.67')))
+
+        # Moving a rating to another product shifts both
+        second.product = other
+        second.save()
+        self.assertEqual(self.stats(product), (2, 7, Decimal('3.50')))
+        self.assertEqual(self.stats(other), (1, 4, Decimal('4.00')))
+
+        first.delete()
+        third.delete()
+        self.assertEqual(self.stats(product), (0, 0, Decimal('0.00')))
+
+    def test_rebuild_rating_stats(self):
+        product = self.products[0]
+        for score, username in ((5, 'first'), (4, 'second'), (4, 'third')):
+            self.rate(product, score, username)
+        Product.objects.update(rating_count=9, rating_sum=9, rating_avg=1)
+        call_command('rebuild_rating_stats', batch_size=2, stdout=io.StringIO())
+        self.assertEqual(self.stats(product), (3, 13, Decimal('4.33')))
+        self.assertEqual(self.stats(self.products[1]), (0, 0, Decimal('0.00')))
+
+
+class SearchTests(ShopTestCase):
+    """The full-text index follows product and category changes"""
+
+    def search(self, query):
+        products, ordering = search_products(Product.objects.all(), query)
+        return [product.slug for product in products.order_by(*ordering)]
+
+    def test_index_follows_saves_and_deletes(self):
+        product = self.products[0]
+        product.name = 'Walnut Desk'
+        product.save()
+        self.assertEqual(self.search('walnut'), ['product-0'])
+        self.category.name = 'Widgets'
+        self.category.save()
+        self.assertEqual(len(self.search('widgets')), 6)
+        self.assertEqual(self.search('gadgets'), [])
+        product.delete()
+        self.assertEqual(self.search('walnut'), [])
+        self.assertEqual(len(self.search('widgets')), 5)
+
+    def test_last_term_matches_as_prefix(self):
+        self.assertEqual(len(self.search('gadg')), 6)
+        self.assertEqual(self.search('product 3'), ['product-3'])
+        self.assertEqual(self.search('xyz'), [])
+
+    def test_name_matches_rank_first(self):
+        for slug, name, description in (('rug', 'Rug', 'Goes under a lamp'), ('lamp', 'Desk Lamp', 'Bright')):
+            Product.objects.create(name=name, slug=slug, category=self.category, description=description,
+                                   price=10, stock=1, image='products/test.png')
+        self.assertEqual(self.search('lamp'), ['lamp', 'rug'])
+
+    def test_results_page_by_rank(self):
+        products, ordering = search_products(Product.objects.all(), 'product')
+        paginator = CursorPaginator(products, per_page=4, ordering=ordering)
+        first = paginator.page()
+        second = paginator.page(after=first.next_cursor)
+        self.assertEqual(sorted(p.slug for p in [*first, *second]), sorted(p.slug for p in self.products))
+
+    def test_reindex_command(self):
+        search.get_backend().clear()
+        self.assertEqual(self.search('product'), [])
+        call_command('reindex_products', batch_size=4, stdout=io.StringIO())
+        self.assertEqual(len(self.search('product')), 6)
+
+    def test_fallback_is_not_kept(self):
+        search._backends.clear()
+        with mock.patch.object(connection.introspection, 'table_names', return_value=[]), \
+                self.assertLogs('JRShop.search', 'WARNING'):
+            self.assertIs(type(search.get_backend()), search.SearchBackend)
+        self.assertIsInstance(search.get_backend(), search.SQLiteSearchBackend)
+
+
+class CheckoutReservationTests(ShopTestCase):
+
+    def test_checkout_reserves_stock_in_fixed_queries(self):
+        for lines in (1, 5):
+            with self.subTest(lines=lines):
+                self.fill_cart(lines)
+                # session, user, cart, items; one transaction reading the cart,
+                # locking products, reserving stock and inserting the order and
+                # its lines; session save
+                with self.assertNumQueries(15):
+                    response = self.client.post(reverse('checkout'), ORDER_DETAILS)
+                self.assertRedirects(response, reverse('payment_process'), fetch_redirect_response=False)
+                order = Order.objects.latest('id')
+                self.assertTrue(order.stock_reserved)
+                self.assertEqual(order.order_items.count(), lines)
+                self.assertFalse(CartItem.objects.exists())
+                Product.objects.update(stock=50)
+
+    def test_out_of_stock_writes_nothing(self):
+        cart = self.fill_cart(2)
+        Product.objects.filter(pk=self.products[1].pk).update(stock=1)
+        with self.assertRaises(OutOfStock):
+            place_order(cart, Order(user=self.user, **ORDER_DETAILS))
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock, 50)
+        self.assertEqual(cart.items.count(), 2)
+
+    def test_expired_reservation_is_released_once(self):
+        order = place_order(self.fill_cart(1), Order(user=self.user, **ORDER_DETAILS))
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock, 48)
+        self.assertEqual(release_expired_reservations(), 0)
+        later = timezone.now() + timedelta(days=1)
+        self.assertEqual(release_expired_reservations(now=later), 1)
+        self.assertEqual(release_expired_reservations(now=later), 0)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock, 50)
+        order.refresh_from_db()
+        self.assertFalse(order.stock_reserved)
+
+    def test_release_restores_every_line_in_one_update(self):
+        order = place_order(self.fill_cart(5), Order(user=self.user, **ORDER_DETAILS))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(release_reservation(order))
+        product_table = Product._meta.db_table
+        self.assertEqual(sum(q['sql'].startswith(f'UPDATE "{product_table}"') for q in queries.captured_queries), 1)
+        self.assertEqual(set(Product.objects.values_list('stock', flat=True)), {50})
+
+    def test_cart_emptied_during_checkout(self):
+        cart = self.fill_cart(1)
+
+        def emptied_in_another_tab(cart, order):
+            CartItem.objects.filter(cart=cart).delete()
+            return place_order(cart, order)
+
+        with mock.patch('JRShop.views.place_order', emptied_in_another_tab):
+            response = self.client.post(reverse('checkout'), ORDER_DETAILS)
+        self.assertRedirects(response, reverse('view_cart'), fetch_redirect_response=False)
+        self.assertIn('empty', str(list(get_messages(response.wsgi_request))[-1]))
+        self.assertFalse(Order.objects.exists())
+        with self.assertRaises(EmptyCart):
+            place_order(cart, Order(user=self.user, **ORDER_DETAILS))
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """Many buyers checking out the last units of one SKU at once"""
+
+    BUYERS = 200
+    STOCK = 25
+
+    def test_no_overselling(self):
+        category = Category.objects.create(name='Sale', slug='sale', description='Sale')
+        product = Product.objects.create(
+            name='Flash Deal', slug='flash-deal', category=category, description='Hot',
+            price=Decimal('10.00'), stock=self.STOCK, image='products/test.png',
+        )
+        carts = []
+        for i in range(self.BUYERS):
+            cart = Cart.objects.create(user=User.objects.create(username=f'buyer{i}'))
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+            carts.append(cart)
+
+        start = threading.Barrier(self.BUYERS)
+        sold = []
+
+        def checkout(cart):
+            try:
+                start.wait()
+                place_order(cart, Order(user_id=cart.user_id, **ORDER_DETAILS))
+                sold.append(cart.pk)
+            except OutOfStock:
+                pass
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(cart,)) for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(len(sold), self.STOCK)
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(OrderItem.objects.filter(product=product).count(), self.STOCK)
+
+
+class ConcurrentAddToCartTests(TransactionTestCase):
+    """Many clicks on one product at once, starting from a user without a cart"""
+
+    CLICKS = 60
+    STOCK = 40
+
+    def test_no_lost_increments_or_extra_carts(self):
+        user = User.objects.create(username='clicker')
+        category = Category.objects.create(name='Sale', slug='sale', description='Sale')
+        product = Product.objects.create(
+            name='Flash Deal', slug='flash-deal', category=category, description='Hot',
+            price=Decimal('10.00'), stock=self.STOCK, image='products/test.png',
+        )
+
+        start = threading.Barrier(self.CLICKS)
+        quantities = []
+
+        def click():
+            try:
+                start.wait()
+                quantities.append(add_item(user, product.pk))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=click) for _ in range(self.CLICKS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(Cart.objects.filter(user=user).count(), 1)
+        self.assertEqual(CartItem.objects.get(cart__user=user).quantity, self.STOCK)
+        # Every successful click saw its own increment; the rest hit the stock cap
+        self.assertEqual(sorted(q for q in quantities if q), list(range(1, self.STOCK + 1)))
+        self.assertEqual(quantities.count(None), self.CLICKS - self.STOCK)
+
+
+class CartApiTests(ShopTestCase):
+    """PATCH /api/cart/ applies a batch of quantity changes all or nothing"""
+
+    def patch(self, items):
+        return self.client.patch(reverse('cart_api'), json.dumps({'items': items}), content_type='application/json')
+
+    def test_batch_is_applied_in_fixed_queries(self):
+        cart = self.fill_cart(3)
+        first, second, third = cart.items.order_by('id')
+        # session, user, savepoint, locked cart, lines + products, delete,
+        # bulk update, version, release; then the cart summary invalidation
+        with self.assertNumQueries(9):
+            response = self.patch({first.pk: 5, second.pk: 0, third.pk: 1})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['version'], 1)
+        self.assertEqual([(line['id'], line['quantity']) for line in data['items']], [(first.pk, 5), (third.pk, 1)])
+        self.assertEqual(Decimal(data['subtotal']), self.products[0].price * 5 + self.products[2].price)
+        self.assertEqual(dict(cart.items.values_list('id', 'quantity')), {first.pk: 5, third.pk: 1})
+
+    def test_conflict_applies_nothing(self):
+        cart = self.fill_cart(2)
+        first, second = cart.items.order_by('id')
+        for changes in ({first.pk: 3, second.pk: 51}, {first.pk: 3, 999999: 1}):
+            with self.subTest(changes=changes):
+                response = self.patch(changes)
+                self.assertEqual(response.status_code, 409)
+                self.assertEqual(len(response.json()['errors']), 1)
+                self.assertEqual(response.json()['version'], 0)
+                self.assertEqual(set(cart.items.values_list('quantity', flat=True)), {2})
+
+    def test_unavailable_products_cannot_be_raised(self):
+        cart = self.fill_cart(1)
+        item = cart.items.get()
+        Product.objects.filter(pk=item.product_id).update(available=False)
+        response = self.patch({item.pk: 3})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['errors'], {str(item.pk): "No longer available"})
+        # Lowering or removing the line is still allowed
+        self.assertEqual(self.patch({item.pk: 1}).status_code, 200)
+
+    def test_version_moves_only_when_lines_change(self):
+        cart = self.fill_cart(1)
+        item = cart.items.get()
+        version = lambda: Cart.objects.get(pk=cart.pk).version
+        self.assertEqual(self.patch({item.pk: 2}).json()['version'], 0)
+        Product.objects.filter(pk=item.product_id).update(stock=2)
+        self.assertIsNone(add_item(self.user, item.product_id))
+        self.assertEqual(version(), 0)
+
+        self.client.post(reverse('update_cart_quantity', args=[item.pk]), {'quantity': 1})
+        self.assertEqual(version(), 1)
+        self.client.post(reverse('remove_from_cart', args=[item.pk]))
+        self.assertEqual(version(), 2)
+        self.assertFalse(cart.items.exists())
+
+    def test_bad_requests(self):
+        self.fill_cart(1)
+        for body in ('not json', '{"items": [1, 2]}', '{"items": {"1": -1}}', '{}'):
+            with self.subTest(body=body):
+                response = self.client.patch(reverse('cart_api'), body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+
+
+class CartSummaryTests(ShopTestCase):
+    """The navbar badge comes from a cached summary that every cart change drops"""
+
+    def assertSummaryCount(self, count):
+        self.assertEqual(get_cart_summary(self.user).count, count)
+
+    def test_badge_renders_without_queries_on_cache_hit(self):
+        self.fill_cart(2)
+        self.assertSummaryCount(2)
+        request = RequestFactory().get('/')
+        request.user = self.user
+        badge = Template('{% if cart_items_count %}<span class="cart-badge">{{ cart_items_count }}</span>{% endif %}')
+        with self.assertNumQueries(0):
+            self.assertEqual(badge.render(RequestContext(request)), '<span class="cart-badge">2</span>')
+
+    def test_cart_changes_invalidate_the_summary(self):
+        self.assertSummaryCount(0)
+        self.client.post(reverse('add_to_cart', args=[self.products[0].pk]))
+        self.assertSummaryCount(1)
+
+        self.client.post(reverse('remove_from_cart', args=[CartItem.objects.get().pk]))
+        self.assertSummaryCount(0)
+
+        for product in self.products[:3]:
+            self.client.post(reverse('add_to_cart', args=[product.pk]))
+        self.assertSummaryCount(3)
+        # Clearing the cart through the API
+        items = {item.pk: 0 for item in CartItem.objects.all()}
+        self.client.patch(reverse('cart_api'), json.dumps({'items': items}), content_type='application/json')
+        self.assertSummaryCount(0)
+
+        self.client.post(reverse('add_to_cart', args=[self.products[0].pk]))
+        self.assertSummaryCount(1)
+        self.client.post(reverse('checkout'), ORDER_DETAILS)
+        self.assertSummaryCount(0)
+
+
+class AnonymousCartTests(ShopTestCase):
+    """Visitors who are not logged in cart into a signed cookie, merged on login"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_browse_and_cart_without_writes(self):
+        product = self.products[0]
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('add_to_cart', args=[product.pk]))
+            self.client.post(reverse('add_to_cart', args=[product.pk]))
+            self.client.post(reverse('add_to_cart', args=[self.products[1].pk]))
+            response = self.client.get(reverse('view_cart'))
+            self.assertEqual([(item.product, item.quantity) for item in response.context['cart_items']],
+                             [(product, 2), (self.products[1], 1)])
+            response = self.client.patch(reverse('cart_api'), json.dumps({'items': {product.pk: 5, self.products[1].pk: 0}}),
+                                         content_type='application/json')
+            self.assertEqual([(line['product_id'], line['quantity']) for line in response.json()['items']],
+                             [(product.pk, 5)])
+            response = self.client.get(reverse('product_detail', args=[product.slug]))
+            self.assertTrue(response.context['is_in_cart'])
+            self.assertEqual(response.context['cart_items_count'], 1)
+        writes = [q['sql'] for q in queries.captured_queries if not q['sql'].lstrip().upper().startswith('SELECT')]
+        self.assertEqual(writes, [])
+        self.assertFalse(Cart.objects.exists())
+
+    def test_cart_cookie_bypasses_the_page_cache(self):
+        url = reverse('product_detail', args=[self.products[0].slug])
+        self.client.get(url)
+        self.client.post(reverse('add_to_cart', args=[self.products[0].pk]))
+        self.assertContains(self.client.get(url), 'Already Added')
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies['cart'] = f'{self.products[0].pk}:3'
+        self.assertEqual(list(self.client.get(reverse('view_cart')).context['cart_items']), [])
+
+    def test_login_merges_the_cookie_cart(self):
+        self.fill_cart(1)
+        for product in self.products[:2]:
+            self.client.post(reverse('add_to_cart', args=[product.pk]))
+        self.client.post(reverse('add_to_cart', args=[self.products[0].pk]))
+        Product.objects.filter(pk=self.products[1].pk).update(stock=0)
+
+        response = self.client.post(reverse('login'), {'email': 'buyer@example.com', 'password': 'secret-pass-123'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies['cart'].value, '')
+        # 2 saved + 2 from the cookie; the sold-out product is skipped
+        self.assertEqual(dict(CartItem.objects.filter(cart__user=self.user).values_list('product_id', 'quantity')),
+                         {self.products[0].pk: 4})
+
+
+class SessionTests(ShopTestCase):
+    """Unchanged sessions are never rewritten, and changes made elsewhere are seen"""
+
+    def session_writes(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        return [q['sql'] for q in queries.captured_queries
+                if Session._meta.db_table in q['sql'] and not q['sql'].startswith('SELECT')]
+
+    def test_unchanged_session_is_not_written(self):
+        order = self.create_order(1)
+        url = reverse('payment_retry', args=[order.pk])
+        self.assertEqual(len(self.session_writes(url)), 1)  # order_id stored
+        self.assertEqual(self.session_writes(url), [])  # the same order_id again
+        self.assertEqual(self.client.session['order_id'], order.pk)
+
+    def test_change_through_another_store_is_seen(self):
+        for engine in ('JRShop.sessions', 'JRShop.cached_sessions'):
+            with self.subTest(engine=engine):
+                SessionStore = import_module(engine).SessionStore
+                first = SessionStore()
+                first['order_id'] = 1
+                first.save()
+                second = SessionStore(first.session_key)
+                second['order_id'] = 2
+                second.save()
+                # The first store, still holding what it loaded, writes nothing
+                first.save()
+                self.assertEqual(SessionStore(first.session_key)['order_id'], 2)
+
+    def test_purge_deletes_expired_sessions_in_batches(self):
+        now = timezone.now()
+        Session.objects.bulk_create(
+            Session(session_key=f'key{i}', session_data='', expire_date=now + timedelta(days=i - 5))
+            for i in range(10)
+        )
+        self.assertEqual(purge_expired_sessions(batch_size=2, limit=3, now=now), 3)
+        self.assertEqual(purge_expired_sessions(batch_size=2, now=now), 2)
+        self.assertEqual(Session.objects.filter(session_key__startswith='key').count(), 5)
+        self.assertFalse(Session.objects.filter(expire_date__lt=now).exists())
+
+
+class FinalizePaymentTests(ShopTestCase):
+
+    def test_only_first_caller_finalizes(self):
+        order = place_order(self.fill_cart(2), Order(user=self.user, **ORDER_DETAILS))
+        # paid update, reservation claim, order total, stats update then insert
+        # (in a savepoint, as the customer's first payment), queued confirmation
+        # email (+ savepoint pair)
+        with self.assertNumQueries(10):
+            self.assertTrue(finalize_payment(order, transaction_id='tx-1'))
+        self.assertFalse(finalize_payment(Order.objects.get(pk=order.pk)))
+        order.refresh_from_db()
+        self.assertTrue(order.paid)
+        self.assertEqual(order.transaction_id, 'tx-1')
+        # Stock was taken by the reservation and not decremented again
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock, 48)
+
+    def test_lapsed_reservation_is_claimed_in_one_statement(self):
+        order = self.create_order(5)
+        CustomerStats.objects.create(user=self.user)
+        Product.objects.filter(pk=self.products[0].pk).update(stock=1)
+        # paid update, reservation claim, order lines, one stock UPDATE, order
+        # total, stats update, queued email (+ savepoint pair)
+        with self.assertNumQueries(9):
+            self.assertTrue(finalize_payment(order))
+        stocks = dict(Product.objects.values_list('pk', 'stock'))
+        self.assertEqual(stocks[self.products[0].pk], 0)
+        self.assertEqual(stocks[self.products[4].pk], 48)
+        self.assertEqual(stocks[self.products[5].pk], 50)
+
+    def test_paid_orders_are_added_to_customer_stats(self):
+        orders = [self.create_order(lines) for lines in (1, 2)]
+        self.create_order(3)
+        for order in orders:
+            finalize_payment(order)
+        finalize_payment(orders[0])
+        stats = CustomerStats.objects.get(user=self.user)
+        self.assertEqual(stats.paid_orders, 2)
+        self.assertEqual(stats.total_spent, sum(order.get_total_cost() for order in orders))
+
+        Order.objects.filter(pk=orders[0].pk).update(status='delivered')
+        with self.assertNumQueries(1):
+            summary = order_summary(self.user)
+        self.assertEqual(summary['total_orders'], 3)
+        self.assertEqual(summary['delivered_orders'], 1)
+        self.assertEqual(summary['processing_orders'], 1)
+        self.assertEqual(summary['pending_orders'], 1)
+        self.assertEqual(summary['total_spent'], stats.total_spent)
+
+        CustomerStats.objects.update(paid_orders=0, total_spent=0)
+        call_command('rebuild_customer_stats', stdout=io.StringIO())
+        self.assertEqual(CustomerStats.objects.get(user=self.user).total_spent, stats.total_spent)
+
+
+class StubGateway:
+    """
+    Local stand-in for the SSL Commerz API.
+
+    Each request pops the next scripted (status, payload, delay) reply; the
+    last one repeats. Records the client address of every request so tests
+    can check keep-alive reuse.
+    """
+
+    def __init__(self, *replies):
+        self.replies = list(replies) or [(200, {'status': 'VALID'}, 0)]
+        self.clients = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.clients.append(self.client_address)
+                status, payload, delay = stub.replies.pop(0) if len(stub.replies) > 1 else stub.replies[0]
+                time.sleep(delay)
+                body = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up (timeout tests)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 64
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/validator'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def hits(self):
+        return len(self.clients)
+
+
+@override_settings(SSLCOMMERZ_RETRY_BACKOFF=0, SSLCOMMERZ_READ_TIMEOUT=2)
+class GatewayClientTests(SimpleTestCase):
+
+    def validate(self, gateway):
+        with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+            return validate_sslcommerz_payment('val-1')
+
+    def test_connections_are_reused(self):
+        with StubGateway() as gateway:
+            self.validate(gateway)
+            self.validate(gateway)
+        self.assertEqual(gateway.hits, 2)
+        self.assertEqual(len(set(gateway.clients)), 1)
+
+    def test_validation_is_retried_on_server_errors(self):
+        with StubGateway((503, {}, 0), (502, {}, 0), (200, {'status': 'VALID'}, 0)) as gateway:
+            self.assertEqual(self.validate(gateway)['status'], 'VALID')
+        self.assertEqual(gateway.hits, 3)
+
+    def test_gateway_time_is_recorded(self):
+        token = instrumentation.start()
+        try:
+            with StubGateway((200, {'status': 'VALID'}, 0.05)) as gateway:
+                self.validate(gateway)
+            self.assertGreaterEqual(instrumentation.current().timings['gateway'], 0.05)
+        finally:
+            instrumentation.stop(token)
+
+    @override_settings(SSLCOMMERZ_READ_TIMEOUT=0.2, SSLCOMMERZ_RETRIES=0)
+    def test_read_timeout(self):
+        with StubGateway((200, {'status': 'VALID'}, 1)) as gateway:
+            with self.assertRaises(requests.RequestException):
+                self.validate(gateway)
+
+    @override_settings(SSLCOMMERZ_RETRIES=0, SSLCOMMERZ_CIRCUIT_FAILURE_THRESHOLD=2,
+                       SSLCOMMERZ_CIRCUIT_RESET_SECONDS=60)
+    def test_circuit_breaker_fails_fast(self):
+        with StubGateway((500, {}, 0)) as gateway:
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+                client = get_gateway_client()
+                for _ in range(2):
+                    with self.assertRaises(requests.HTTPError):
+                        validate_sslcommerz_payment('val-1')
+                self.assertTrue(client.breaker.is_open)
+                with self.assertRaises(GatewayUnavailable):
+                    validate_sslcommerz_payment('val-1')
+        self.assertEqual(gateway.hits, 2)
+
+    def test_unexpected_error_in_half_open_trial_releases_it(self):
+        client = GatewayClient(CircuitBreaker(failure_threshold=1, reset_timeout=0), retries=0)
+        self.addCleanup(client.close)
+        with mock.patch.object(client.session, 'request', side_effect=ValueError('bad response')) as request:
+            for _ in range(3):
+                # Each call after the first is a half-open trial, which
+                # would be rejected if the previous one were still in flight
+                with self.assertRaises(ValueError):
+                    client.get('http://gateway.invalid/')
+            self.assertEqual(request.call_count, 3)
+            self.assertTrue(client.breaker.is_open)
+            request.side_effect = None
+            request.return_value = mock.Mock(status_code=200)
+            client.get('http://gateway.invalid/')
+        self.assertFalse(client.breaker.is_open)
+
+    async def test_async_validations_share_the_event_loop(self):
+        with StubGateway((200, {'status': 'VALID'}, 0.3)) as gateway:
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+                started = time.monotonic()
+                results = await asyncio.gather(*(avalidate_sslcommerz_payment(f'val-{i}') for i in range(10)))
+                elapsed = time.monotonic() - started
+        self.assertEqual({result['status'] for result in results}, {'VALID'})
+        # Ten 300 ms validations overlap instead of taking 3 s back to back
+        self.assertLess(elapsed, 1.5)
+
+
+@override_settings(SSLCOMMERZ_RETRY_BACKOFF=0, SSLCOMMERZ_READ_TIMEOUT=2)
+class AsyncPaymentViewTests(ShopTestCase):
+
+    @override_settings(DEBUG=True)
+    def test_middleware_chain_stays_async(self):
+        # With DEBUG, Django logs each middleware it has to wrap to run it in the other mode
+        with self.assertLogs('django.request', 'DEBUG') as logs:
+            logging.getLogger('django.request').debug("Loading the ASGI middleware")
+            ASGIHandler().load_middleware(is_async=True)
+        self.assertEqual([line for line in logs.output if 'adapted' in line], [])
+
+    async def test_ipn_is_queued_and_finalized_by_worker(self):
+        order = await sync_to_async(place_order)(
+            await sync_to_async(self.fill_cart)(2), Order(user=self.user, transaction_id='tx-ipn', **ORDER_DETAILS)
+        )
+        with StubGateway((503, {}, 0), (200, {'status': 'VALID'}, 0)) as gateway:
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+                for _ in range(2):  # the gateway retries IPNs
+                    response = await self.async_client.post(
+                        reverse('sslcommerz_ipn'), {'tran_id': 'tx-ipn', 'val_id': 'val-1'}
+                    )
+                    self.assertEqual(response.status_code, 200)
+                self.assertEqual(gateway.hits, 0)
+                self.assertEqual(await Job.objects.acount(), 1)
+                # The IPN job, then the confirmation email it queued
+                self.assertEqual(await sync_to_async(jobs.run_pending)(), 2)
+        self.assertEqual(gateway.hits, 2)
+        await order.arefresh_from_db()
+        self.assertTrue(order.paid)
+        self.assertEqual(order.status, 'processing')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(f'Order #{order.id}', mail.outbox[0].subject)
+
+
+@override_settings(SSLCOMMERZ_RETRY_BACKOFF=0, SSLCOMMERZ_RETRIES=0)
+class PaymentValidationCacheTests(ShopTestCase):
+
+    async def test_concurrent_callers_share_one_request(self):
+        reply = (200, {'status': 'VALID', 'tran_id': 'tx-1', 'amount': '202.00'}, 0.2)
+        with StubGateway(reply) as gateway:
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+                results = await asyncio.gather(*(avalidate_payment('val-1') for _ in range(5)))
+                self.assertEqual(gateway.hits, 1)
+                # Once persisted, later callbacks never reach the gateway
+                await cache.aclear()
+                self.assertEqual((await avalidate_payment('val-1'))['status'], 'VALID')
+        self.assertEqual(gateway.hits, 1)
+        self.assertEqual({result['status'] for result in results}, {'VALID'})
+        record = await PaymentValidation.objects.aget(val_id='val-1')
+        self.assertEqual(record.amount, Decimal('202.00'))
+
+    def test_gateway_errors_are_not_cached(self):
+        with StubGateway((500, {}, 0), (200, {'status': 'VALID'}, 0)) as gateway:
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+                with self.assertRaises(requests.HTTPError):
+                    validate_payment('val-2')
+                self.assertEqual(validate_payment('val-2')['status'], 'VALID')
+                self.assertEqual(validate_payment('val-2')['status'], 'VALID')
+        self.assertEqual(gateway.hits, 2)
+        self.assertTrue(PaymentValidation.objects.filter(val_id='val-2').exists())
+
+    @override_settings(PAYMENT_VALIDATION_FAILURE_CACHE_TIMEOUT=0)
+    def test_failed_validations_do_not_block_a_retry(self):
+        with StubGateway((200, {'status': 'INVALID_TRANSACTION'}, 0), (200, {'status': 'VALID'}, 0)) as gateway:
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+                self.assertEqual(validate_payment('val-3')['status'], 'INVALID_TRANSACTION')
+                self.assertEqual(validate_payment('val-3')['status'], 'VALID')
+        self.assertEqual(gateway.hits, 2)
+
+    @override_settings(SSLCOMMERZ_CONNECT_TIMEOUT=0.5, SSLCOMMERZ_READ_TIMEOUT=0.5, SSLCOMMERZ_RETRIES=0)
+    def test_waiter_past_the_deadline_leaves_the_lock_alone(self):
+        # Another worker holds the lock and never publishes a result
+        cache.add(_lock_key('val-4'), 'other worker', 60)
+        with StubGateway((200, {'status': 'VALID'}, 0)) as gateway:
+            with override_settings(SSLCOMMERZ_VALIDATION_URL=gateway.url):
+                self.assertEqual(validate_payment('val-4')['status'], 'VALID')
+        self.assertEqual(cache.get(_lock_key('val-4')), 'other worker')
+
+
+calls = []
+
+
+@jobs.task()
+def flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise RuntimeError('boom')
+
+
+@override_settings(JOB_RETRY_BASE_DELAY=0, JOB_MAX_ATTEMPTS=3)
+class JobQueueTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+
+    def test_failed_jobs_are_retried_then_kept(self):
+        flaky.enqueue({'fail_times': 1})
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(Job.objects.exists())
+
+        flaky.enqueue({'fail_times': 5}, key='flaky:1')
+        self.assertEqual(jobs.run_pending(), 0)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), ('failed', 3))
+        self.assertIn('boom', job.last_error)
+        # Its key is released, so the same work can be queued again
+        self.assertIsNone(job.key)
+        flaky.enqueue({'fail_times': 0}, key='flaky:1')
+        self.assertEqual(jobs.run_pending(), 1)
+
+    def test_retry_is_delayed_with_backoff(self):
+        with override_settings(JOB_RETRY_BASE_DELAY=60):
+            flaky.enqueue({'fail_times': 1})
+            self.assertEqual(jobs.run_pending(), 0)
+        job = Job.objects.get()
+        self.assertEqual(job.status, 'queued')
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=25))
+
+    def test_unfinished_job_is_reclaimed_after_visibility_timeout(self):
+        flaky.enqueue({'fail_times': 0})
+        [job] = jobs.claim('worker-1', visibility_timeout=60)
+        self.assertEqual(jobs.claim('worker-2'), [])
+        Job.objects.update(run_at=timezone.now() - timedelta(seconds=1))
+        [reclaimed] = jobs.claim('worker-2')
+        self.assertEqual((reclaimed.pk, reclaimed.attempts), (job.pk, 2))
+        # The first worker finishing late does not remove the reclaimed job
+        jobs.run([job])
+        self.assertTrue(Job.objects.filter(pk=job.pk).exists())
+        jobs.run([reclaimed])
+        self.assertFalse(Job.objects.exists())
+
+    def test_confirmation_emails_are_batched(self):
+        orders = [self.create_order(2) for _ in range(3)]
+        for order in orders:
+            finalize_payment(order)
+        # claim (select + update + reload, in a savepoint), orders with totals, their items, delete
+        with self.assertNumQueries(8):
+            self.assertEqual(jobs.run(jobs.claim('worker', limit=10)), 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox), [ORDER_DETAILS['email']] * 3)
+
+    def test_only_failed_confirmation_emails_are_retried(self):
+        orders = [self.create_order(1) for _ in range(3)]
+        Order.objects.filter(pk=orders[1].pk).update(email='bounce@example.com')
+        for order in orders:
+            finalize_payment(order)
+        send_messages = mail.backends.locmem.EmailBackend.send_messages
+
+        def refuse_bounces(backend, messages):
+            if any('bounce' in address for message in messages for address in message.to):
+                raise smtplib.SMTPRecipientsRefused({'bounce@example.com': (550, b'No such user')})
+            return send_messages(backend, messages)
+
+        with mock.patch.object(mail.backends.locmem.EmailBackend, 'send_messages', refuse_bounces):
+            self.assertEqual(jobs.run(jobs.claim('worker', limit=10)), 2)
+        self.assertEqual(len(mail.outbox), 2)
+        job = Job.objects.get()
+        self.assertEqual((job.payload, job.status), ({'order_id': orders[1].pk}, 'queued'))
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual([email.to[0] for email in mail.outbox[2:]], ['bounce@example.com'])
+
+
+class CatalogCacheTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.anonymous = Client()
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        self.anonymous.get(reverse('product_list'))
+        # Tracking and blank parameters map to the same page
+        with self.assertNumQueries(0):
+            response = self.anonymous.get(reverse('product_list') + '?utm_source=mail&rating=')
+        self.assertContains(response, 'Product 5')
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+            with override_settings(CACHES={'default': backend}):
+                self.anonymous.get(reverse('home'))
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.anonymous.get(reverse('home')).status_code, 200)
+
+    def test_saves_invalidate_cached_pages(self):
+        url = reverse('product_list')
+        self.anonymous.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.products[0]
+            product.name = 'Renamed Gadget'
+            product.save()
+        self.assertContains(self.anonymous.get(url), 'Renamed Gadget')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Widgets'
+            self.category.save()
+        self.assertContains(self.anonymous.get(url), 'Widgets')
+
+    def test_product_detail_is_served_from_cache(self):
+        url = reverse('product_detail', args=[self.products[0].slug])
+        self.anonymous.get(url)
+        with self.assertNumQueries(0):
+            response = self.anonymous.get(url)
+        self.assertContains(response, reverse('add_to_cart', args=[self.products[0].pk]))
+        self.assertNotContains(response, 'csrfmiddlewaretoken')
+
+    def test_add_to_cart_posts_the_cookie_token(self):
+        browser = Client(enforce_csrf_checks=True)
+        url = reverse('add_to_cart', args=[self.products[0].pk])
+        self.assertEqual(browser.get(url).status_code, 405)
+        self.assertEqual(browser.post(url).status_code, 403)
+        # What base.js does on a cached page: fetch the cookie if need be, then post its token
+        token = browser.get(reverse('cart_api')).cookies['csrftoken'].value
+        response = browser.post(url, {'csrfmiddlewaretoken': token})
+        self.assertRedirects(response, reverse('product_detail', args=[self.products[0].slug]))
+        self.assertIn('cart', response.cookies)
+
+    def test_logged_in_users_reuse_fragments(self):
+        url = reverse('product_list')
+        self.client.get(url)
+        # session, user, product page; the price range, category sidebar,
+        # cards and cart summary all come from the cache
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertContains(response, 'Product 0')
+        self.assertContains(response, 'Gadgets')
+
+
+class ProductImageTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+
+    def test_variants_are_rendered_on_save_and_served(self):
+        original = io.BytesIO()
+        Image.effect_noise((2000, 1500), 40).convert('RGB').save(original, 'JPEG', quality=90)
+        product = self.products[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image = SimpleUploadedFile('photo.jpg', original.getvalue(), content_type='image/jpeg')
+            product.save()
+        product.refresh_from_db()
+
+        self.assertEqual(product.image_variants['source'], product.image.name)
+        cards = product.image_variants['card']
+        self.assertEqual([width for width, _ in cards['webp']], VARIANTS['card'])
+        card_bytes = default_storage.size(cards['webp'][0][1])
+        self.assertLess(card_bytes * 10, default_storage.size(product.image.name))
+
+        html = self.client.get(reverse('product_list')).content.decode()
+        self.assertIn('type="image/webp"', html)
+        self.assertIn(f'{default_storage.url(cards["webp"][1][1])} 600w', html)
+        self.assertNotIn(product.image.url, html)
+
+        # A replaced image is re-rendered and the old renderings removed
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image = SimpleUploadedFile('small.png', original.getvalue(), content_type='image/jpeg')
+            product.save()
+        product.refresh_from_db()
+        self.assertTrue(product.image_variants['source'].endswith('small.png'))
+        self.assertFalse(default_storage.exists(cards['webp'][0][1]))
+
+
+class ProductImportExportTests(ShopTestCase):
+
+    def import_csv(self, text, *args):
+        path = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        self.addCleanup(os.remove, path.name)
+        with path:
+            path.write(text)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_products', path.name, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_upserts_by_slug_and_export_round_trips(self):
+        header = 'slug,name,category,description,price,discount_price,stock,available,image\n'
+        with StubGateway() as gateway:
+            out, err = self.import_csv(
+                header
+                + 'product-0,Renamed,gadgets,New text,99.50,,7,false,\n'
+                + f'new-one,New One,toys,Fresh,10,8,3,true,{gateway.url}\n'
+                + 'broken,Broken,gadgets,Text,not-a-price,,1,true,\n',
+                '--create-categories',
+            )
+        self.assertIn('Imported 2 products (1 rows rejected)', out)
+        self.assertIn('line 4: price', err)
+        self.assertIn('not an image', err)
+
+        updated = Product.objects.get(slug='product-0')
+        self.assertEqual((updated.name, updated.price, updated.stock, updated.available),
+                         ('Renamed', Decimal('99.50'), 7, False))
+        # Columns the file does not carry are kept
+        self.assertEqual(updated.image.name, 'products/test.png')
+        created = Product.objects.get(slug='new-one')
+        self.assertEqual((created.category.slug, created.discount_price), ('toys', Decimal('8.00')))
+        self.assertEqual(Product.objects.filter(slug='broken').count(), 0)
+        self.assertEqual([p.slug for p in search_products(Product.objects.all(), 'renamed')[0]], ['product-0'])
+
+        export = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+        export.close()
+        self.addCleanup(os.remove, export.name)
+        call_command('export_products', export.name, stderr=io.StringIO())
+        with open(export.name) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), Product.objects.count())
+        self.assertIn({'slug': 'new-one', 'name': 'New One', 'category': 'toys', 'description': 'Fresh',
+                       'price': '10.00', 'discount_price': '8.00', 'stock': 3, 'available': True, 'image': ''}, rows)
+
+
+class StaticFilesTests(TestCase):
+
+    def test_collected_files_are_compressed_and_immutable(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        with override_settings(STATIC_ROOT=root.name):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            client = Client(headers={'Accept-Encoding': 'gzip, br;q=0'})
+            url = staticfiles_storage.url('JRShop/css/base.css')
+            self.assertRegex(url, r'^/static/JRShop/css/base\.[0-9a-f]{12}\.css$')
+            self.assertContains(client.get(reverse('login')), url)
+
+            response = client.get(url)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            with open(finders.find('JRShop/css/base.css'), 'rb') as original:
+                self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), original.read())
+
+            revalidated = client.get(url, headers={'If-None-Match': response['ETag']})
+            self.assertEqual(revalidated.status_code, 304)
+
+    def test_missing_manifest_is_reported(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        storage = CompressedManifestStaticFilesStorage(location=root.name)
+        with self.assertLogs('JRShop.staticfiles', 'WARNING') as logs:
+            self.assertEqual(storage.stored_name('JRShop/css/base.css'), 'JRShop/css/base.css')
+            storage.stored_name('JRShop/js/product_detail.js')
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('collectstatic', logs.output[0])
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        # The catalog last changed a minute ago
+        cache.set(f'{VERSION_PREFIX}catalog', time.time_ns() - 60 * 10 ** 9)
+        self.router = ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def route(self, request):
+        """The database the catalog is read from while handling the request"""
+        seen = {}
+
+        def view(request):
+            seen['db'] = self.router.db_for_read(Product)
+            return HttpResponse()
+
+        response = ReplicaRoutingMiddleware(view)(request)
+        return seen['db'], response
+
+    def test_catalog_reads_go_to_replicas(self):
+        self.assertEqual(self.router.db_for_read(Product), 'replica1')
+        self.assertEqual(self.router.db_for_read(Category), 'replica1')
+        self.assertIsNone(self.router.db_for_read(Order))
+        self.assertEqual(self.router.db_for_write(Product), 'default')
+        with pin_primary():
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+        self.assertFalse(self.router.allow_migrate('replica1', 'JRShop'))
+
+    def test_writers_stick_to_the_primary(self):
+        self.assertEqual(self.route(self.factory.get('/products/'))[0], 'replica1')
+        db, response = self.route(self.factory.post('/cart/add/1/'))
+        self.assertEqual(db, 'default')
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 5)
+
+        request = self.factory.get('/products/')
+        request.COOKIES[PIN_COOKIE] = '1'
+        self.assertEqual(self.route(request)[0], 'default')
+
+    def test_checkout_uses_the_primary(self):
+        self.assertEqual(self.route(self.factory.get(reverse('checkout')))[0], 'default')
+
+    def test_catalog_changes_rekey_caches_instead_of_pinning(self):
+        settled = get_version('catalog')
+        cache.set(f'{VERSION_PREFIX}catalog', time.time_ns())
+        # Everyone else still reads from replicas...
+        self.assertEqual(self.route(self.factory.get('/products/'))[0], 'replica1')
+        # ...but what they cache now is keyed apart from what is cached once replicas caught up
+        settling = get_version('catalog')
+        self.assertTrue(str(settling).endswith('-settling'))
+        with override_settings(REPLICA_STICKY_SECONDS=0):
+            self.assertNotIn(get_version('catalog'), (settled, settling))
+
+
+class InstrumentationTests(ShopTestCase):
+    """Requests report their queries and timings, and slow ones are logged"""
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('profile'))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="5 queries, 0 repeated", template;dur=[\d.]+, total;dur=[\d.]+$')
+
+    @override_settings(SLOW_REQUEST_THRESHOLD_MS=0)
+    def test_slow_requests_are_logged(self):
+        with self.assertLogs('JRShop.slow_requests', 'WARNING') as logs:
+            self.client.get(reverse('product_list'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['view'], record['status'], record['user']), ('product_list', 200, self.user.pk))
+        self.assertGreater(record['queries'], 0)
+        self.assertIn('template_ms', record)
+        self.assertEqual(record['repeated_queries'], [])
+
+    def test_repeated_queries_are_fingerprinted(self):
+        metrics = instrumentation.RequestMetrics()
+        for ids in (1, 2, 3):
+            metrics.add_query(f"SELECT * FROM product WHERE id IN ({', '.join(['%s'] * ids)})", 0.001)
+        metrics.add_query('SELECT * FROM category WHERE id = %s', 0.001)
+        self.assertEqual(metrics.repeated_queries(threshold=3), [('SELECT * FROM product WHERE id IN (...)', 3)])
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_not_measured(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('profile')))
+
+
+@skipUnless(connection.vendor == 'sqlite', "Scratch databases are SQLite files named by DB_NAME")
+class BenchCommandTests(SimpleTestCase):
+    """
+    The bench commands run end to end on a tiny workload. Each creates and
+    destroys its own test database, so it runs in a separate process with
+    a scratch DB_NAME rather than inside this test database.
+    """
+
+    def bench(self, command, *args):
+        with tempfile.TemporaryDirectory() as scratch:
+            result = subprocess.run(
+                [sys.executable, 'manage.py', command, *args],
+                cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=300,
+                env={**os.environ, 'DB_NAME': os.path.join(scratch, 'bench.sqlite3'), 'DB_REPLICAS': ''},
+            )
+            self.assertEqual(os.listdir(scratch), [])
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def test_bench_database(self):
+        output = self.bench('bench_database', '--workers', '2', '--duration', '1', '--products', '3')
+        self.assertIn('journal_mode=wal', output)
+        self.assertIn('checkout', output)
+
+    def test_bench_indexes(self):
+        output = self.bench('bench_indexes', '--products', '200', '--orders', '500', '--users', '20', '--repeat', '2')
+        self.assertIn('=== before hot-path indexes ===', output)
+        self.assertIn('=== after hot-path indexes ===', output)
+        self.assertEqual(output.count('p50'), 14)
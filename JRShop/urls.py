@@ -11,12 +11,14 @@ urlpatterns = [
     path('products/', views.product_list, name='product_list'),
     path('products/category/<slug:category_slug>/', views.product_list, name='product_list_by_category'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
+    path('api/products/', views.product_list_api, name='product_list_api'),
     
     # Cart URLs
     path('cart/', views.view_cart, name='view_cart'),
     path('cart/add/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
     path('cart/remove/<int:item_id>/', views.remove_from_cart, name='remove_from_cart'),
     path('cart/update/<int:item_id>/', views.update_cart_quantity, name='update_cart_quantity'),
+    path('api/cart/', views.cart_api, name='cart_api'),
     
     # AJAX Cart URLs
     path('remove-from-cart/<int:item_id>/', views.remove_from_cart, name='remove_from_cart_ajax'),
@@ -1,22 +1,37 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth import authenticate, login as auth_login, logout as auth_logout, get_user_model
 from django.contrib import messages
-from django.db.models import Avg, Min, Max, Q
-from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
-from django.views.decorators.csrf import csrf_exempt
+from django.db.models import Min, Max
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_http_methods
 from decimal import Decimal, InvalidOperation
+import json
 import uuid
 import logging
+from asgiref.sync import sync_to_async
+from . import images
+from .caching import annotate_card_versions, cache_anonymous_page, fragment_timeout, get_version
+from .cart import AnonymousCart, CartConflict, CartFull, add_item, apply_changes, invalidate_cart_summary
 from .forms import RegistrationForm, CheckoutForm
-from .models import Product, Category, Cart, CartItem, Rating, Order, OrderItem
-from .sslcommerz import generate_sslcommerz_payment, validate_sslcommerz_payment
+from .orders import EmptyCart, OutOfStock, finalize_payment, order_summary, place_order
+from .models import Product, Category, Cart, Order
+from .pagination import CursorPaginator, InvalidCursor
+from .routers import read_database, use_primary
+from .jobs import aenqueue
+from .payments import avalidate_payment, is_valid
+from .search import search_products
+from .sslcommerz import agenerate_sslcommerz_payment
 
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+@cache_anonymous_page()
 def home(request):
     return render(request, 'JRShop/home.html')
 
@@ -68,130 +83,230 @@ def user_logout(request):
     messages.success(request, "You have been logged out successfully!")
     return redirect('home')
 
+DEFAULT_ORDERING = ('-created_at', '-id')
+PRODUCTS_PER_PAGE = 12
+ORDERS_PER_PAGE = 10
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 200
+CART_API_MAX_CHANGES = 100
+
+
+def _parse_decimal(value):
+    try:
+        value = Decimal(value)
+    except (InvalidOperation, TypeError):
+        return None
+    # NaN and Infinity parse, but the database can't compare against them
+    return value if value.is_finite() else None
+
+
+def _filter_products(products, params):
+    """
+    Apply the price, rating and search filters shared by the catalog views.
+
+    Returns the filtered queryset and the paginator ordering to use: search
+    results are ranked by relevance, everything else is newest first.
+    """
+    min_price = _parse_decimal(params.get('min_price'))
+    if min_price is not None:
+        products = products.filter(price__gte=min_price)
+
+    max_price = _parse_decimal(params.get('max_price'))
+    if max_price is not None:
+        products = products.filter(price__lte=max_price)
+
+    min_rating = _parse_decimal(params.get('rating'))
+    if min_rating is not None:
+        products = products.filter(rating_avg__gte=min_rating)
+
+    products, ordering = search_products(products, params.get('search'))
+    return products, ordering or DEFAULT_ORDERING
+
+
+def _price_range(products, category):
+    """Min and max price of a listing, cached until the catalog changes"""
+    key = f"price-range:{get_version('catalog')}:{category.id if category else 'all'}"
+    price_range = cache.get(key)
+    if price_range is None:
+        price_range = products.aggregate(Min('price'), Max('price'))
+        cache.set(key, price_range, fragment_timeout())
+    return price_range
+
+
+def _page_query(params, **cursor):
+    """Build a query string for another page, keeping the active filters"""
+    query = params.copy()
+    for key in ('after', 'before'):
+        query.pop(key, None)
+    query.update(cursor)
+    return query.urlencode()
+
+
 # product list page
+@cache_anonymous_page(params=('search', 'min_price', 'max_price', 'rating', 'after', 'before'))
 def product_list(request, category_slug = None):
     category = None 
     categories = Category.objects.all()
-    products = Product.objects.filter(available=True)
+    products = Product.objects.filter(available=True).select_related('category')
     
     if category_slug:
         category = get_object_or_404(Category, slug=category_slug)
-        print("category .......", category)
         products = products.filter(category = category)
         
-    min_price = products.aggregate(Min('price'))['price__min']
-    max_price = products.aggregate(Max('price'))['price__max']
+    price_range = _price_range(products, category)
+    min_price = price_range['price__min']
+    max_price = price_range['price__max']
     
-    if request.GET.get('min_price'):
-        products = products.filter(price__gte=request.GET.get('min_price'))
-    
-    if request.GET.get('max_price'):
-        products = products.filter(price__lte=request.GET.get('max_price'))
-    
-    if request.GET.get('rating'):
-        min_rating = request.GET.get('rating')
-        products = products.annotate(avg_rating = Avg('ratings__rating')).filter(avg_rating__gte=min_rating)
-        
-    
-    if request.GET.get('search'):
-        query = request.GET.get('search')
-        products = products.filter(
-            Q(name__icontains = query) | 
-            Q(description__icontains = query) | 
-            Q(category__name__icontains = query)  
-        )
-    
-    # Get cart items count
-    cart_items_count = 0
-    if request.user.is_authenticated:
-        try:
-            cart = Cart.objects.get(user=request.user)
-            cart_items_count = cart.items.count()
-        except Cart.DoesNotExist:
-            cart_items_count = 0
+    products, ordering = _filter_products(products, request.GET)
+
+    paginator = CursorPaginator(products, per_page=PRODUCTS_PER_PAGE, ordering=ordering)
+    try:
+        page = paginator.page(after=request.GET.get('after'), before=request.GET.get('before'))
+    except InvalidCursor:
+        page = paginator.page()
     
     return render(request, 'JRShop/product_list.html', {
         'category' : category,
         'categories' : categories,
-        'products' : products,
+        'products' : annotate_card_versions(page.object_list),
+        'page' : page,
+        'categories_version' : get_version('categories'),
+        'fragment_timeout' : fragment_timeout(),
+        'next_query' : _page_query(request.GET, after=page.next_cursor) if page.has_next else None,
+        'previous_query' : _page_query(request.GET, before=page.previous_cursor) if page.has_previous else None,
         'min_price' : min_price,
         'max_price' : max_price,
-        'cart_items_count': cart_items_count
     })
 
+
+def _serialize_product(request, product):
+    return {
+        'id': product.id,
+        'name': product.name,
+        'slug': product.slug,
+        'category': product.category.slug,
+        'price': product.price,
+        'discount_price': product.discount_price,
+        'final_price': product.get_final_price(),
+        'stock': product.stock,
+        'rating': product.rating_avg,
+        'rating_count': product.rating_count,
+        'image': request.build_absolute_uri(product.image.url) if product.image else None,
+        'thumbnail': request.build_absolute_uri(images.fallback_url(product, 'card')) if product.image else None,
+        'url': request.build_absolute_uri(reverse('product_detail', args=[product.slug])),
+    }
+
+
+def _stream_product_page(request, paginator, rows):
+    """Yield a page of products as JSON, one row at a time"""
+    encoder = DjangoJSONEncoder()
+    yield '{"results": ['
+    last = None
+    for index, product in enumerate(rows):
+        if index == paginator.per_page:
+            # The extra row only signals that another page exists
+            yield '], "next": %s}' % encoder.encode(paginator.encode_cursor(last))
+            return
+        if index:
+            yield ', '
+        yield encoder.encode(_serialize_product(request, product))
+        last = product
+    yield '], "next": null}'
+
+
+# product catalog JSON API
+@require_http_methods(["GET"])
+def product_list_api(request):
+    products = Product.objects.filter(available=True).select_related('category')
+
+    if request.GET.get('category'):
+        products = products.filter(category__slug=request.GET.get('category'))
+
+    products, ordering = _filter_products(products, request.GET)
+
+    try:
+        per_page = min(max(int(request.GET.get('limit', API_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit'}, status=400)
+
+    paginator = CursorPaginator(products, per_page=per_page, ordering=ordering)
+    try:
+        rows = paginator.window(after=request.GET.get('after'))
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    return StreamingHttpResponse(
+        _stream_product_page(request, paginator, rows.iterator(chunk_size=per_page + 1)),
+        content_type='application/json',
+    )
+
 # product detail page
+@cache_anonymous_page()
 def product_detail(request, slug):
-    product = get_object_or_404(Product, slug = slug, available = True)
+    product = get_object_or_404(Product.objects.select_related('category'), slug = slug, available = True)
+    # Only evaluated when the related products fragment is not cached
     related_products = Product.objects.filter(category = product.category).exclude(id=product.id)[:4]
     
-    # Get cart items count and check if product is in cart
-    cart_items_count = 0
-    is_in_cart = False
-    if request.user.is_authenticated:
-        try:
-            cart = Cart.objects.get(user=request.user)
-            cart_items_count = cart.items.count()
-            # Check if this product is in the cart
-            is_in_cart = CartItem.objects.filter(cart=cart, product=product).exists()
-        except Cart.DoesNotExist:
-            cart_items_count = 0
-            is_in_cart = False
-    
     return render(request, 'JRShop/product_detail.html', {
         'product': product,
         'related_products': related_products,
-        'cart_items_count': cart_items_count,
-        'is_in_cart': is_in_cart
+        'is_in_cart': product.id in request.cart,
+        'catalog_version': get_version('catalog'),
+        'fragment_timeout': fragment_timeout(),
     })
 
-# add to cart
+# add to cart; the catalog pages' forms send it without a rendered token (see base.js)
+@require_http_methods(["POST"])
 def add_to_cart(request, product_id):
-    if not request.user.is_authenticated:
-        messages.error(request, "Please login to add items to cart")
-        return redirect('login')
-    
     product = get_object_or_404(Product, id=product_id)
     
     if not product.available or product.stock <= 0:
         messages.error(request, "This product is not available")
         return redirect('product_detail', slug=product.slug)
     
-    cart, created = Cart.objects.get_or_create(user=request.user)
-    
-    try:
-        cart_item = CartItem.objects.get(cart=cart, product=product)
-        if cart_item.quantity < product.stock:
-            cart_item.quantity += 1
-            cart_item.save()
-            messages.success(request, f"Updated {product.name} quantity in cart")
-        else:
-            messages.warning(request, "Cannot add more - limited stock")
-    except CartItem.DoesNotExist:
-        CartItem.objects.create(cart=cart, product=product, quantity=1)
+    response = redirect('product_detail', slug=product.slug)
+    if request.user.is_authenticated:
+        quantity = add_item(request.user, product.pk)
+    else:
+        # Anonymous carts live in a signed cookie, so this writes nothing to the database
+        cart = AnonymousCart.from_request(request)
+        try:
+            quantity = cart.add(product)
+        except CartFull:
+            messages.warning(request, "Your cart is full - please login to add more items")
+            return response
+        cart.save(response)
+    
+    if quantity is None:
+        messages.warning(request, "Cannot add more - limited stock")
+    elif quantity == 1:
+        invalidate_cart_summary(request.user)
         messages.success(request, f"{product.name} added to cart!")
+    else:
+        messages.success(request, f"Updated {product.name} quantity in cart")
     
-    return redirect('product_detail', slug=product.slug)
+    return response
 
 # view cart
+@ensure_csrf_cookie
 def view_cart(request):
     if not request.user.is_authenticated:
-        messages.error(request, "Please login to view cart")
-        return redirect('login')
+        cart = AnonymousCart.from_request(request)
+        return render(request, 'JRShop/cart.html', {
+            'cart': cart,
+            'cart_items': cart.get_items(),
+        })
     
     try:
-        cart = Cart.objects.get(user=request.user)
+        cart = Cart.objects.with_items().get(user=request.user)
         cart_items = cart.items.all()
     except Cart.DoesNotExist:
         cart = None
         cart_items = []
     
-    # Get cart items count
-    cart_items_count = len(cart_items) if cart_items else 0
-    
     return render(request, 'JRShop/cart.html', {
         'cart': cart,
         'cart_items': cart_items,
-        'cart_items_count': cart_items_count
     })
 
 # remove from cart
@@ -202,19 +317,16 @@ def remove_from_cart(request, item_id):
         return redirect('login')
     
     try:
-        cart = Cart.objects.get(user=request.user)
-        cart_item = CartItem.objects.get(id=item_id, cart=cart)
-        cart_item.delete()
-        
+        apply_changes(request.user, {item_id: 0})
+    except CartConflict:
+        if request.method == 'POST':
+            return JsonResponse({'success': False, 'error': 'Item not found in cart'})
+        messages.error(request, "Item not found in cart")
+    else:
         # Always return JSON for POST requests (AJAX)
         if request.method == 'POST':
             return JsonResponse({'success': True, 'message': 'Item removed from cart'})
-        
         messages.success(request, "Item removed from cart")
-    except (Cart.DoesNotExist, CartItem.DoesNotExist):
-        if request.method == 'POST':
-            return JsonResponse({'success': False, 'error': 'Item not found in cart'})
-        messages.error(request, "Item not found in cart")
     
     return redirect('view_cart')
 
@@ -227,41 +339,87 @@ def update_cart_quantity(request, item_id):
     
     if request.method == 'POST':
         try:
-            cart = Cart.objects.get(user=request.user)
-            cart_item = CartItem.objects.get(id=item_id, cart=cart)
             quantity = int(request.POST.get('quantity', 1))
-            
-            # If quantity is 0, delete the item
-            if quantity == 0:
-                cart_item.delete()
-                return JsonResponse({'success': True, 'message': 'Item removed from cart'})
-            
-            if quantity > 0 and quantity <= cart_item.product.stock:
-                cart_item.quantity = quantity
-                cart_item.save()
-                return JsonResponse({'success': True, 'message': 'Cart updated', 'quantity': quantity})
-            else:
-                return JsonResponse({'success': False, 'error': 'Invalid quantity'})
-        except (Cart.DoesNotExist, CartItem.DoesNotExist):
-            return JsonResponse({'success': False, 'error': 'Item not found'})
+        except ValueError:
+            quantity = -1
+        if quantity < 0:
+            return JsonResponse({'success': False, 'error': 'Invalid quantity'})
+        # Goes through apply_changes, like the cart API, so the cart version moves with it
+        try:
+            apply_changes(request.user, {item_id: quantity})
+        except CartConflict as e:
+            error = e.errors[item_id]
+            if error != "Item not found":
+                error = 'Invalid quantity'
+            return JsonResponse({'success': False, 'error': error})
+        if quantity == 0:
+            return JsonResponse({'success': True, 'message': 'Item removed from cart'})
+        return JsonResponse({'success': True, 'message': 'Cart updated', 'quantity': quantity})
     
     return redirect('view_cart')
 
 
+def _serialize_cart(cart, items):
+    lines = [
+        {'id': item.id, 'product_id': item.product_id, 'quantity': item.quantity, 'cost': item.get_cost()}
+        for item in items
+    ]
+    return {
+        'version': cart.version if cart else 0,
+        'items': lines,
+        'count': len(lines),
+        'subtotal': sum((line['cost'] for line in lines), Decimal('0')),
+    }
+
+
+# cart JSON API: GET the cart, PATCH {"items": {item_id: quantity, ...}};
+# the lines of an anonymous (cookie) cart are identified by product id.
+# A GET also sets the csrftoken cookie the add-to-cart forms read.
+@require_http_methods(["GET", "PATCH"])
+@ensure_csrf_cookie
+def cart_api(request):
+    anonymous = None if request.user.is_authenticated else AnonymousCart.from_request(request)
+
+    if request.method == 'GET':
+        if anonymous is not None:
+            return JsonResponse(_serialize_cart(anonymous, anonymous.get_items()))
+        cart = Cart.objects.with_items().filter(user=request.user).first()
+        return JsonResponse(_serialize_cart(cart, cart.items.all() if cart else []))
+
+    try:
+        changes = json.loads(request.body)['items']
+        changes = {int(item_id): int(quantity) for item_id, quantity in changes.items()}
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return JsonResponse({'error': 'Expected {"items": {item_id: quantity}}'}, status=400)
+    if len(changes) > CART_API_MAX_CHANGES or any(quantity < 0 for quantity in changes.values()):
+        return JsonResponse({'error': 'Invalid quantity'}, status=400)
+
+    try:
+        if anonymous is not None:
+            cart, items = anonymous.apply_changes(changes)
+        else:
+            cart, items = apply_changes(request.user, changes)
+    except CartConflict as e:
+        # Nothing was changed; the current cart lets the client resync
+        return JsonResponse({'errors': e.errors, **_serialize_cart(e.cart, e.items)}, status=409)
+    response = JsonResponse(_serialize_cart(cart, items))
+    if anonymous is not None:
+        anonymous.save(response)
+    return response
+
+
+@use_primary
 @login_required
 def checkout(request):
     try:
-        cart = Cart.objects.get(user=request.user)
-        if not cart.items.exists():
+        cart = Cart.objects.with_items().get(user=request.user)
+        if not cart.items.all():
             messages.warning(request, 'Your cart is empty!')
             return redirect('view_cart')
     except Cart.DoesNotExist:
         messages.warning(request, 'Your cart is empty!')
         return redirect('view_cart')
     
-    # Get cart items count for navbar
-    cart_items_count = cart.items.count()
-    
     if request.method == 'POST':
         form = CheckoutForm(request.POST)
         if form.is_valid():
@@ -269,19 +427,18 @@ def checkout(request):
             order = form.save(commit=False)
             order.user = request.user
             order.status = 'pending'
-            order.save()
-            
-            # Create order items from cart items
-            for item in cart.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product=item.product,
-                    price=item.product.get_final_price(),
-                    quantity=item.quantity
-                )
             
-            # Clear cart
-            cart.items.all().delete()
+            # Reserve stock, create the order items and clear the cart in one transaction
+            try:
+                place_order(cart, order)
+            except OutOfStock as e:
+                messages.error(request, f"{e} - please update your cart.")
+                return redirect('view_cart')
+            except EmptyCart:
+                # Emptied in another tab since the cart was read above
+                messages.warning(request, 'Your cart is empty!')
+                return redirect('view_cart')
+            invalidate_cart_summary(request.user)
             
             # Store order ID in session for payment processing
             request.session['order_id'] = order.id
@@ -296,24 +453,27 @@ def checkout(request):
     return render(request, 'JRShop/checkout.html', {
         'cart': cart,
         'form': form,
-        'cart_items_count': cart_items_count
     })
 
 
+# The views that call SSL Commerz are async: served over ASGI (uvicorn
+# JR_E_Shop.asgi:application) a slow gateway no longer ties up a worker.
+@use_primary
 @csrf_exempt
 @login_required
-def payment_process(request):
+async def payment_process(request):
     """Process payment initiation and redirect to SSL Commerz gateway"""
-    order_id = request.session.get('order_id')
+    user = await request.auser()
+    order_id = await request.session.aget('order_id')
     if not order_id:
-        logger.warning(f"Payment process accessed without order_id in session by user {request.user.id}")
+        logger.warning(f"Payment process accessed without order_id in session by user {user.id}")
         messages.error(request, 'No order found.')
         return redirect('home')
     
     try:
-        order = Order.objects.get(id=order_id, user=request.user)
+        order = await Order.objects.with_totals().aget(id=order_id, user=user)
     except Order.DoesNotExist:
-        logger.error(f"Order {order_id} not found for user {request.user.id}")
+        logger.error(f"Order {order_id} not found for user {user.id}")
         messages.error(request, 'Order not found.')
         return redirect('home')
     
@@ -325,14 +485,14 @@ def payment_process(request):
     # Generate transaction ID if not exists
     if not order.transaction_id:
         order.transaction_id = f"{order.id}-{uuid.uuid4().hex[:12]}"
-        order.save(update_fields=['transaction_id'])
+        await order.asave(update_fields=['transaction_id'])
         logger.info(f"Generated transaction ID {order.transaction_id} for Order {order.id}")
 
     gateway_url = None
     error_message = None
     
     try:
-        payment_data = generate_sslcommerz_payment(request, order)
+        payment_data = await agenerate_sslcommerz_payment(request, order)
         gateway_url = payment_data.get('GatewayPageURL')
         
         if not gateway_url:
@@ -348,17 +508,19 @@ def payment_process(request):
         return redirect('payment_fail', order_id=order.id)
 
     logger.info(f"Payment gateway URL generated for Order {order.id}, redirecting user")
-    return render(request, 'JRShop/payment_process.html', {
+    # Context processors query the database, so render in the sync thread
+    return await sync_to_async(render)(request, 'JRShop/payment_process.html', {
         'order': order,
         'gateway_url': gateway_url,
     })
 
 
+@use_primary
 @csrf_exempt
 @login_required
 def payment_success(request, order_id):
     try:
-        order = Order.objects.get(id=order_id, user=request.user)
+        order = Order.objects.with_totals().with_items().get(id=order_id, user=request.user)
     except Order.DoesNotExist:
         messages.error(request, 'Order not found.')
         return redirect('home')
@@ -374,6 +536,7 @@ def payment_success(request, order_id):
     })
 
 
+@use_primary
 @csrf_exempt
 @login_required
 def payment_fail(request, order_id):
@@ -390,6 +553,7 @@ def payment_fail(request, order_id):
     })
 
 
+@use_primary
 @csrf_exempt
 @login_required
 def payment_cancel(request, order_id):
@@ -406,6 +570,7 @@ def payment_cancel(request, order_id):
     })
 
 
+@use_primary
 @login_required
 def payment_retry(request, order_id):
     try:
@@ -421,12 +586,13 @@ def payment_retry(request, order_id):
     return redirect('payment_process')
 
 
+@use_primary
 @csrf_exempt
 @require_http_methods(["POST", "GET"])
-def sslcommerz_success(request, order_id):
+async def sslcommerz_success(request, order_id):
     """Handle successful payment callback from SSL Commerz"""
     logger.info(f"SSL Commerz success callback received for Order {order_id}")
-    order = get_object_or_404(Order, id=order_id)
+    order = await aget_object_or_404(Order.objects.with_totals(), id=order_id)
 
     tran_id = (request.POST.get('tran_id') or request.GET.get('tran_id') or '').strip()
     val_id = (request.POST.get('val_id') or request.GET.get('val_id') or '').strip()
@@ -447,23 +613,23 @@ def sslcommerz_success(request, order_id):
     if not val_id:
         logger.error(f"No validation ID provided for Order {order_id}")
         order.status = 'pending'
-        order.save(update_fields=['status'])
+        await order.asave(update_fields=['status'])
         return redirect('payment_fail', order_id=order.id)
 
     try:
-        validation = validate_sslcommerz_payment(val_id)
+        validation = await avalidate_payment(val_id, order)
     except Exception as e:
         logger.exception(f"Payment validation failed for Order {order_id}: {str(e)}")
         order.status = 'pending'
-        order.save(update_fields=['status'])
+        await order.asave(update_fields=['status'])
         return redirect('payment_fail', order_id=order.id)
 
     # Check validation status
     status = (validation.get('status') or '').upper()
-    if status not in ('VALID', 'VALIDATED'):
+    if not is_valid(validation):
         logger.warning(f"Invalid payment status for Order {order_id}: {status}")
         order.status = 'pending'
-        order.save(update_fields=['status'])
+        await order.asave(update_fields=['status'])
         return redirect('payment_fail', order_id=order.id)
 
     # Verify payment amount
@@ -477,30 +643,17 @@ def sslcommerz_success(request, order_id):
     if paid_amount and paid_amount != order_amount:
         logger.error(f"Amount mismatch for Order {order_id}: expected {order_amount}, got {paid_amount}")
         order.status = 'pending'
-        order.save(update_fields=['status'])
+        await order.asave(update_fields=['status'])
         return redirect('payment_fail', order_id=order.id)
 
-    # Mark order as paid and update stock
-    order.paid = True
-    order.status = 'processing'
-    if tran_id:
-        order.transaction_id = tran_id
-    order.save(update_fields=['paid', 'status', 'transaction_id'])
-    logger.info(f"Order {order_id} marked as paid successfully")
-
-    # Update product stock
-    for item in order.order_items.all():
-        product = item.product
-        old_stock = product.stock
-        product.stock -= item.quantity
-        if product.stock < 0:
-            product.stock = 0
-        product.save(update_fields=['stock'])
-        logger.info(f"Updated stock for Product {product.id}: {old_stock} -> {product.stock}")
+    # Mark order as paid and settle stock; the IPN may have beaten us to it
+    if not await sync_to_async(finalize_payment)(order, transaction_id=tran_id):
+        logger.info(f"Order {order_id} was already finalized by another callback")
 
     return redirect('payment_success', order_id=order.id)
 
 
+@use_primary
 @csrf_exempt
 @require_http_methods(["POST", "GET"])
 def sslcommerz_fail(request, order_id):
@@ -524,6 +677,7 @@ def sslcommerz_fail(request, order_id):
     return redirect('payment_fail', order_id=order.id)
 
 
+@use_primary
 @csrf_exempt
 @require_http_methods(["POST", "GET"])
 def sslcommerz_cancel(request, order_id):
@@ -545,10 +699,16 @@ def sslcommerz_cancel(request, order_id):
     return redirect('payment_cancel', order_id=order.id)
 
 
+@use_primary
 @csrf_exempt
 @require_http_methods(["POST"])
-def sslcommerz_ipn(request):
-    """Handle Instant Payment Notification (IPN) from SSL Commerz"""
+async def sslcommerz_ipn(request):
+    """
+    Handle Instant Payment Notification (IPN) from SSL Commerz.
+
+    The notification is only recorded here; a run_jobs worker validates
+    it and marks the order paid. A retried IPN is queued only once.
+    """
     tran_id = (request.POST.get('tran_id') or '').strip()
     val_id = (request.POST.get('val_id') or '').strip()
 
@@ -558,73 +718,33 @@ def sslcommerz_ipn(request):
         logger.warning("Invalid IPN: missing tran_id or val_id")
         return HttpResponseBadRequest('Invalid IPN')
 
-    try:
-        order = Order.objects.get(transaction_id=tran_id)
-    except Order.DoesNotExist:
-        logger.warning(f"IPN for non-existent order: tran_id={tran_id}")
-        return HttpResponse('OK')
-
-    if order.paid:
-        logger.info(f"IPN for already paid Order {order.id}")
-        return HttpResponse('OK')
-
-    try:
-        validation = validate_sslcommerz_payment(val_id)
-    except Exception as e:
-        logger.exception(f"IPN validation failed for Order {order.id}: {str(e)}")
-        return HttpResponse('OK')
-
-    status = (validation.get('status') or '').upper()
-    if status not in ('VALID', 'VALIDATED'):
-        logger.warning(f"IPN invalid status for Order {order.id}: {status}")
-        return HttpResponse('OK')
-
-    # Mark order as paid
-    order.paid = True
-    order.status = 'processing'
-    order.save(update_fields=['paid', 'status'])
-    logger.info(f"IPN: Order {order.id} marked as paid")
-
-    # Update stock
-    for item in order.order_items.all():
-        product = item.product
-        product.stock -= item.quantity
-        if product.stock < 0:
-            product.stock = 0
-        product.save(update_fields=['stock'])
-
+    await aenqueue('process_ipn', {'tran_id': tran_id, 'val_id': val_id}, key=f'ipn:{tran_id}:{val_id}')
     return HttpResponse('OK')
 
 
 @login_required
 def profile(request):
-    # Get all orders for the user
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    
-    # Get completed orders
-    completed_orders = orders.filter(status='delivered')
-    
-    # Calculate total spent
-    total_spent = sum(order.get_total_cost() for order in orders)
-    
-    # Get cart items count for navbar
-    cart_items_count = 0
+    # Order history may come from a replica
+    db = read_database()
+    summary = order_summary(request.user, using=db)
+
+    orders = Order.objects.using(db).filter(user=request.user).with_totals().with_items()
+    paginator = CursorPaginator(orders, per_page=ORDERS_PER_PAGE)
     try:
-        cart = Cart.objects.get(user=request.user)
-        cart_items_count = cart.items.count()
-    except Cart.DoesNotExist:
-        cart_items_count = 0
+        page = paginator.page(after=request.GET.get('after'), before=request.GET.get('before'))
+    except InvalidCursor:
+        page = paginator.page()
     
     # Check which tab is active
     tab = request.GET.get('tab', 'orders')
     
     return render(request, 'JRShop/profile.html', {
         'user': request.user,
-        'orders': orders,
-        'completed_orders': completed_orders,
-        'total_spent': total_spent,
+        'orders': page,
+        'summary': summary,
+        'next_query': _page_query(request.GET, after=page.next_cursor) if page.has_next else None,
+        'previous_query': _page_query(request.GET, before=page.previous_cursor) if page.has_previous else None,
         'order_history_active': (tab == 'orders'),
-        'cart_items_count': cart_items_count
     })
 
 
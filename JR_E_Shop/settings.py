@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import copy
 import os
 from pathlib import Path
 
@@ -53,11 +54,15 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'JRShop.middleware.StaticFilesMiddleware',
+    'JRShop.middleware.InstrumentationMiddleware',
+    'JRShop.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'JRShop.middleware.CartMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "allauth.account.middleware.AccountMiddleware",
 ]
@@ -66,7 +71,8 @@ ROOT_URLCONF = 'JR_E_Shop.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for the Server-Timing header
+        'BACKEND': 'JRShop.instrumentation.DjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -74,6 +80,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'JRShop.context_processors.cart_summary',
             ],
         },
     },
@@ -85,12 +92,92 @@ WSGI_APPLICATION = 'JR_E_Shop.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite unless DB_ENGINE=postgresql, e.g.
+#   DB_ENGINE=postgresql DB_NAME=jrshop DB_USER=jrshop DB_PASSWORD=secret DB_HOST=127.0.0.1
+# Compare profiles with manage.py bench_database
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    # Django's connection pool (needs psycopg[pool]); set DB_POOL=False to
+    # keep persistent connections instead, e.g. behind PgBouncer
+    DB_POOL = os.environ.get('DB_POOL', 'True') == 'True'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'jrshop'),
+            'USER': os.environ.get('DB_USER', ''),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', ''),
+            'PORT': os.environ.get('DB_PORT', ''),
+            # Pooled connections go back to the pool after each request
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+            # Check a persistent connection is alive before reusing it
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', '2')),
+                    'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '20')),
+                    'timeout': int(os.environ.get('DB_POOL_TIMEOUT', '10')),  # Seconds to wait for a free connection
+                },
+            } if DB_POOL else {},
+        }
     }
-}
+else:
+    DB_NAME = Path(os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'))
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': DB_NAME,
+            'OPTIONS': {
+                # Take the write lock when a transaction begins (SQLite has no
+                # SELECT ... FOR UPDATE) so concurrent checkouts queue up
+                # instead of failing when upgrading a read lock
+                'transaction_mode': 'IMMEDIATE',
+                # busy_timeout: seconds a writer waits for the lock before
+                # "database is locked"
+                'timeout': 20,
+                # Run on every new connection. WAL lets readers carry on while
+                # one writer commits; synchronous=NORMAL only syncs at
+                # checkpoints (still safe against corruption in WAL mode);
+                # reads go through a 256 MB memory map and a 64 MB page cache
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA mmap_size=268435456;'
+                    'PRAGMA cache_size=-65536;'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+            'TEST': {
+                # Concurrency tests need a real file, not a shared in-memory DB.
+                # It sits next to the database, so each DB_NAME gets its own
+                'NAME': DB_NAME.with_name(f'test_{DB_NAME.name}'),
+            },
+        }
+    }
+
+
+# Read replicas for catalog reads (JRShop/routers.py): comma-separated
+# SQLite files or PostgreSQL host[:port]s, e.g. DB_REPLICAS=replica.sqlite3
+# against a copy of db.sqlite3, or DB_REPLICAS=10.0.0.2,10.0.0.3:5433
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), 1):
+    alias = f'replica{number}'
+    DATABASES[alias] = copy.deepcopy(DATABASES['default'])
+    if DB_ENGINE == 'postgresql':
+        host, _, port = replica.strip().partition(':')
+        DATABASES[alias].update(HOST=host, PORT=port or DATABASES[alias]['PORT'])
+    else:
+        DATABASES[alias]['NAME'] = BASE_DIR / replica.strip()
+    # Tests read the replicas through the test primary
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['JRShop.routers.ReplicaRouter']
+
+# Seconds a visitor reads only from the primary after writing anything, and
+# everyone does after a catalog change; should exceed the replication lag
+REPLICA_STICKY_SECONDS = 5
 
 
 # Password validation
@@ -128,6 +215,17 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = '/static/'
+# manage.py collectstatic fingerprints and compresses files into STATIC_ROOT,
+# which the app then serves itself (JRShop/staticfiles.py)
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'JRShop.staticfiles.CompressedManifestStaticFilesStorage',
+    },
+}
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
@@ -202,6 +300,11 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        # Slow-request records are already JSON
+        'json_line': {
+            'format': '{message}',
+            'style': '{',
+        },
     },
     'handlers': {
         'console': {
@@ -218,6 +321,11 @@ LOGGING = {
             'filename': LOGS_DIR / 'payment.log',
             'formatter': 'verbose',
         },
+        'slow_requests_file': {
+            'class': 'logging.FileHandler',
+            'filename': LOGS_DIR / 'slow_requests.log',
+            'formatter': 'json_line',
+        },
     },
     'loggers': {
         'django': {
@@ -230,11 +338,80 @@ LOGGING = {
             'level': 'DEBUG' if DEBUG else 'INFO',
             'propagate': False,
         },
+        'JRShop.slow_requests': {
+            'handlers': ['slow_requests_file'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
 
+# Cache: local memory unless configured, e.g.
+#   CACHE_BACKEND=django.core.cache.backends.redis.RedisCache CACHE_LOCATION=redis://127.0.0.1:6379/1
+#   CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache CACHE_LOCATION=/var/tmp/jrshop_cache
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Sessions are only written to django_session when their data changed;
+# expired rows are deleted in batches by manage.py purge_sessions, run from
+# cron (see JRShop/sessions.py). They are served from the cache only when
+# every worker shares it: each process has its own local-memory cache, so a
+# logout or change made in one worker would go unseen by the others
+SHARED_CACHE_BACKENDS = (
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+)
+SESSION_ENGINE = 'JRShop.cached_sessions' if CACHES['default']['BACKEND'] in SHARED_CACHE_BACKENDS else 'JRShop.sessions'
+
+# Catalog caching (see JRShop/caching.py); saves invalidate both at once
+CATALOG_PAGE_CACHE_TIMEOUT = 120  # Whole pages for anonymous visitors; also bounds stale stock counts
+CATALOG_FRAGMENT_CACHE_TIMEOUT = 3600  # Product cards, category sidebar, related products
+
+# Cart summary (navbar badge) cache lifetime in seconds; views that change
+# the cart drop it straight away, this only bounds staleness across
+# processes when the cache backend is not shared
+CART_SUMMARY_TIMEOUT = 300
+
+# Visitors who are not logged in keep their cart in a signed cookie (see
+# JRShop/cart.py), merged into their saved cart when they log in
+ANONYMOUS_CART_COOKIE_AGE = 30 * 24 * 3600
+ANONYMOUS_CART_MAX_LINES = 50  # Keeps the cookie well under the 4 KB browsers allow
+
+# Request instrumentation (see JRShop/instrumentation.py)
+INSTRUMENTATION_SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', '1'))  # Share of requests measured
+INSTRUMENTATION_SERVER_TIMING = True  # Send the measurements to the browser as a Server-Timing header
+SLOW_REQUEST_THRESHOLD_MS = int(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', '500'))  # Logged to logs/slow_requests.log
+N_PLUS_ONE_THRESHOLD = 5  # A query run this many times in one request is reported as repeated
+
+# Admin changelists the database estimates at more than this many rows
+# show the estimate instead of running COUNT(*) (see JRShop/pagination.py)
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100_000
+
+# Minutes an unpaid order holds its reserved stock before
+# release_expired_reservations returns it to the shelf
+STOCK_RESERVATION_MINUTES = 30
+
 # SSL Commerz Configuration
-SSLCOMMERZ_TIMEOUT = 30  # Timeout for SSL Commerz API requests in seconds
+SSLCOMMERZ_CONNECT_TIMEOUT = 5  # Seconds to establish a connection to the gateway
+SSLCOMMERZ_READ_TIMEOUT = 20  # Seconds to wait for the gateway's response
+SSLCOMMERZ_RETRIES = 3  # Retries for validation (GET) calls, with jittered backoff
+SSLCOMMERZ_POOL_SIZE = 20  # Keep-alive connections kept per gateway host
+SSLCOMMERZ_ASYNC_MAX_CONNECTIONS = 512  # In-flight gateway calls per ASGI worker
+SSLCOMMERZ_CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive failures before failing fast
+SSLCOMMERZ_CIRCUIT_RESET_SECONDS = 30  # How long to fail fast before trying again
+PAYMENT_VALIDATION_CACHE_TIMEOUT = 300  # Seconds a val_id's successful validation is reused from the cache
+PAYMENT_VALIDATION_FAILURE_CACHE_TIMEOUT = 5  # Seconds an INVALID/FAILED answer is, just for callers waiting on it
+
+# Background jobs (manage.py run_jobs)
+JOB_VISIBILITY_TIMEOUT = 300  # Seconds before a job held by a silent worker is handed to another
+JOB_MAX_ATTEMPTS = 8
+JOB_RETRY_BASE_DELAY = 10  # Seconds before the first retry, doubling after each failure
+JOB_RETRY_MAX_DELAY = 3600
 
 # SSL Commerz setup
 SSLCOMMERZ_STORE_ID = os.environ.get('SSLCOMMERZ_STORE_ID', '')